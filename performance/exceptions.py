@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Memory of the recording of code using exceptions for control flow.
+
+Each round makes a batch of monitored calls ended by an exception caught by
+their monitored caller. The call stack must stay empty between rounds, and the
+traced memory must level off: the script fails if it grows by more than
+MAX_GROWTH_KIB over the second half of the rounds.
+"""
+import json
+import sys
+import tracemalloc
+
+import spacetimepy
+
+# Growth of the traced memory allowed over the second half of the rounds
+MAX_GROWTH_KIB = 64
+
+
+class Stop(Exception):
+    pass
+
+
+@spacetimepy.pymonitor(mode="function")
+def search(items, target):
+    try:
+        for item in items:
+            check(item, target)
+    except Stop as e:
+        return e.args[0]
+    return None
+
+
+@spacetimepy.pymonitor(mode="function")
+def check(item, target):
+    if item == target:
+        raise Stop(item)
+
+
+def run_round(calls):
+    for i in range(calls):
+        search(range(5), i % 5)
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    monitor = spacetimepy.init_monitoring(db_path=":memory:")
+    spacetimepy.start_session("Exception memory")
+    run_round(calls)  # Warm the caches
+    monitor.flush()
+
+    tracemalloc.start()
+    results = []
+    for round_number in range(rounds):
+        run_round(calls)
+        monitor.flush()
+        current, peak = tracemalloc.get_traced_memory()
+        results.append({
+            "round": round_number,
+            "traced_kib": current / 1024,
+            "peak_kib": peak / 1024,
+            "stack_depth": len(monitor.call_stack),
+        })
+        print(f"round {round_number:3d} {current / 1024:10.1f} KiB traced, call stack depth {len(monitor.call_stack)}")
+    tracemalloc.stop()
+    spacetimepy.end_session()
+
+    with open("perf_exceptions.json", "w") as f:
+        json.dump(results, f)
+
+    growth = results[-1]["traced_kib"] - results[rounds // 2]["traced_kib"]
+    print(f"Growth over the second half of the rounds: {growth:.1f} KiB")
+    if any(result["stack_depth"] for result in results):
+        raise SystemExit("Calls ended by an exception were left on the call stack")
+    if growth > MAX_GROWTH_KIB:
+        raise SystemExit(f"Traced memory didn't level off, it grew by {growth:.1f} KiB (max {MAX_GROWTH_KIB} KiB)")
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Compare the cost of a monitored function while recording is paused with the
+same function without monitoring.
+
+Paused functions have their sys.monitoring events turned off, so both should
+run at the same speed.
+"""
+import json
+import timeit
+
+import spacetimepy
+
+
+def small_function(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+@spacetimepy.pymonitor(mode="function")
+def small_function_mnt(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+@spacetimepy.pymonitor(mode="line")
+def small_function_line(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+def bench(func, number):
+    # Best of 5 runs, in microseconds per call
+    return min(timeit.repeat(lambda: func(10), number=number, repeat=5)) / number * 1e6
+
+
+if __name__ == "__main__":
+    monitor = spacetimepy.init_monitoring(db_path=":memory:")
+    spacetimepy.start_session("Pause overhead")
+
+    results = {"unmonitored": bench(small_function, 100_000)}
+
+    spacetimepy.disable_recording()
+    results["function_paused"] = bench(small_function_mnt, 100_000)
+    results["line_paused"] = bench(small_function_line, 100_000)
+    spacetimepy.enable_recording()
+
+    results["function_recording"] = bench(small_function_mnt, 200)
+    results["line_recording"] = bench(small_function_line, 200)
+    spacetimepy.end_session()
+
+    for name, us in results.items():
+        print(f"{name:20s} {us:10.2f} us/call")
+    with open("perf_pause.json", "w") as f:
+        json.dump(results, f)
@@ -6,9 +6,12 @@ from .core import (
     CodeDefinition,
     CodeManager,
     CodeObjectLink,
+    CompressionDictionary,
+    DatabaseInfo,
     FunctionCall,
     FunctionCallRepository,
     MonitoringSession,
+    ObjectChunk,
     ObjectIdentity,
     ObjectManager,
     PyMonitoring,  # Backward compatibility alias
@@ -31,6 +34,7 @@ from .core import (
     replay_session_from,
     run_with_state,
     session_context,
+    set_line_filter,
     start_session,
 )
 
@@ -89,9 +93,13 @@ __all__ = [
     'CodeDefinition',
     'CodeObjectLink',
     'MonitoringSession',
+    'DatabaseInfo',
+    'ObjectChunk',
+    'CompressionDictionary',
     # Monitoring
     'init_monitoring',
     'pymonitor',
+    'set_line_filter',
     # Session Management
     'start_session',
     'end_session',
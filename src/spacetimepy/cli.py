@@ -0,0 +1,78 @@
+"""
+Command line tools working on recorded databases.
+
+    spacetimepy recompress monitoring.db --codec lzma
+    spacetimepy merge monitoring.db monitoring.*.db
+"""
+
+import argparse
+import logging
+import os
+
+from sqlalchemy import text
+
+from .core.compression import CODECS, COMPRESSION_THRESHOLD, Compressor, recompress
+from .core.models import init_db
+from .core.shards import merge_databases
+
+
+def recompress_command(args):
+    """Recompress the stored states of a database, then shrink the file"""
+    if not os.path.exists(args.db_file):
+        raise SystemExit(f"Database not found: {args.db_file}")
+    file_size = os.path.getsize(args.db_file)
+    try:
+        compressor = Compressor(args.codec, args.level, args.min_size, args.dictionaries)
+    except ValueError as e:
+        raise SystemExit(str(e)) from e
+
+    Session = init_db(args.db_file, in_memory=False)
+    with Session() as session:
+        size_before, size_after = recompress(session, compressor)
+        session.execute(text("VACUUM"))
+    print(f"Payloads: {size_before} -> {size_after} bytes")
+    print(f"Database file: {file_size} -> {os.path.getsize(args.db_file)} bytes")
+
+
+def merge_command(args):
+    """Merge the shards of child processes (or any recordings) into one database"""
+    try:
+        counts = merge_databases(args.output, args.sources)
+    except ValueError as e:
+        raise SystemExit(str(e)) from e
+    print(f"Merged {len(args.sources)} databases into {args.output}: {counts['function_calls']} calls, "
+          f"{counts['stack_snapshots']} snapshots, {counts['monitoring_sessions']} sessions")
+    if args.delete:
+        for source in args.sources:
+            os.remove(source)
+
+
+def main():
+    """Main function for the spacetimepy command line tool."""
+    parser = argparse.ArgumentParser(description='SpaceTimePy database tools')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Show the progress logs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    recompress_parser = subparsers.add_parser('recompress', help='Recompress the stored states of a database')
+    recompress_parser.add_argument('db_file', help='Path to the SQLite database file')
+    recompress_parser.add_argument('--codec', choices=CODECS, default='zlib',
+                                   help='Compression codec, "none" to decompress everything')
+    recompress_parser.add_argument('--level', type=int, default=None, help='zlib level or lzma preset')
+    recompress_parser.add_argument('--min-size', type=int, default=COMPRESSION_THRESHOLD,
+                                   help='Size in bytes under which states are left uncompressed')
+    recompress_parser.add_argument('--dictionaries', action='store_true',
+                                   help='Train a zlib dictionary per type (zlib only)')
+    recompress_parser.set_defaults(handler=recompress_command)
+
+    merge_parser = subparsers.add_parser('merge', help='Merge the shards of child processes into one database')
+    merge_parser.add_argument('output', help='Database receiving the rows, created if missing')
+    merge_parser.add_argument('sources', nargs='+', help='Databases to merge, e.g. monitoring.*.db')
+    merge_parser.add_argument('--delete', action='store_true', help='Delete the merged databases')
+    merge_parser.set_defaults(handler=merge_command)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    args.handler(args)
+
+if __name__ == '__main__':
+    main()
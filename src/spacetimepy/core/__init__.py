@@ -8,15 +8,18 @@ from .function_call import FunctionCallRepository
 from .models import (
     CodeDefinition,
     CodeObjectLink,
+    CompressionDictionary,
+    DatabaseInfo,
     FunctionCall,
     MonitoringSession,
+    ObjectChunk,
     ObjectIdentity,
     StackSnapshot,
     StoredObject,
     export_db,
     init_db,
 )
-from .monitoring import SpaceTimeMonitor, init_monitoring, pymonitor, function, line
+from .monitoring import SpaceTimeMonitor, init_monitoring, pymonitor, function, line, set_line_filter
 
 # Backward compatibility alias
 PyMonitoring = SpaceTimeMonitor
@@ -110,6 +113,7 @@ __all__ = [
     'function',
     'line',
     'init_monitoring',
+    'set_line_filter',
     # Core classes
     'SpaceTimeMonitor',
     'PyMonitoring',  # Backward compatibility alias
@@ -125,6 +129,9 @@ __all__ = [
     'CodeDefinition',
     'CodeObjectLink',
     'MonitoringSession',
+    'DatabaseInfo',
+    'ObjectChunk',
+    'CompressionDictionary',
     # Session management
     'start_session',
     'end_session',
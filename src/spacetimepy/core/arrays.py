@@ -0,0 +1,92 @@
+"""
+Capture and storage of NumPy arrays.
+
+Arrays are pickled with protocol 5 out-of-band buffers: the pickle only
+holds the dtype, shape and strides, the data stays in the array's own
+buffer. The reference of an array is hashed directly over that buffer, so
+an array whose state is already stored is never copied, and the stored
+payload is a frame holding the pickle followed by the raw buffers. Loading a
+frame rebuilds the array over the payload without copying it (the array is
+then read-only).
+
+Frames start with a byte no pickle starts with (like compressed payloads,
+see compression.py). Arrays are only handled here if numpy has already been
+imported by the monitored program, spacetimepy doesn't import it.
+"""
+
+import io
+import pickle
+import struct
+import sys
+from typing import Any
+
+from .digest import Digest
+
+# First byte of array frames
+ARRAY_FRAME = 4
+# Frame header: first byte, pickle size, number of buffers, then the size of each buffer
+_HEADER = struct.Struct("<BII")
+_BUFFER_SIZE = struct.Struct("<Q")
+
+
+def is_array(value: Any) -> bool:
+    """Return True if a value is a plain NumPy array of non-object dtype"""
+    np = sys.modules.get("numpy")
+    return np is not None and type(value) is np.ndarray and not value.dtype.hasobject
+
+
+def is_array_frame(data: bytes | None) -> bool:
+    """Return True if a payload is an array frame"""
+    return bool(data) and data[0] == ARRAY_FRAME # type: ignore
+
+
+def split_array(value: Any, dispatch_table=None) -> tuple[bytes, list[memoryview]]:
+    """Pickle an array without its data.
+
+    Returns:
+        The pickle and the raw buffers it refers to (views on the array, not copies)
+    """
+    buffers: list[pickle.PickleBuffer] = []
+    file = io.BytesIO()
+    pickler = pickle.Pickler(file, protocol=5, buffer_callback=buffers.append)
+    if dispatch_table:
+        pickler.dispatch_table = dispatch_table
+    pickler.dump(value)
+    # Non-contiguous arrays are pickled with their data, they have no out-of-band buffer
+    return file.getvalue(), [buffer.raw() for buffer in buffers]
+
+
+def array_ref(meta: bytes, buffers: list[memoryview], digest: Digest) -> str:
+    """Compute the reference of an array from its pickle and buffers, without copying them"""
+    return digest(b"".join([meta, *(digest(buffer).encode() for buffer in buffers)])) # type: ignore
+
+
+def encode_frame(meta: bytes, buffers: list[memoryview]) -> bytes:
+    """Build the stored payload of an array (the single copy of its data)"""
+    header = _HEADER.pack(ARRAY_FRAME, len(meta), len(buffers))
+    sizes = b"".join(_BUFFER_SIZE.pack(buffer.nbytes) for buffer in buffers)
+    return b"".join([header, sizes, meta, *buffers])
+
+
+def decode_frame(data: bytes) -> tuple[bytes, list[memoryview]]:
+    """Get the pickle and the buffers of an array frame, as views on the payload"""
+    view = memoryview(data)
+    _, meta_size, buffer_count = _HEADER.unpack_from(view)
+    offset = _HEADER.size
+    sizes = [_BUFFER_SIZE.unpack_from(view, offset + i * _BUFFER_SIZE.size)[0] for i in range(buffer_count)]
+    offset += buffer_count * _BUFFER_SIZE.size
+    meta = view[offset:offset + meta_size]
+    offset += meta_size
+    buffers = []
+    for size in sizes:
+        buffers.append(view[offset:offset + size])
+        offset += size
+    return meta, buffers # type: ignore
+
+
+def writable(value: Any) -> Any:
+    """Return a writable copy of a read-only array loaded from a frame, other values as is"""
+    if is_array(value) and not value.flags.writeable:
+        return value.copy()
+    return value
+
@@ -0,0 +1,211 @@
+"""
+Precompiled capture plans for monitored code objects.
+
+Everything the monitoring callbacks need to know about a monitored function
+(argument names, ignored variables, hooks, lines to record...) is resolved
+once, when the function is decorated, instead of on every event.
+"""
+
+import builtins
+import dis
+import inspect
+import linecache
+import logging
+import sys
+import types
+from collections.abc import Callable, Iterable
+from typing import Any
+
+from .capture_policy import CapturePolicy
+from .sampling import SamplingPolicy
+
+logger = logging.getLogger(__name__)
+
+
+def accessed_global_names(code: types.CodeType) -> frozenset[str]:
+    """Extract the global names loaded by the bytecode of a code object.
+
+    Dunder names, builtins and built-in module names are skipped.
+    """
+    accessed_names = set()
+    for instr in dis.get_instructions(code):
+        if instr.opname == "LOAD_GLOBAL":
+            name = instr.argval
+            # Skip special dunder methods
+            if name.startswith('__') and name.endswith('__'):
+                continue
+            # Skip built-in variables
+            if name in sys.builtin_module_names:
+                continue
+            # Skip if it's a default function(like print, len, etc)
+            if hasattr(builtins, name):
+                continue
+            accessed_names.add(name)
+    return frozenset(accessed_names)
+
+
+def is_coroutine_code(code: types.CodeType) -> bool:
+    """Return True for the code of a coroutine, which yields to the event loop when it awaits"""
+    return bool(code.co_flags & (inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE))
+
+
+def monitored_events(code: types.CodeType, mode: str = "function") -> int:
+    """Local sys.monitoring events needed to record a code object"""
+    events = sys.monitoring.events.PY_START | sys.monitoring.events.PY_RETURN
+    if mode == "line":
+        events |= sys.monitoring.events.LINE
+    if is_coroutine_code(code):
+        events |= sys.monitoring.events.PY_YIELD | sys.monitoring.events.PY_RESUME
+    return events
+
+
+def tagged_lines(code: types.CodeType) -> frozenset[int]:
+    """Return the line numbers of a code object whose source contains "#tag" """
+    lines = {line for _, _, line in code.co_lines() if line is not None}
+    return frozenset(line for line in lines if "#tag" in linecache.getline(code.co_filename, line))
+
+
+_MISSING = object()
+
+
+class GlobalsClosure:
+    """Global variables a code object can read, directly or through the functions it calls.
+
+    The global names of the code are resolved once, following the functions
+    they refer to (through their own globals) recursively. Modules and
+    functions are not captured themselves. The closure is the list of the
+    (globals, name) pairs visited, values() only does one lookup for each of
+    them. The closure goes stale when a visited name is rebound to another
+    function, when a name that wasn't a function becomes one, or when the code
+    of a visited function is replaced (hotswap).
+
+    Args:
+        code: The code object
+        globals: Its globals
+        names_of: Function giving the global names accessed by a code object
+        accessed_names: Global names accessed by the code, if already known
+        processed_functions: Names of the functions already visited, each name is only followed once
+    """
+
+    def __init__(self, code: types.CodeType, globals: dict[str, Any],
+                 names_of: Callable[[types.CodeType], Iterable[str]] = accessed_global_names,
+                 accessed_names: Iterable[str] | None = None, processed_functions: set[str] | None = None):
+        self.code = code
+        self.globals = globals
+        # (globals, name, function and its code if the name refers to a function)
+        self.entries: list[tuple[dict[str, Any], str, types.FunctionType | None, types.CodeType | None]] = []
+        if accessed_names is None:
+            accessed_names = names_of(code)
+        self._visit(globals, accessed_names, names_of, set() if processed_functions is None else processed_functions)
+
+    def _visit(self, globals: dict[str, Any], names: Iterable[str], names_of: Callable, processed_functions: set[str]):
+        for name in names:
+            value = globals.get(name, _MISSING)
+            if type(value) is not types.FunctionType:
+                self.entries.append((globals, name, None, None))
+                continue
+            self.entries.append((globals, name, value, value.__code__))
+            if name not in processed_functions:
+                processed_functions.add(name)
+                self._visit(value.__globals__, names_of(value.__code__), names_of, processed_functions)
+
+    def values(self) -> dict[str, Any] | None:
+        """Current values of the global variables, None if the closure is stale"""
+        used = {}
+        for globals, name, function, code in self.entries:
+            value = globals.get(name, _MISSING)
+            if function is not None:
+                if value is not function or function.__code__ is not code:
+                    return None
+            elif type(value) is types.FunctionType:
+                return None
+            elif value is not _MISSING and not isinstance(value, types.ModuleType):
+                used[name] = value
+        return used
+
+
+class CapturePlan:
+    """What to capture for one monitored code object.
+
+    Attributes:
+        code: The monitored code object
+        func: The function owning the code object, if known
+        mode: "function" or "line"
+        name: Name of the code object
+        arg_names: Names of the positional arguments captured at function start
+        is_method: Whether the function receives `self`, its recorded name is then
+            prefixed with the class of `self`
+        ignore: Variable names never captured
+        start_hooks: Hooks called at function start
+        return_hooks: Hooks called at function return
+        tracked_by: Name of the monitored function this one is only recorded within
+        global_names: Global names accessed by the code
+        allowed_lines: Line numbers recorded in line mode, None for all of them.
+            The line callback disables the other line locations.
+        module_path: File of the module defining the function
+        sampling: Sampling policy of the function, None to use the monitor's
+        capture_policy: Size limits of the captured values, None to use the monitor's
+        fork: Whether line snapshots are captured in a forked child (see fork_capture.py)
+        is_coroutine: Whether the code is a coroutine, its suspensions are then recorded
+        code_definition: (key of the monitor's code definitions, code definition ID) once
+            resolved by a monitor, see SpaceTimeMonitor._code_definition_id
+    """
+
+    def __init__(self, func: Callable | None, code: types.CodeType | None = None, mode: str = "function",
+                 ignore: Iterable[str] | None = None, start_hooks: Iterable[Callable] | None = None,
+                 return_hooks: Iterable[Callable] | None = None, lines: Iterable[int] | None = None,
+                 use_tag_line: bool = False, sampling: SamplingPolicy | None = None,
+                 capture_policy: CapturePolicy | None = None, fork: bool = False):
+        if code is None:
+            if func is None:
+                raise ValueError("A capture plan needs a function or a code object")
+            code = func.__code__
+        self.code = code
+        self.func = func
+        self.mode = mode
+        self.name = code.co_name
+        self.arg_names = code.co_varnames[:code.co_argcount]
+        self.is_method = "self" in self.arg_names
+        self.ignore = frozenset(ignore or ())
+        self.start_hooks = tuple(start_hooks or ())
+        self.return_hooks = tuple(return_hooks or ())
+        self.tracked_by: str | None = None
+        self.global_names = accessed_global_names(code)
+        self.allowed_lines: frozenset[int] | None = None
+        self.set_line_filter(lines, use_tag_line)
+        self.sampling = sampling
+        self.capture_policy = capture_policy
+        self.fork = fork
+        self.is_coroutine = is_coroutine_code(code)
+        self.code_definition: tuple[object, str | None] | None = None
+
+        self.module_path = None
+        if inspect.isfunction(func):
+            try:
+                module = inspect.getmodule(func)
+                self.module_path = getattr(module, '__file__', None)
+            except Exception as e:
+                logger.debug(f"Could not resolve the module of {self.name}: {e}")
+
+    def set_line_filter(self, lines: Iterable[int] | None = None, use_tag_line: bool = False):
+        """Set the lines recorded in line mode.
+
+        Args:
+            lines: Line numbers to record, None for all of them
+            use_tag_line: Only record the lines containing "#tag" (among lines if given)
+        """
+        allowed_lines = frozenset(lines) if lines is not None else None
+        if use_tag_line:
+            tags = tagged_lines(self.code)
+            allowed_lines = tags if allowed_lines is None else allowed_lines & tags
+        self.allowed_lines = allowed_lines
+        self.code_definition = None
+
+    def qualname(self, frame_locals) -> str:
+        """Return the name recorded for a call, given the locals at function start"""
+        if self.is_method and 'self' in frame_locals:
+            return f"{frame_locals['self'].__class__.__name__}.{self.name}"
+        return self.name
+
+    def __repr__(self) -> str:
+        return f"CapturePlan({self.name}, mode={self.mode})"
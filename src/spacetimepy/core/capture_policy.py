@@ -0,0 +1,250 @@
+"""
+Size limits of captured values.
+
+A capture policy can be set for all monitored functions (init_monitoring) or
+per function (pymonitor). Values above its limits are not pickled, a compact
+ValueSummary (type, length, shape, a sample of elements and a hash of their
+fingerprint) is stored instead, marked with `StoredObject.is_summary`.
+
+The limits are checked before pickling, on the length of the value, an
+estimate of its size and its nesting depth, all computed on a sample of the
+elements of large containers. The serialized size is checked again after
+pickling, for values whose size was underestimated.
+"""
+
+import logging
+import sys
+from collections.abc import Mapping, Sequence
+from collections.abc import Set as AbstractSet
+from itertools import islice
+from typing import Any
+
+from .change_detection import fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Elements looked at to estimate the size and depth of a container, and kept in a summary
+SAMPLE_SIZE = 16
+SUMMARY_SAMPLE_SIZE = 5
+# Maximum length of the repr of each sampled element
+SAMPLE_REPR_LENGTH = 100
+# Maximum length of the repr of values captured by their repr only
+REPR_LENGTH = 1000
+
+_CONTAINERS = (list, tuple, set, frozenset, dict)
+
+
+class ValueSummary:
+    """Stand-in for a value that was too large to be captured.
+
+    Attributes:
+        type_name: Qualified name of the type of the value
+        reason: Limit of the capture policy exceeded: "max_size", "max_length" or "max_depth",
+            or "repr" for values of a type captured by their repr only
+        length: len() of the value, if it has one
+        shape: Shape of arrays and dataframes
+        dtype: Data type of arrays
+        size: Estimated or serialized size in bytes
+        sample: repr() of the first elements
+        fingerprint: Hash of the fingerprint of the value (see change_detection.py), None if
+            the value can't be fingerprinted. Within a recording, two summaries with different
+            hashes summarize different states.
+    """
+
+    def __init__(self, type_name: str, reason: str, length: int | None = None, shape: tuple | None = None,
+                 dtype: str | None = None, size: int | None = None, sample: list[str] | None = None,
+                 fingerprint: int | None = None):
+        self.type_name = type_name
+        self.reason = reason
+        self.length = length
+        self.shape = shape
+        self.dtype = dtype
+        self.size = size
+        self.sample = sample or []
+        self.fingerprint = fingerprint
+
+    def __repr__(self) -> str:
+        details = [f"{name}={value}" for name, value in (
+            ("len", self.length), ("shape", self.shape), ("dtype", self.dtype), ("size", self.size)
+        ) if value is not None]
+        return f"<{self.type_name} summary ({self.reason}){' ' + ', '.join(details) if details else ''}>"
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, ValueSummary) and vars(self) == vars(other)
+
+    def __hash__(self) -> int:
+        return hash((self.type_name, self.reason, self.length, self.fingerprint))
+
+
+def repr_summary(value: Any) -> ValueSummary:
+    """Build the summary of a value captured by its repr only (see type_strategies.py)"""
+    value_type = type(value)
+    try:
+        sample = [repr(value)[:REPR_LENGTH]]
+    except Exception as e:  # __repr__ of an arbitrary type
+        logger.debug(f"Could not get the repr of {value_type.__name__}: {e}", exc_info=True)
+        sample = [f"<repr failed: {type(e).__name__}>"]
+    return ValueSummary(
+        type_name=f"{value_type.__module__}.{value_type.__qualname__}",
+        reason="repr",
+        length=_length(value),
+        sample=sample,
+    )
+
+
+def _length(value: Any) -> int | None:
+    if isinstance(value, (*_CONTAINERS, str, bytes, bytearray)):
+        return len(value)
+    try:
+        return len(value) if hasattr(type(value), "__len__") else None
+    except (TypeError, ValueError, OverflowError):
+        return None  # e.g. 0-d arrays, or a __len__ returning a negative or huge value
+
+
+def _elements(value: Any) -> list:
+    """Sample of the elements of a container or the attributes of an object"""
+    if isinstance(value, Mapping):
+        return [*islice(value.keys(), SAMPLE_SIZE), *islice(value.values(), SAMPLE_SIZE)]
+    if isinstance(value, _CONTAINERS):
+        return list(islice(value, SAMPLE_SIZE))
+    attributes = getattr(value, "__dict__", None)
+    if isinstance(attributes, dict) and not isinstance(value, type):
+        return list(islice(attributes.values(), SAMPLE_SIZE))
+    return []
+
+
+def estimate_size(value: Any, depth: int = 0) -> int:
+    """Estimate the serialized size of a value from a sample of its elements"""
+    if isinstance(value, str | bytes | bytearray):
+        return len(value)
+    if value is None or isinstance(value, int | float):
+        return 9  # At most an opcode and 8 bytes, except for big integers
+    try:
+        # NumPy arrays, pandas Series and Index
+        nbytes = getattr(value, "nbytes", None)
+        if isinstance(nbytes, int):
+            return nbytes
+        # pandas DataFrame, other types may have an unrelated memory_usage()
+        memory_usage = getattr(value, "memory_usage", None)
+        if type(value).__module__.startswith("pandas") and callable(memory_usage):
+            usage = memory_usage(deep=False)
+            return int(usage.sum() if hasattr(usage, "sum") else usage)
+    except Exception as e:  # Properties of arbitrary types
+        logger.debug(f"Could not get the size of {type(value).__name__}: {e}", exc_info=True)
+
+    size = sys.getsizeof(value, 64)
+    if depth >= 3:
+        return size
+    elements = _elements(value)
+    if not elements:
+        return size
+    # Extrapolate the size of the sampled elements to all of them
+    if isinstance(value, Mapping):
+        count = 2 * len(value)
+    elif isinstance(value, _CONTAINERS):
+        count = len(value)
+    else:
+        count = len(value.__dict__)
+    return size + sum(estimate_size(element, depth + 1) for element in elements) * count // len(elements)
+
+
+def depth_exceeds(value: Any, max_depth: int, depth: int = 0) -> bool:
+    """Return True if containers are nested more than max_depth levels, looking at a sample of elements"""
+    if not isinstance(value, _CONTAINERS) and not hasattr(value, "__dict__"):
+        return False
+    if depth >= max_depth:
+        return True
+    return any(depth_exceeds(element, max_depth, depth + 1) for element in _elements(value))
+
+
+class CapturePolicy:
+    """Limits above which values are summarized instead of captured.
+
+    Args:
+        max_size: Maximum serialized size in bytes
+        max_length: Maximum number of elements of a container (or characters of a string)
+        max_depth: Maximum nesting depth of containers and objects
+
+    Raises:
+        ValueError: If one of the values is not a positive integer
+    """
+
+    FIELDS = ("max_size", "max_length", "max_depth")
+
+    def __init__(self, max_size: int | None = None, max_length: int | None = None, max_depth: int | None = None):
+        for name, value in zip(self.FIELDS, (max_size, max_length, max_depth), strict=True):
+            if value is not None and (not isinstance(value, int) or value < 1):
+                raise ValueError(f"{name} must be a positive integer, got {value!r}")
+        self.max_size = max_size
+        self.max_length = max_length
+        self.max_depth = max_depth
+
+    def is_active(self) -> bool:
+        """Return True if the policy has a limit"""
+        return any(getattr(self, name) is not None for name in self.FIELDS)
+
+    def merged(self, defaults: 'CapturePolicy | None') -> 'CapturePolicy':
+        """Return this policy with its unset values taken from defaults"""
+        if defaults is None:
+            return self
+        return CapturePolicy(*(
+            getattr(self, name) if getattr(self, name) is not None else getattr(defaults, name)
+            for name in self.FIELDS
+        ))
+
+    def check(self, value: Any) -> str | None:
+        """Check a value before pickling it.
+
+        Returns:
+            The exceeded limit ("max_length", "max_size" or "max_depth"), None if the value can be captured
+        """
+        if self.max_length is not None:
+            length = _length(value)
+            if length is not None and length > self.max_length:
+                return "max_length"
+        if self.max_size is not None and estimate_size(value) > self.max_size:
+            return "max_size"
+        if self.max_depth is not None and depth_exceeds(value, self.max_depth):
+            return "max_depth"
+        return None
+
+    def check_size(self, size: int) -> str | None:
+        """Check the serialized size of a value, see check()"""
+        return "max_size" if self.max_size is not None and size > self.max_size else None
+
+    def summarize(self, value: Any, reason: str, size: int | None = None) -> ValueSummary:
+        """Build the summary stored instead of a value"""
+        value_type = type(value)
+        shape = getattr(value, "shape", None)
+        dtype = getattr(value, "dtype", None)
+        if isinstance(value, str | bytes | bytearray):
+            sample = [repr(value[:SAMPLE_REPR_LENGTH])]
+        elif not isinstance(value, Mapping | Sequence | AbstractSet):
+            sample = []  # Iterating over other values (e.g. iterators) could change the state of the program
+        else:
+            try:
+                items = value.items() if isinstance(value, Mapping) else value
+                sample = [repr(element)[:SAMPLE_REPR_LENGTH] for element in islice(items, SUMMARY_SAMPLE_SIZE)]
+            except Exception as e:  # Iteration and repr of arbitrary types
+                logger.debug(f"Could not sample {value_type.__name__}: {e}", exc_info=True)
+                sample = []
+        try:
+            key = fingerprint(value)
+            value_fingerprint = hash(key) if key is not None else None
+        except Exception as e:  # Attributes and elements of arbitrary types
+            logger.debug(f"Could not fingerprint {value_type.__name__}: {e}", exc_info=True)
+            value_fingerprint = None
+        return ValueSummary(
+            type_name=f"{value_type.__module__}.{value_type.__qualname__}",
+            reason=reason,
+            length=_length(value),
+            shape=tuple(shape) if isinstance(shape, tuple) else None,
+            dtype=str(dtype) if dtype is not None else None,
+            size=size if size is not None else estimate_size(value),
+            sample=sample,
+            fingerprint=value_fingerprint,
+        )
+
+    def __repr__(self) -> str:
+        values = ", ".join(f"{name}={getattr(self, name)}" for name in self.FIELDS if getattr(self, name) is not None)
+        return f"CapturePolicy({values})"
@@ -0,0 +1,173 @@
+"""
+Change detection for captured objects.
+
+Capturing a value pickles and hashes it, even when it has not changed since
+the last time it was captured. The ChangeDetector remembers a cheap
+fingerprint of the last captured state of each live object and reuses the
+previous capture while the fingerprint stays the same.
+
+Fingerprints look at the length of containers, at a sample of their elements
+(evenly spaced for sequences, the first and last inserted items for dicts)
+and at the attributes of custom objects, a few levels deep. A class can define
+`__spacetime_version__(self)` to return a value that changes whenever its
+state does, its instances are then fingerprinted by that value only.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Hashable
+from itertools import islice
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:  # representation imports the capture policy, which uses fingerprint()
+    from .representation import Object
+
+logger = logging.getLogger(__name__)
+
+_PRIMITIVES = (int, float, bool, str, bytes, type(None))
+_SEQUENCES = (list, tuple)
+
+# Containers with more elements than this are fingerprinted on a sample of them
+SAMPLE_SIZE = 16
+# Maximum depth and number of containers visited for one fingerprint
+MAX_DEPTH = 3
+MAX_NODES = 64
+
+
+def _sample_indices(length: int) -> range | list[int]:
+    """Indices of the elements of a sequence used in its fingerprint"""
+    if length <= SAMPLE_SIZE:
+        return range(length)
+    step = length / (SAMPLE_SIZE - 1)
+    return [int(i * step) for i in range(SAMPLE_SIZE - 1)] + [length - 1]
+
+
+class _Fingerprinter:
+    """Compute the fingerprint of one value, visiting at most MAX_NODES containers"""
+
+    def __init__(self):
+        self.nodes = 0
+
+    def key(self, value: Any, depth: int = 0) -> Hashable:
+        value_type = type(value)
+        if value_type in _PRIMITIVES:
+            return (value_type, value)
+
+        version = getattr(value_type, "__spacetime_version__", None)
+        if version is not None:
+            return (value_type, id(value), version(value))
+
+        # Too deep or too many containers visited: only the identity of the value is used
+        if depth >= MAX_DEPTH or self.nodes >= MAX_NODES:
+            return (value_type, id(value))
+        self.nodes += 1
+
+        if isinstance(value, _SEQUENCES):
+            return (value_type, len(value), tuple(self.key(value[i], depth + 1) for i in _sample_indices(len(value))))
+        if isinstance(value, dict):
+            return (value_type, len(value), self.items_key(value, depth))
+
+        attributes = getattr(value, "__dict__", None)
+        if isinstance(attributes, dict) and not isinstance(value, type):
+            return (value_type, len(attributes), self.items_key(attributes, depth))
+        return (value_type, id(value))
+
+    def items_key(self, mapping: dict, depth: int) -> tuple:
+        """Key of the items of a dict, sampled if it's large"""
+        if len(mapping) <= SAMPLE_SIZE:
+            items = mapping.items()
+        else:
+            # Dicts have no random access, sample the first and last inserted items
+            half = SAMPLE_SIZE // 2
+            items = [*islice(mapping.items(), half), *islice(reversed(mapping.items()), half)]
+        return tuple((name, self.key(item, depth + 1)) for name, item in items)
+
+
+def fingerprint(value: Any) -> Hashable | None:
+    """Compute a cheap fingerprint of the state of a value.
+
+    Returns:
+        The fingerprint, or None if the type of the value isn't supported
+        (its state must then be compared by pickling it)
+    """
+    if isinstance(value, BaseException):
+        return None  # Remembering an exception would keep its traceback and all its frames alive
+    key = _Fingerprinter().key(value)
+    if len(key) == 2 and key[1] == id(value):
+        return None  # Only the identity, nothing tells if the state changed
+    return key
+
+
+class ChangeDetector:
+    """Reuse the previous capture of a live object while its fingerprint is unchanged.
+
+    Fingerprints only look at a sample of large containers, and at MAX_DEPTH
+    levels of nesting, so a change in an element outside of the sample or
+    deeper is only seen at the next full capture, done every `recheck_every`
+    captures of an object. In between, the object is recorded unchanged.
+
+    The detector doesn't keep the objects alive: the last `max_entries` ones
+    are remembered by id along with their identity token (see identity.py),
+    so another object reusing the id of a collected one isn't mistaken for it.
+
+    Args:
+        max_entries: Maximum number of objects remembered
+        recheck_every: Capture an object fully every N captures even if its fingerprint is unchanged
+    """
+
+    def __init__(self, max_entries: int = 10_000, recheck_every: int = 100):
+        self.max_entries = max_entries
+        self.recheck_every = recheck_every
+        # id(value) -> (identity token, fingerprint, captured object, captures since the last full capture)
+        self._entries: OrderedDict[int, tuple[str, Hashable, Object, int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, value: Any, identity: str) -> tuple['Object | None', Hashable | None]:
+        """Find the previous capture of a value if its state didn't change.
+
+        Args:
+            value: The live object
+            identity: Its identity token
+
+        Returns:
+            The previous capture (None if the value must be captured again) and
+            the current fingerprint to pass to remember()
+        """
+        try:
+            key = fingerprint(value)
+        except Exception as e:
+            logger.debug(f"Could not fingerprint {type(value).__name__}: {e}")
+            key = None
+        if key is None:
+            return None, None
+
+        # Fingerprints are computed outside of the lock, threads capture in parallel
+        with self._lock:
+            entry = self._entries.get(id(value))
+            if entry is not None and entry[0] == identity and entry[1] == key and entry[3] < self.recheck_every:
+                self._entries[id(value)] = (identity, key, entry[2], entry[3] + 1)
+                self._entries.move_to_end(id(value))
+                self.hits += 1
+                return entry[2], key
+            self.misses += 1
+        return None, key
+
+    def remember(self, value: Any, identity: str, key: Hashable, captured: 'Object'):
+        """Remember the capture of a value, with its identity token and fingerprint"""
+        with self._lock:
+            self._entries[id(value)] = (identity, key, captured, 0)
+            self._entries.move_to_end(id(value))
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Forget all the remembered captures"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Number of captures reused and redone"""
+        return {"reused": self.hits, "captured": self.misses}
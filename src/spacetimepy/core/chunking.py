@@ -0,0 +1,79 @@
+"""
+Content-defined chunking of large pickled states.
+
+Large states are split into chunks stored once by digest, a new version that
+only changes a few elements shares most of its chunks with the previous one.
+Chunk boundaries depend on the content around them (gear rolling hash over a
+32 byte window), so an insertion only changes the chunks around it instead of
+shifting all the following ones. The data of arrays is changed in place, not
+shifted, it is split in fixed size chunks which is much faster.
+
+The gear hash is vectorized with numpy when the monitored program has already
+imported it (like arrays.py, spacetimepy doesn't import numpy), and computed
+byte by byte otherwise. Both give the same boundaries.
+"""
+
+import random
+import sys
+
+# States smaller than this are stored inline
+CHUNK_THRESHOLD = 32 * 1024
+# Chunk sizes, the average is set by the number of bits of the boundary mask
+MIN_CHUNK_SIZE = 1024
+MAX_CHUNK_SIZE = 64 * 1024
+FIXED_CHUNK_SIZE = 16 * 1024
+_MASK = ((1 << 12) - 1) << 20  # 12 high bits, ~4 KiB average
+
+# Random value of each byte for the gear hash, fixed so boundaries are the same across runs
+_GEAR = tuple(random.Random(0x5EED).choices(range(2**32), k=256))
+
+
+def _candidate_boundaries(data: bytes) -> list[int]:
+    """Positions after which the gear hash of the last 32 bytes matches the boundary mask"""
+    np = sys.modules.get("numpy")
+    if np is None:
+        return _candidate_boundaries_python(data)
+    gear_hash = np.array(_GEAR, dtype=np.uint32)[np.frombuffer(data, dtype=np.uint8)]
+    # hash[i] = sum(gear[i - k] << k for k < 32), computed by doubling the window
+    width = 1
+    while width < 32:
+        shifted = np.zeros_like(gear_hash)
+        shifted[width:] = gear_hash[:-width] << np.uint32(width)
+        gear_hash += shifted
+        width *= 2
+    return (np.flatnonzero((gear_hash & np.uint32(_MASK)) == 0) + 1).tolist()
+
+
+def _candidate_boundaries_python(data: bytes) -> list[int]:
+    """Same as _candidate_boundaries without numpy, the bytes older than 32 are shifted out of the hash"""
+    boundaries = []
+    gear, mask = _GEAR, _MASK
+    gear_hash = 0
+    for position, byte in enumerate(data, 1):
+        gear_hash = ((gear_hash << 1) + gear[byte]) & 0xFFFFFFFF
+        if not gear_hash & mask:
+            boundaries.append(position)
+    return boundaries
+
+
+def split_chunks(data: bytes) -> list[bytes]:
+    """Split data into content-defined chunks of MIN_CHUNK_SIZE to MAX_CHUNK_SIZE bytes"""
+    chunks = []
+    start = 0
+    for boundary in _candidate_boundaries(data):
+        # Cut at MAX_CHUNK_SIZE while no boundary is found
+        while boundary - start > MAX_CHUNK_SIZE:
+            chunks.append(data[start:start + MAX_CHUNK_SIZE])
+            start += MAX_CHUNK_SIZE
+        if boundary - start >= MIN_CHUNK_SIZE:
+            chunks.append(data[start:boundary])
+            start = boundary
+    while start < len(data):
+        chunks.append(data[start:start + MAX_CHUNK_SIZE])
+        start += MAX_CHUNK_SIZE
+    return chunks
+
+
+def split_fixed(data: bytes, size: int = FIXED_CHUNK_SIZE) -> list[bytes]:
+    """Split data into chunks of the same size, for data changed in place (e.g. arrays)"""
+    return [data[start:start + size] for start in range(0, len(data), size)]
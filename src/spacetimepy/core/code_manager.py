@@ -129,18 +129,26 @@ class CodeManager:
 
         return code_hash
 
-    def link_object(self, object_ref: str, code_ref: str) -> None:
-        """Link an object to its code definition."""
-        # Check if link already exists
-        existing_link = self.session.query(CodeObjectLink).filter(
-            CodeObjectLink.object_id == object_ref,
-            CodeObjectLink.definition_id == code_ref
-        ).first()
-
-        if existing_link:
-            return
+    def link_object(self, object_ref: str, code_ref: str, check_existing: bool = True) -> None:
+        """Link an object to its code definition.
 
-        # Create new link
+        Args:
+            object_ref: Reference of the stored object
+            code_ref: Reference of the code definition
+            check_existing: Look for an existing link first, not needed for a new object
+        """
+        # Check if link already exists, without flushing the rows being buffered
+        if check_existing:
+            with self.session.no_autoflush:
+                existing_link = self.session.query(CodeObjectLink).filter(
+                    CodeObjectLink.object_id == object_ref,
+                    CodeObjectLink.definition_id == code_ref
+                ).first()
+
+            if existing_link:
+                return
+
+        # Create new link, nothing references it so it is written with the next flush
         link = CodeObjectLink(
             object_id=object_ref,
             definition_id=code_ref
@@ -148,12 +156,6 @@ class CodeManager:
 
         self.session.add(link)
 
-        try:
-            self.session.flush()
-        except SQLAlchemyError as e:
-            logger.warning(f"Error creating code link: {e}")
-            self.session.rollback()
-
     def get_code(self, code_ref: str) -> dict[str, Any] | None:
         """Get a code definition by its reference."""
         code_def = self.session.query(CodeDefinition).filter(
@@ -0,0 +1,228 @@
+"""
+Compression of stored pickled states.
+
+Compressed payloads start with a codec byte, pickled data never does
+(pickles start with the PROTO opcode 0x80), so uncompressed payloads are
+stored as is and databases written before compression are still readable.
+Chunks of large states can start with any byte, their row records whether
+they are compressed.
+
+With trained dictionaries, the first states stored of each type are used as
+a zlib preset dictionary for the next ones: instances of the same class
+share most of their pickled bytes (class path, attribute names), which zlib
+can't find in a single small state. The zlib stream records the Adler-32 of
+its dictionary, which is also the ID of the dictionary in the database.
+"""
+
+import logging
+import lzma
+import zlib
+from collections.abc import Callable
+
+from sqlalchemy.orm import Session
+
+from .models import CompressionDictionary, ObjectChunk, StoredObject
+
+logger = logging.getLogger(__name__)
+
+# Codec byte at the start of compressed payloads
+_ZLIB = 1
+_LZMA = 2
+_ZLIB_DICTIONARY = 3
+
+CODECS = ("none", "zlib", "lzma")
+
+# States smaller than this are stored uncompressed
+COMPRESSION_THRESHOLD = 128
+# Dictionaries: number of states of a type used to train one, bytes kept of each and maximum size
+DICTIONARY_SAMPLES = 32
+DICTIONARY_SAMPLE_SIZE = 4 * 1024
+DICTIONARY_SIZE = 32 * 1024  # zlib only looks back 32 KiB
+# Types with a dictionary
+MAX_DICTIONARIES = 1000
+
+DictionaryLookup = Callable[[int], bytes | None]
+
+
+def train_dictionary(samples: list[bytes], size: int = DICTIONARY_SIZE) -> bytes:
+    """Build a zlib preset dictionary from sample payloads.
+
+    zlib finds the closest matches at the end of the dictionary, the last
+    samples are kept first when they don't all fit.
+    """
+    return b"".join(samples)[-size:]
+
+
+def dictionary_id(data: bytes | None) -> int | None:
+    """Get the ID of the dictionary a payload is compressed with, None if it has none"""
+    if not data or data[0] != _ZLIB_DICTIONARY:
+        return None
+    # The zlib header is followed by the Adler-32 of the dictionary
+    return int.from_bytes(data[3:7], "big")
+
+
+def is_compressed(data: bytes | None) -> bool:
+    """Return True if a payload is compressed"""
+    return bool(data) and data[0] in (_ZLIB, _LZMA, _ZLIB_DICTIONARY) # type: ignore
+
+
+def decompress(data: bytes, dictionaries: DictionaryLookup | None = None) -> bytes:
+    """Decompress a payload, payloads that aren't compressed are returned as is.
+
+    Args:
+        data: Stored payload
+        dictionaries: Get a trained dictionary by ID, needed for payloads compressed with one
+
+    Raises:
+        ValueError: If the dictionary of the payload is unknown
+    """
+    if not data:
+        return data
+    codec = data[0]
+    if codec == _ZLIB:
+        return zlib.decompress(data[1:])
+    if codec == _LZMA:
+        return lzma.decompress(data[1:])
+    if codec == _ZLIB_DICTIONARY:
+        dict_id = dictionary_id(data)
+        dictionary = dictionaries(dict_id) if dictionaries is not None else None # type: ignore
+        if dictionary is None:
+            raise ValueError(f"Compression dictionary {dict_id} not found")
+        decompressor = zlib.decompressobj(zdict=dictionary)
+        return decompressor.decompress(data[1:]) + decompressor.flush()
+    return data
+
+
+class Compressor:
+    """Compress payloads before they are stored.
+
+    Payloads smaller than `min_size`, or that don't get smaller, are kept
+    uncompressed. With `dictionaries`, a zlib dictionary is trained for each
+    type from its first DICTIONARY_SAMPLES states; the dictionaries trained
+    since the last call to take_new_dictionaries() must be stored along with
+    the payloads using them.
+
+    Args:
+        codec: "none", "zlib" or "lzma"
+        level: Compression level (zlib) or preset (lzma), None for the codec default
+        min_size: Size under which payloads aren't compressed
+        dictionaries: Train a zlib dictionary per type
+
+    Raises:
+        ValueError: If the codec is unknown, or dictionaries are used with another codec than zlib
+    """
+
+    def __init__(self, codec: str = "zlib", level: int | None = None,
+                 min_size: int = COMPRESSION_THRESHOLD, dictionaries: bool = False):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown compression codec {codec!r}, available codecs: {', '.join(CODECS)}")
+        if dictionaries and codec != "zlib":
+            raise ValueError("Trained dictionaries are only supported with the zlib codec")
+        self.codec = codec
+        self.level = level
+        self.min_size = min_size
+        self.dictionaries = dictionaries
+        self._trained: dict[str, tuple[int, bytes]] = {}  # type name -> (dictionary ID, dictionary)
+        self._samples: dict[str, list[bytes]] = {}
+        self._new_dictionaries: list[tuple[int, str, bytes]] = []
+
+    def compress(self, data: bytes, type_name: str | None = None) -> bytes:
+        """Compress a payload, type_name selects its dictionary"""
+        if self.codec == "none" or len(data) < self.min_size:
+            return data
+        dictionary = self._dictionary(type_name, data) if self.dictionaries and type_name else None
+
+        if dictionary is not None:
+            compressor = zlib.compressobj(-1 if self.level is None else self.level, zdict=dictionary)
+            compressed = bytes([_ZLIB_DICTIONARY]) + compressor.compress(data) + compressor.flush()
+        elif self.codec == "zlib":
+            compressed = bytes([_ZLIB]) + zlib.compress(data, -1 if self.level is None else self.level)
+        else:
+            compressed = bytes([_LZMA]) + lzma.compress(data, preset=self.level)
+        return compressed if len(compressed) < len(data) else data
+
+    def add_dictionary(self, type_name: str, dict_id: int, dictionary: bytes):
+        """Use an already stored dictionary for a type"""
+        self._trained[type_name] = (dict_id, dictionary)
+        self._samples.pop(type_name, None)
+
+    def take_new_dictionaries(self) -> list[tuple[int, str, bytes]]:
+        """Get the (ID, type name, dictionary) trained since the last call"""
+        new_dictionaries, self._new_dictionaries = self._new_dictionaries, []
+        return new_dictionaries
+
+    def clear_dictionaries(self):
+        """Forget the dictionaries and samples, e.g. after a rollback"""
+        self._trained.clear()
+        self._samples.clear()
+        self._new_dictionaries.clear()
+
+    def _dictionary(self, type_name: str, data: bytes) -> bytes | None:
+        trained = self._trained.get(type_name)
+        if trained is not None:
+            return trained[1]
+        if len(self._trained) >= MAX_DICTIONARIES:
+            return None
+        samples = self._samples.setdefault(type_name, [])
+        samples.append(data[:DICTIONARY_SAMPLE_SIZE])
+        if len(samples) < DICTIONARY_SAMPLES:
+            return None
+
+        dictionary = train_dictionary(samples)
+        del self._samples[type_name]
+        dict_id = zlib.adler32(dictionary)
+        if any(trained_id == dict_id for trained_id, _ in self._trained.values()):
+            return None  # Same ID as another dictionary, payloads couldn't tell them apart
+        self._trained[type_name] = (dict_id, dictionary)
+        self._new_dictionaries.append((dict_id, type_name, dictionary))
+        return dictionary
+
+
+def recompress(session: Session, compressor: Compressor, batch_size: int = 1000) -> tuple[int, int]:
+    """Recompress all the stored states and chunks of a database with another compressor.
+
+    Dictionaries no longer used by any payload are deleted.
+
+    Returns:
+        The total size of the payloads before and after
+    """
+    dictionaries = {row.id: row.data for row in session.query(CompressionDictionary)}
+    used_dictionaries: set[int] = set()
+    size_before = size_after = 0
+
+    def recompress_payload(stored: bytes, data: bytes, type_name: str | None) -> bytes:
+        """Compress the decompressed data of a stored payload again"""
+        nonlocal size_before, size_after
+        new_data = compressor.compress(data, type_name)
+        for dict_id, dict_type_name, dictionary in compressor.take_new_dictionaries():
+            dictionaries[dict_id] = dictionary
+            session.merge(CompressionDictionary(id=dict_id, type_name=dict_type_name, data=dictionary))
+        dict_id = dictionary_id(new_data)
+        if dict_id is not None:
+            used_dictionaries.add(dict_id)
+        size_before += len(stored)
+        size_after += len(new_data)
+        return new_data
+
+    # Rows are updated by batches of IDs, not while iterating over a query
+    object_ids = [object_id for (object_id,) in session.query(StoredObject.id).filter(StoredObject.pickle_data.is_not(None))]
+    for start in range(0, len(object_ids), batch_size):
+        for stored_obj in session.query(StoredObject).filter(StoredObject.id.in_(object_ids[start:start + batch_size])):
+            data = decompress(stored_obj.pickle_data, dictionaries.get) # type: ignore
+            stored_obj.pickle_data = recompress_payload(stored_obj.pickle_data, data, stored_obj.type_name) # type: ignore
+        session.commit()
+
+    chunk_ids = [chunk_id for (chunk_id,) in session.query(ObjectChunk.id)]
+    for start in range(0, len(chunk_ids), batch_size):
+        for chunk in session.query(ObjectChunk).filter(ObjectChunk.id.in_(chunk_ids[start:start + batch_size])):
+            data = decompress(chunk.data, dictionaries.get) if chunk.compressed else chunk.data
+            new_data = recompress_payload(chunk.data, data, None)
+            chunk.compressed = new_data is not data
+            chunk.data = new_data
+        session.commit()
+
+    unused = session.query(CompressionDictionary).filter(CompressionDictionary.id.not_in(used_dictionaries))
+    removed = unused.delete(synchronize_session=False)
+    session.commit()
+    logger.info(f"Recompressed {size_before} bytes into {size_after} bytes, {removed} unused dictionaries removed")
+    return size_before, size_after
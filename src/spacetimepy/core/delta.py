@@ -0,0 +1,118 @@
+"""
+Structural delta encoding between versions of an object.
+
+A new state of a list, dict or plain object (whose pickled state is its
+`__dict__`) can be stored as a patch against the previous state of the same
+identity: the indices, keys or attributes that changed, were added or were
+removed. An element is left out of the patch if it is the same object, a
+primitive (int, bool, str, bytes, float compared bit for bit, or a tuple of
+them) with the same value, or if it pickles to the same bytes. `__eq__` is
+never used, it doesn't tell if the state of an element is the same (e.g.
+fields excluded from the comparison of a dataclass).
+"""
+
+import pickle
+import struct
+from typing import Any
+
+# Classes defined in Python, the state of their instances is their __dict__
+_HEAPTYPE = 1 << 9
+_PRIMITIVES = (int, bool, str, bytes)
+
+
+def supports_delta(value: Any) -> bool:
+    """Return True if the state of a value can be stored as a patch"""
+    if type(value) in (list, dict):
+        return True
+    cls = type(value)
+    # Subclasses of builtin types (list, dict...) also keep their state outside of __dict__
+    return (isinstance(getattr(value, "__dict__", None), dict)
+            and all(base is object or base.__flags__ & _HEAPTYPE for base in cls.__mro__)
+            and cls.__reduce_ex__ is object.__reduce_ex__
+            and cls.__reduce__ is object.__reduce__
+            and cls.__getstate__ is object.__getstate__
+            and not hasattr(cls, "__setstate__")
+            and not hasattr(cls, "__slots__"))
+
+
+def _same(a: Any, b: Any) -> bool:
+    if a is b:
+        return True
+    value_type = type(a)
+    if value_type is not type(b):
+        return False
+    if value_type in _PRIMITIVES:
+        return a == b
+    if value_type is float:
+        return struct.pack("<d", a) == struct.pack("<d", b)  # -0.0 isn't 0.0
+    if value_type is tuple:
+        return len(a) == len(b) and all(_same(x, y) for x, y in zip(a, b, strict=True))
+    try:
+        return pickle.dumps(a, pickle.HIGHEST_PROTOCOL) == pickle.dumps(b, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return False  # Only picklable with the reducers of the recording, part of the patch
+
+
+def _mapping_patch(base: dict, new: dict) -> dict[str, Any]:
+    patch: dict[str, Any] = {
+        "set": {key: value for key, value in new.items() if key not in base or not _same(base[key], value)},
+        "removed": [key for key in base if key not in new],
+    }
+    # Keep the order of the keys if applying the patch wouldn't give the same one
+    removed = set(patch["removed"])
+    expected_order = [key for key in base if key not in removed] + [key for key in patch["set"] if key not in base]
+    if expected_order != list(new):
+        patch["order"] = list(new)
+    return patch
+
+
+def _apply_mapping_patch(base: dict, patch: dict[str, Any]) -> dict:
+    result = dict(base)
+    for key in patch["removed"]:
+        del result[key]
+    result.update(patch["set"])
+    if "order" in patch:
+        result = {key: result[key] for key in patch["order"]}
+    return result
+
+
+def make_patch(base: Any, new: Any) -> dict[str, Any] | None:
+    """Compute the patch turning base into new.
+
+    Returns:
+        The patch, None if the values can't be patched (different types)
+    """
+    if type(base) is not type(new):
+        return None
+    if type(new) is list:
+        common = min(len(base), len(new))
+        changed = {i: new[i] for i in range(common) if not _same(base[i], new[i])}
+        changed.update((i, new[i]) for i in range(common, len(new)))
+        return {"kind": "list", "length": len(new), "set": changed}
+    if type(new) is dict:
+        return {"kind": "dict", **_mapping_patch(base, new)}
+    if supports_delta(new):
+        return {"kind": "attributes", **_mapping_patch(base.__dict__, new.__dict__)}
+    return None
+
+
+def apply_patch(base: Any, patch: dict[str, Any]) -> Any:
+    """Apply a patch to a copy of base (modified in place if it's a plain object).
+
+    Base must be a fresh value (e.g. just unpickled), its elements are reused.
+    """
+    kind = patch["kind"]
+    if kind == "list":
+        length = patch["length"]
+        result = base[:length] + [None] * (length - len(base))
+        for i, value in patch["set"].items():
+            result[i] = value
+        return result
+    if kind == "dict":
+        return _apply_mapping_patch(base, patch)
+    if kind == "attributes":
+        attributes = _apply_mapping_patch(base.__dict__, patch)
+        base.__dict__.clear()
+        base.__dict__.update(attributes)
+        return base
+    raise ValueError(f"Unknown patch kind {kind!r}")
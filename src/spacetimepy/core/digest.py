@@ -0,0 +1,55 @@
+"""
+Digests used to compute the reference of stored objects.
+
+The digest of a database is chosen when the database is created and recorded
+in its `database_info` table, so objects keep the same reference for the whole
+life of the database. Databases created before the digest was recorded use md5.
+"""
+
+import hashlib
+from collections.abc import Callable
+
+try:
+    import xxhash
+except ImportError:  # Optional, much faster non-cryptographic hash
+    xxhash = None
+
+Digest = Callable[[bytes], str]
+
+
+def _md5(data: bytes) -> str:
+    return hashlib.md5(data).hexdigest()
+
+
+def _blake2b(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+DIGESTS: dict[str, Digest] = {
+    "md5": _md5,
+    "blake2b": _blake2b,
+    "sha256": _sha256,
+}
+if xxhash is not None:
+    DIGESTS["xxh3_128"] = lambda data: xxhash.xxh3_128_hexdigest(data)
+
+# Digest of the databases created before it was recorded
+LEGACY_DIGEST = "md5"
+# Digest of new databases
+DEFAULT_DIGEST = "xxh3_128" if xxhash is not None else "blake2b"
+
+
+def get_digest(name: str) -> Digest:
+    """Get a digest function by name
+
+    Raises:
+        ValueError: If the digest is unknown (e.g. xxh3_128 without the xxhash package)
+    """
+    try:
+        return DIGESTS[name]
+    except KeyError:
+        raise ValueError(f"Unknown digest {name!r}, available digests: {', '.join(DIGESTS)}") from None
@@ -0,0 +1,179 @@
+"""
+Line snapshots captured in forked child processes.
+
+Capturing a frame holding very large values pauses the program for as long
+as pickling them takes. In fork mode (pymonitor(fork=True), on platforms with
+os.fork), the monitor forks at each recorded line instead: the child captures
+the variables from its copy-on-write view of the memory, writes the captured
+objects to a spool file and exits, while the parent continues right away.
+
+The snapshot row is created immediately with no variables. Its variables are
+stored when the child is merged back: on the next forked snapshots, at flush
+and at the end of the session. The child never touches the database, the spool
+holds the pickled state, reference and identity of each captured object, and
+the parent stores them through the usual ObjectManager path (versions,
+patches, chunks and compression).
+"""
+
+import contextlib
+import itertools
+import logging
+import os
+import pickle
+import sys
+import tempfile
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import Any
+
+from .digest import Digest
+from .representation import Object, ObjectType, PickleConfig
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of children capturing at the same time
+MAX_CHILDREN = 2
+
+
+def spool_record(obj: Object | str) -> tuple | str:
+    """Turn a captured object into a picklable record, placeholders are kept as is"""
+    if isinstance(obj, str):
+        return obj
+    value_type = obj.value_type
+    # Captured objects only keep the value of primitives (arrays captured without a copy keep the live array)
+    value = obj.value if obj.type == ObjectType.PRIMITIVE else None
+    return (obj.type.value, value_type.__module__, value_type.__qualname__, value, obj.data(), obj.ref(), obj._identity)
+
+
+def _resolve_type(module: str, qualname: str) -> type:
+    """Find a type by name, a stand-in type with the same name if it's gone or local"""
+    value = sys.modules.get(module)
+    for name in qualname.split("."):
+        value = getattr(value, name, None)
+    if isinstance(value, type):
+        return value
+    return type(qualname.rsplit(".", 1)[-1], (), {"__module__": module})
+
+
+class SpooledObject(Object):
+    """Represent a captured object read back from a spool file"""
+    def __init__(self, record: tuple, pickle_config: PickleConfig | None = None, digest: Digest | None = None):
+        obj_type, module, qualname, value, data, ref, identity = record
+        super().__init__(value, pickle_config, digest)
+        self.type = ObjectType(obj_type)
+        self.value_type = _resolve_type(module, qualname)
+        self._data = data
+        self._hash = ref
+        self._identity = identity
+
+
+class ForkCapture:
+    """Run captures in forked children and collect their results in order.
+
+    Args:
+        max_children: Maximum number of children running at the same time, a new
+            capture waits for the oldest one to exit
+        spool_dir: Directory of the spool files, the system temporary directory by default
+    """
+
+    def __init__(self, max_children: int = MAX_CHILDREN, spool_dir: str | None = None):
+        if max_children < 1:
+            raise ValueError(f"max_children must be a positive integer, got {max_children!r}")
+        self.max_children = max_children
+        self.spool_dir = spool_dir or tempfile.gettempdir()
+        self.available = hasattr(os, "fork")
+        self.forking = False  # Set while forking, the fork hooks leave capture children alone
+        self._keys = itertools.count(1)
+        # key -> (pid, spool path, exit status once reaped)
+        self._children: OrderedDict[int, tuple[int, str, int | None]] = OrderedDict()
+
+    @property
+    def running(self) -> int:
+        """Number of children not reaped yet"""
+        return sum(1 for _, _, status in self._children.values() if status is None)
+
+    def spawn(self, capture: Callable[[], Any]) -> int:
+        """Fork a child running capture() and spooling its result.
+
+        The result must be made of captured objects and placeholders (dicts and
+        tuples of them), they are turned into records with spool_record().
+
+        Returns:
+            The key of the capture, passed back by collect()
+        """
+        while self.running >= self.max_children:
+            self._wait_oldest()
+
+        key = next(self._keys)
+        path = os.path.join(self.spool_dir, f"spacetimepy-{os.getpid()}-{key}.spool")
+        self.forking = True
+        try:
+            pid = os.fork()
+        finally:
+            self.forking = False
+        if pid == 0:
+            code = 1
+            try:
+                data = pickle.dumps(self._records(capture()), protocol=pickle.HIGHEST_PROTOCOL)
+                # Written under a temporary name, the parent only sees complete spools
+                with open(f"{path}.tmp", "wb") as f:
+                    f.write(data)
+                os.replace(f"{path}.tmp", path)
+                code = 0
+            except BaseException:  # Nothing may unwind into the code of the parent
+                logger.exception("Forked capture failed")
+            finally:
+                os._exit(code)
+        self._children[key] = (pid, path, None)
+        return key
+
+    def collect(self, block: bool = False) -> list[tuple[int, Any]]:
+        """Get the results of the finished children, in the order they were spawned.
+
+        Args:
+            block: Wait for all the children, otherwise stop at the first one still running
+
+        Returns:
+            (key, result) pairs, the result is None if the child failed
+        """
+        results = []
+        while self._children:
+            key, (pid, path, status) = next(iter(self._children.items()))
+            if status is None:
+                done, status = os.waitpid(pid, 0 if block else os.WNOHANG)
+                if done == 0:
+                    break
+            del self._children[key]
+            results.append((key, self._read(path, status)))
+        return results
+
+    def _wait_oldest(self):
+        """Wait for the oldest running child to exit"""
+        for key, (pid, path, status) in self._children.items():
+            if status is None:
+                _, status = os.waitpid(pid, 0)
+                self._children[key] = (pid, path, status)
+                return
+
+    @staticmethod
+    def _records(result: Any) -> Any:
+        if isinstance(result, dict):
+            return {name: spool_record(obj) for name, obj in result.items()}
+        return tuple(ForkCapture._records(part) for part in result)
+
+    @staticmethod
+    def _read(path: str, status: int) -> Any:
+        """Read and delete a spool file, None if the child failed"""
+        try:
+            if os.waitstatus_to_exitcode(status) != 0:
+                logger.warning(f"Forked capture exited with status {status}, its snapshot has no variables")
+                return None
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            logger.warning(f"Could not read the forked capture spool {path}: {e}")
+            return None
+        finally:
+            for stale in (path, f"{path}.tmp"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(stale)
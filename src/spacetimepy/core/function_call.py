@@ -146,6 +146,7 @@ class FunctionCallRepository:
             snapshots = self.session.query(StackSnapshot).filter(
                 StackSnapshot.function_call_id == function_id
             ).order_by(StackSnapshot.order_in_call.asc()).all()
+            StackSnapshot.reconstruct(self.session, snapshots)
 
             # Get code information if available
             code = None
@@ -0,0 +1,120 @@
+"""
+Adaptive overhead governor for the monitor.
+
+The governor measures the time spent in the monitoring callbacks and lowers
+the capture fidelity when it exceeds a share of the wall time, then raises it
+again when there is headroom.
+"""
+
+import datetime  # noqa: ICN001
+import logging
+import types
+from collections import deque
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+# Fidelity levels, from the most to the least detailed
+FULL = 0        # Function calls and line snapshots
+FUNCTION = 1    # Function calls with their arguments and globals, no line snapshots
+ARGS = 2        # Function calls with their arguments only
+SAMPLED = 3     # Only 1 call in sample_every with its arguments
+
+LEVEL_NAMES = ("full", "function", "args", "sampled")
+
+# Most recent fidelity changes kept, the others are only counted
+MAX_TRANSITIONS = 100
+
+
+class OverheadGovernor:
+    """Keep the time spent in the monitoring callbacks under a share of the wall time.
+
+    Every `window` seconds, the governor compares the time spent in the
+    callbacks to the elapsed time. Above `max_overhead` it steps the fidelity
+    down one level, below half of it it steps back up one level.
+
+    Args:
+        max_overhead: Maximum share of the wall time spent in the callbacks (e.g. 0.1 for 10%)
+        window: Length in seconds of the measurement window
+        sample_every: Record 1 call in N of each function at the "sampled" level
+
+    Raises:
+        ValueError: If max_overhead is not between 0 and 1 or window is not positive
+    """
+
+    def __init__(self, max_overhead: float = 0.1, window: float = 1.0, sample_every: int = 10):
+        if not 0 < max_overhead < 1:
+            raise ValueError(f"max_overhead must be between 0 and 1, got {max_overhead}")
+        if window <= 0:
+            raise ValueError(f"window must be positive, got {window}")
+        self.max_overhead = max_overhead
+        self.window = window
+        self.sample_every = sample_every
+
+        self.level = FULL
+        self.transitions: deque[dict] = deque(maxlen=MAX_TRANSITIONS)  # Recent fidelity changes since the last reset
+        self.transition_counts = dict.fromkeys(LEVEL_NAMES, 0)  # Changes to each level since the last reset
+        self._window_start = perf_counter()
+        self._spent = 0.0
+        self._call_counts: dict[types.CodeType, int] = {}
+
+    @property
+    def level_name(self) -> str:
+        return LEVEL_NAMES[self.level]
+
+    def account(self, elapsed: float) -> int | None:
+        """Add time spent in a callback.
+
+        Returns:
+            The new fidelity level if it changed, None otherwise
+        """
+        self._spent += elapsed
+        now = perf_counter()
+        wall_time = now - self._window_start
+        if wall_time < self.window:
+            return None
+
+        overhead = self._spent / wall_time
+        self._window_start = now
+        self._spent = 0.0
+
+        if overhead > self.max_overhead and self.level < SAMPLED:
+            return self._set_level(self.level + 1, overhead)
+        if overhead < self.max_overhead / 2 and self.level > FULL:
+            return self._set_level(self.level - 1, overhead)
+        return None
+
+    def sample_call(self, code: types.CodeType) -> bool:
+        """Return True if a call should be recorded at the current level"""
+        if self.level < SAMPLED:
+            return True
+        count = self._call_counts.get(code, 0)
+        self._call_counts[code] = count + 1
+        return count % self.sample_every == 0
+
+    def reset(self):
+        """Forget the recorded transitions, keeping the current level"""
+        self.transitions.clear()
+        self.transition_counts = dict.fromkeys(LEVEL_NAMES, 0)
+
+    def stats(self) -> dict:
+        """Summary of the governor state, saved in the session metadata"""
+        return {
+            "max_overhead": self.max_overhead,
+            "level": self.level_name,
+            "transitions": list(self.transitions),
+            "transition_counts": dict(self.transition_counts),
+        }
+
+    def _set_level(self, level: int, overhead: float) -> int:
+        logger.info(f"Monitoring overhead {overhead:.1%}, fidelity {self.level_name} -> {LEVEL_NAMES[level]}")
+        self.transitions.append({
+            "time": datetime.datetime.now().isoformat(),
+            "from": self.level_name,
+            "to": LEVEL_NAMES[level],
+            "overhead": round(overhead, 4),
+        })
+        self.transition_counts[LEVEL_NAMES[level]] += 1
+        self.level = level
+        self._call_counts.clear()
+        return level
@@ -0,0 +1,147 @@
+"""
+Identity registry for live objects.
+
+Each live object gets an identity token the first time it is captured, all
+its states are stored as versions of that identity. Tokens are unique to the
+registry, so an object reusing the address of a collected one gets a new
+identity instead of continuing the history of the collected object.
+
+Objects without weak reference support (lists, dicts...) must be kept alive to
+be told apart from a later object at the same address. The registry keeps the
+most recently captured ones, up to a number of objects and an estimated total
+size: the history of an object evicted from it is split, its next state
+starts a new identity. An object larger than the size bound by itself is never
+kept, each of its captures starts a new identity.
+
+Keeping these objects alive is visible to the monitored program: the memory
+of a captured list or dict is only released once the registry evicts it or is
+cleared, and so are the objects it contains, whose __del__ methods and
+weakref.finalize callbacks run late instead of when the program drops them.
+Lower max_strong and max_strong_size (or clear the registry) when that matters.
+"""
+
+import itertools
+import logging
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+from functools import partial
+from typing import Any
+
+from .capture_policy import estimate_size
+
+logger = logging.getLogger(__name__)
+
+
+class IdentityRegistry:
+    """Hand out stable identity tokens to live objects.
+
+    Objects are tracked with weak references, their entry goes away with
+    them. Objects that don't support weak references (lists, dicts...) are
+    kept alive by the registry, the least recently captured ones are evicted
+    beyond `max_strong` objects or `max_strong_size` bytes (estimated with
+    capture_policy.estimate_size), an object larger than `max_strong_size`
+    isn't kept at all. An evicted object gets a new identity on its next
+    capture, its history is split in two.
+
+    Tokens minted by the registry and not yet persisted are known to be new,
+    storing their first state needs no lookup of an existing identity.
+
+    Args:
+        max_strong: Maximum number of objects without weak reference support tracked
+        max_strong_size: Maximum estimated size of these objects, in bytes
+    """
+
+    def __init__(self, max_strong: int = 10_000, max_strong_size: int = 64 * 1024 * 1024):
+        self.max_strong = max_strong
+        self.max_strong_size = max_strong_size
+        self.evictions = 0
+        self._prefix = uuid.uuid4().hex[:16]
+        self._counter = itertools.count(1)
+        self._weak: dict[int, tuple[weakref.ref, str]] = {}
+        # id -> (object, token, estimated size)
+        self._strong: OrderedDict[int, tuple[Any, str, int]] = OrderedDict()
+        self._strong_size = 0
+        self._new: set[str] = set()
+        self._lock = threading.Lock()
+
+    def reset_prefix(self):
+        """Mint the next tokens under a new prefix.
+
+        Used in a forked child, whose new tokens would otherwise collide with
+        the ones minted by the parent in the meantime. The child also gets a
+        new lock, in case another thread of the parent held it when forking.
+        """
+        self._prefix = uuid.uuid4().hex[:16]
+        self._lock = threading.Lock()
+
+    def identity_of(self, value: Any) -> str:
+        """Get the identity token of a live object, creating it on first use"""
+        key = id(value)
+        entry = self._weak.get(key)
+        if entry is not None and entry[0]() is value:
+            return entry[1]
+        # Threads capturing the same new object must get the same token
+        with self._lock:
+            entry = self._weak.get(key)
+            if entry is not None and entry[0]() is value:
+                return entry[1]
+            strong_entry = self._strong.get(key)
+            if strong_entry is not None and strong_entry[0] is value:
+                self._strong.move_to_end(key)
+                return strong_entry[1]
+
+            token = f"{self._prefix}:{next(self._counter)}"
+            self._new.add(token)
+            try:
+                self._weak[key] = (weakref.ref(value, partial(self._forget, key, token)), token)
+            except TypeError:
+                size = estimate_size(value)
+                if size > self.max_strong_size:
+                    # Keeping it would evict everything else, its next capture starts a new identity
+                    self._count_eviction()
+                    return token
+                self._strong[key] = (value, token, size)
+                self._strong_size += size
+                self._evict()
+            return token
+
+    def _evict(self):
+        """Drop the least recently captured objects beyond the limits, the lock is held"""
+        while self._strong and (len(self._strong) > self.max_strong or self._strong_size > self.max_strong_size):
+            _, (_, token, size) = self._strong.popitem(last=False)
+            self._strong_size -= size
+            self._new.discard(token)
+            self._count_eviction()
+
+    def _count_eviction(self):
+        """Account an object the registry stopped keeping alive"""
+        if not self.evictions:
+            logger.info("Identity registry full, the history of evicted objects is split into new identities")
+        self.evictions += 1
+
+    def is_new(self, token: str) -> bool:
+        """Return True if the token was minted here and has no stored identity yet"""
+        return token in self._new
+
+    def persisted(self, token: str):
+        """Mark the identity of a token as stored"""
+        self._new.discard(token)
+
+    def clear(self):
+        """Forget all the tracked objects, they get new identities on their next capture"""
+        self._weak.clear()
+        self._strong.clear()
+        self._strong_size = 0
+        self._new.clear()
+
+    def __len__(self) -> int:
+        return len(self._weak) + len(self._strong)
+
+    def _forget(self, key: int, token: str, _ref: weakref.ref):
+        """Weak reference callback, the object was collected"""
+        entry = self._weak.get(key)
+        if entry is not None and entry[1] == token:
+            del self._weak[key]
+        self._new.discard(token)
@@ -2,12 +2,14 @@ import datetime
 import logging
 import os
 import sqlite3
+from collections.abc import Iterable
 from typing import Any
 
 from sqlalchemy import (
     JSON,
     Boolean,
     DateTime,
+    Float,
     ForeignKey,
     Index,
     Integer,
@@ -17,17 +19,22 @@ from sqlalchemy import (
     and_,
     create_engine,
     desc,
+    inspect,
+    text,
 )
 from sqlalchemy.orm import (
     Mapped,
     Session,
     declarative_base,
     mapped_column,
+    object_session,
     relationship,
     sessionmaker,
 )
 from sqlalchemy.sql import func
 
+from .digest import DEFAULT_DIGEST, LEGACY_DIGEST
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
@@ -73,18 +80,52 @@ class StoredObject(Base):
     type_name: Mapped[str] = mapped_column(String, nullable=False)
     is_primitive: Mapped[bool] = mapped_column(Boolean, nullable=False)
     primitive_value: Mapped[str | None] = mapped_column(String, nullable=True)
-    pickle_data: Mapped[bytes | None] = mapped_column(LargeBinary, nullable=True)
+    pickle_data: Mapped[bytes | None] = mapped_column(LargeBinary, nullable=True)  # Possibly compressed (see compression.py)
+    chunk_refs: Mapped[list[str] | None] = mapped_column(JSON, nullable=True)  # IDs of the ObjectChunks of large states, instead of pickle_data
+    encoding: Mapped[str | None] = mapped_column(String, nullable=True)  # None for a full pickled state, "delta" for a patch against base_ref
+    base_ref: Mapped[str | None] = mapped_column(String, nullable=True)  # Previous version the patch applies to
+    is_summary: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)  # A ValueSummary of a value too large to be captured (see capture_policy.py)
 
     # Relationships
     identity = relationship("ObjectIdentity", back_populates="versions")
     code_definitions = relationship("CodeDefinition", secondary="code_object_links", back_populates="objects")
 
+class ObjectChunk(Base):
+    """Model for a chunk of the pickled state of large objects
+
+    Chunks are identified by the digest of their data and shared by all the
+    object versions containing them (see chunking.py).
+    """
+    __tablename__ = 'object_chunks'
+
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    # Chunks can start with any byte, unlike pickled states the codec byte of compressed ones isn't enough
+    compressed: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+
+class CompressionDictionary(Base):
+    """Model for a zlib dictionary trained on the stored states of a type
+
+    The ID is the Adler-32 of the dictionary, recorded in the payloads
+    compressed with it (see compression.py).
+    """
+    __tablename__ = 'compression_dictionaries'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    type_name: Mapped[str] = mapped_column(String, nullable=False)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
 class StackSnapshot(Base):
     """Model for storing stack state at each line execution
 
     Each snapshot represents the state of local and global variables
     at a specific line during function execution. Snapshots form a
     chronological sequence within a function call.
+
+    Keyframe snapshots store all the variable references. The others only
+    store the references that changed since the previous snapshot of the
+    call (None for removed variables). `locals_refs` and `globals_refs`
+    always return the full state, reconstructed from the last keyframe.
     """
     __tablename__ = 'stack_snapshots'
 
@@ -92,8 +133,9 @@ class StackSnapshot(Base):
     function_call_id: Mapped[int] = mapped_column(Integer, ForeignKey('function_calls.id'), nullable=False)
     line_number: Mapped[int] = mapped_column(Integer, nullable=False)
     timestamp: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.now)
-    locals_refs: Mapped[dict[str, str]] = mapped_column(JSON, nullable=False, default=dict)  # Dict[str, str] mapping variable names to object refs
-    globals_refs: Mapped[dict[str, str]] = mapped_column(JSON, nullable=False, default=dict)  # Dict[str, str] mapping variable names to object refs
+    locals_delta: Mapped[dict[str, str | None]] = mapped_column("locals_refs", JSON, nullable=False, default=dict)  # Dict[str, str] mapping variable names to object refs
+    globals_delta: Mapped[dict[str, str | None]] = mapped_column("globals_refs", JSON, nullable=False, default=dict)  # Dict[str, str] mapping variable names to object refs
+    is_keyframe: Mapped[bool] = mapped_column(Boolean, nullable=False, default=True)  # Whether the refs above are complete
 
     # Chronological ordering within a function call
     order_in_call: Mapped[int | None] = mapped_column(Integer, nullable=True)  # Position in the execution sequence
@@ -127,6 +169,83 @@ class StackSnapshot(Base):
         """Return True if this is the last snapshot in its function call"""
         return self.next_snapshot_id is None
 
+    # Full refs of a delta snapshot, filled by reconstruct()
+    _full_refs = None
+
+    def _get_full_refs(self) -> tuple[dict[str, str], dict[str, str]]:
+        if self.is_keyframe is not False:
+            return self.locals_delta or {}, self.globals_delta or {}
+        if self._full_refs is None:
+            session = object_session(self)
+            if session is None:
+                raise RuntimeError(f"Snapshot {self.id} is detached, its state can't be reconstructed")
+            StackSnapshot.reconstruct(session, [self])
+        return self._full_refs  # type: ignore[return-value]
+
+    @property
+    def locals_refs(self) -> dict[str, str]:
+        """Dict[str, str] mapping local variable names to object refs"""
+        return self._get_full_refs()[0]
+
+    @locals_refs.setter
+    def locals_refs(self, refs: dict[str, str]):
+        self.locals_delta = refs
+        self.is_keyframe = True
+
+    @property
+    def globals_refs(self) -> dict[str, str]:
+        """Dict[str, str] mapping global variable names to object refs"""
+        return self._get_full_refs()[1]
+
+    @globals_refs.setter
+    def globals_refs(self, refs: dict[str, str]):
+        self.globals_delta = refs
+        self.is_keyframe = True
+
+    @staticmethod
+    def reconstruct(session: Session, snapshots: Iterable['StackSnapshot']):
+        """Reconstruct the full refs of delta snapshots in one pass per function call.
+
+        Call it before reading the refs of many snapshots, reading them one by
+        one walks back to the keyframe for each snapshot.
+
+        Args:
+            session: SQLAlchemy session to use for queries
+            snapshots: Snapshots whose refs will be read
+        """
+        orders_by_call: dict[int, list[int]] = {}
+        for snapshot in snapshots:
+            if snapshot.is_keyframe is False and snapshot._full_refs is None:
+                orders_by_call.setdefault(snapshot.function_call_id, []).append(snapshot.order_in_call)
+
+        for call_id, orders in orders_by_call.items():
+            # Start from the last keyframe before the first snapshot to reconstruct
+            keyframe_order = session.query(func.max(StackSnapshot.order_in_call)).filter(
+                StackSnapshot.function_call_id == call_id,
+                StackSnapshot.is_keyframe.is_(True),
+                StackSnapshot.order_in_call <= min(orders)
+            ).scalar() or 0
+            chain = session.query(StackSnapshot).filter(
+                StackSnapshot.function_call_id == call_id,
+                StackSnapshot.order_in_call >= keyframe_order,
+                StackSnapshot.order_in_call <= max(orders)
+            ).order_by(StackSnapshot.order_in_call).all()
+
+            locals_refs: dict[str, str] = {}
+            globals_refs: dict[str, str] = {}
+            for snapshot in chain:
+                if snapshot.is_keyframe is not False:
+                    locals_refs = dict(snapshot.locals_delta or {})
+                    globals_refs = dict(snapshot.globals_delta or {})
+                    continue
+                for refs, delta in ((locals_refs, snapshot.locals_delta), (globals_refs, snapshot.globals_delta)):
+                    for name, ref in (delta or {}).items():
+                        if ref is None:
+                            refs.pop(name, None)
+                        else:
+                            refs[name] = ref
+                snapshot._full_refs = (dict(locals_refs), dict(globals_refs))
+
 class FunctionCall(Base):
     """Model for storing function call information"""
     __tablename__ = 'function_calls'
@@ -144,6 +263,11 @@ class FunctionCall(Base):
     globals_refs: Mapped[dict[str, str]] = mapped_column(JSON, nullable=False, default=dict)  # Dict[str, str] mapping variable names to object refs
     return_ref: Mapped[str | None] = mapped_column(String, nullable=True)  # Reference to return value in object manager
 
+    # Exception that ended the call, the call has no return value then
+    exception_type: Mapped[str | None] = mapped_column(String, nullable=True)  # Qualified name, without "builtins."
+    exception_message: Mapped[str | None] = mapped_column(String, nullable=True)
+    exception_ref: Mapped[str | None] = mapped_column(String, nullable=True)  # Reference to the exception object
+
     # Code version tracking
     code_definition_id: Mapped[str | None] = mapped_column(String, ForeignKey('code_definitions.id'), nullable=True)
 
@@ -162,12 +286,28 @@ class FunctionCall(Base):
     # First snapshot reference for efficient stack trace retrieval
     first_snapshot_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
 
+    # Native ID of the thread running the call, calls of other threads have their own parents and order
+    thread_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+
+    # asyncio task running the call (see thread_state.py), and the intervals it spent awaiting,
+    # as [suspended, resumed] offsets in seconds from start_time
+    task_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    suspensions: Mapped[list[list[float]] | None] = mapped_column(JSON, nullable=True)
+    awaiting_time: Mapped[float | None] = mapped_column(Float, nullable=True)  # Total seconds suspended, including the intervals not kept
+
     # Relationships
     session = relationship("MonitoringSession", foreign_keys=[session_id], back_populates="function_calls")
     stack_snapshots = relationship("StackSnapshot", back_populates="function_call", order_by="StackSnapshot.timestamp")
     code_definition = relationship("CodeDefinition", back_populates="function_calls")
     parent_call = relationship("FunctionCall", foreign_keys=[parent_call_id], remote_side=[id], backref="child_calls")
 
+    @property
+    def running_time(self) -> float | None:
+        """Seconds the call spent running, without the time its asyncio task spent awaiting"""
+        if self.start_time is None or self.end_time is None:
+            return None
+        return (self.end_time - self.start_time).total_seconds() - (self.awaiting_time or 0.0)
+
     def get_child_calls(self, session : Session):
         """Get all child function calls ordered by their execution sequence
 
@@ -235,12 +375,20 @@ class FunctionCall(Base):
             "locals_refs": self.locals_refs,
             "globals_refs": self.globals_refs,
             "return_ref": self.return_ref,
+            "exception_type": self.exception_type,
+            "exception_message": self.exception_message,
+            "exception_ref": self.exception_ref,
             "code_definition_id": self.code_definition_id,
             "session_id": self.session_id,
             "parent_call_id": self.parent_call_id,
             "order_in_parent": self.order_in_parent,
             "order_in_session": self.order_in_session,
-            "first_snapshot_id": self.first_snapshot_id
+            "first_snapshot_id": self.first_snapshot_id,
+            "thread_id": self.thread_id,
+            "task_id": self.task_id,
+            "suspensions": self.suspensions,
+            "awaiting_time": self.awaiting_time,
+            "running_time": self.running_time
         }
 
 class CodeDefinition(Base):
@@ -304,8 +452,12 @@ class MonitoringSession(Base):
     # Metadata about the session - renamed to avoid SQLAlchemy reserved name conflict
     session_metadata: Mapped[dict[str, Any] | None] = mapped_column(JSON, nullable=True)  # For any additional data
 
+    # Session of the parent process, for the sessions of child processes merged from their shards (see shards.py)
+    parent_session_id: Mapped[int | None] = mapped_column(Integer, ForeignKey('monitoring_sessions.id'), nullable=True)
+
     # Relationships
     function_calls = relationship("FunctionCall", foreign_keys=[FunctionCall.session_id], back_populates="session")
+    parent_session = relationship("MonitoringSession", foreign_keys=[parent_session_id], remote_side=[id], backref="child_sessions")
 
     @property
     def duration(self):
@@ -347,12 +499,25 @@ class MonitoringSession(Base):
             FunctionCall.parent_call_id.is_(None))  # Only top-level calls
         ).order_by(FunctionCall.order_in_session).all()
 
-def init_db(db_path, in_memory=True):
+class DatabaseInfo(Base):
+    """Model for the settings of a database, as key/value pairs
+
+    Keys:
+        object_digest: Name of the digest used to compute the references of stored objects (see digest.py)
+    """
+    __tablename__ = 'database_info'
+
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    value: Mapped[str] = mapped_column(String, nullable=False)
+
+def init_db(db_path, in_memory=True, digest=None):
     """Initialize the database and return session factory
 
     Args:
         db_path: Path to the SQLite database file or ':memory:' for in-memory database
         in_memory: Whether to use an in-memory database (default: True)
+        digest: Digest used for the object references of a new database (default: DEFAULT_DIGEST).
+            Existing databases keep the digest they were created with.
 
     Returns:
         SQLAlchemy Session factory configured for the database
@@ -362,8 +527,9 @@ def init_db(db_path, in_memory=True):
     """
     try:
         # Handle file-based databases
+        # The connection may be used by the monitor's writer thread (see pipeline.py)
         if in_memory:
-            dest = sqlite3.connect(':memory:')
+            dest = sqlite3.connect(':memory:', check_same_thread=False)
             if db_path != ":memory:":
                 # Ensure we have an absolute path
                 db_path = os.path.abspath(db_path)
@@ -374,7 +540,7 @@ def init_db(db_path, in_memory=True):
                     source.backup(dest)
                     db_path = ':memory:'
         else:
-            dest = sqlite3.connect(db_path)
+            dest = sqlite3.connect(db_path, check_same_thread=False)
 
 
         def get_connection():
@@ -385,6 +551,8 @@ def init_db(db_path, in_memory=True):
 
         # Create tables
         Base.metadata.create_all(engine)
+        _add_missing_columns(engine)
+        _record_object_digest(engine, digest or DEFAULT_DIGEST)
 
         # Create and return session factory
         return sessionmaker(bind=engine, expire_on_commit=False)
@@ -394,6 +562,48 @@ def init_db(db_path, in_memory=True):
         raise RuntimeError(f"Failed to initialize database: {e}") from e
 
 
+# Columns added after the first release, with the SQL used to add them to older databases
+_ADDED_COLUMNS = [
+    ("stack_snapshots", "is_keyframe", "BOOLEAN NOT NULL DEFAULT 1"),
+    ("stored_objects", "chunk_refs", "JSON"),
+    ("stored_objects", "encoding", "VARCHAR"),
+    ("stored_objects", "base_ref", "VARCHAR"),
+    ("object_chunks", "compressed", "BOOLEAN NOT NULL DEFAULT 0"),
+    ("stored_objects", "is_summary", "BOOLEAN NOT NULL DEFAULT 0"),
+    ("function_calls", "thread_id", "INTEGER"),
+    ("function_calls", "task_id", "INTEGER"),
+    ("function_calls", "suspensions", "JSON"),
+    ("function_calls", "awaiting_time", "FLOAT"),
+    ("function_calls", "exception_type", "VARCHAR"),
+    ("function_calls", "exception_message", "VARCHAR"),
+    ("function_calls", "exception_ref", "VARCHAR"),
+    ("monitoring_sessions", "parent_session_id", "INTEGER REFERENCES monitoring_sessions (id)"),
+]
+
+
+def _add_missing_columns(engine):
+    """Add the columns of _ADDED_COLUMNS missing from a database created by an older version"""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table_name, column_name, column_sql in _ADDED_COLUMNS:
+            columns = {column["name"] for column in inspector.get_columns(table_name)}
+            if column_name not in columns:
+                logger.info(f"Adding column {table_name}.{column_name} to the database")
+                connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_sql}"))
+
+
+def _record_object_digest(engine, digest: str):
+    """Record the object digest of the database if it isn't recorded yet"""
+    with Session(engine) as session:
+        if session.get(DatabaseInfo, "object_digest") is not None:
+            return
+        # Objects stored before the digest was recorded use the legacy one
+        if session.query(StoredObject.id).first() is not None:
+            digest = LEGACY_DIGEST
+        session.add(DatabaseInfo(key="object_digest", value=digest))
+        session.commit()
+
+
 def export_db(session : "Session", db_path: str):
     """Exports the current sessionto a specified file.
 
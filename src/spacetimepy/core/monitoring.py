@@ -1,32 +1,75 @@
 import atexit
 import datetime
-import dis
 import inspect
 import json
-import linecache
 import logging
+import multiprocessing.util
 import os
 import sys
+import threading
+from functools import partial
 from time import perf_counter
 import traceback
 import types
+from collections import deque
 from typing import Any
 
+from .capture_plan import CapturePlan, GlobalsClosure, accessed_global_names, monitored_events
+from .capture_policy import CapturePolicy
+from .change_detection import ChangeDetector
+from .compression import Compressor
+from .fork_capture import MAX_CHILDREN, ForkCapture, SpooledObject
 from .function_call import FunctionCallRepository
-from .models import FunctionCall, MonitoringSession, StackSnapshot, export_db, init_db
-from .representation import ObjectManager, PickleConfig
+from .governor import ARGS, FULL, FUNCTION, OverheadGovernor
+from .models import FunctionCall, MonitoringSession, ObjectIdentity, StackSnapshot, export_db, init_db
+from .pipeline import RecordingPipeline
+from .representation import PickleConfig
+from .sampling import Sampler, SamplingPolicy
+from .shards import monitor_from_environment, share_config, start_shard
+from .thread_state import ThreadState, ThreadStates
+from .type_strategies import REPR, SKIP, TypeStrategies
+from .write_buffer import IdAllocator, WriteBuffer
 
 # Configure logging - only show warnings and errors
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+_PRIMITIVES = (int, float, bool, str, type(None))
+
+# Suspension intervals kept per call, the time spent awaiting is still counted after them
+MAX_SUSPENSIONS = 1000
+
+# Length of the exception messages kept on the calls ended by an exception
+MAX_EXCEPTION_MESSAGE = 1000
+
+# Most recent call IDs kept per function in session_function_calls, all of them are in the database
+MAX_SESSION_CALL_IDS = 1000
+
+
+def exception_type_name(exception_type: type) -> str:
+    """Qualified name of an exception type, builtin exceptions keep their bare name"""
+    if exception_type.__module__ == "builtins":
+        return exception_type.__qualname__
+    return f"{exception_type.__module__}.{exception_type.__qualname__}"
+
+
+def exception_message(exception: BaseException) -> str | None:
+    """Message of an exception, truncated to MAX_EXCEPTION_MESSAGE characters"""
+    try:
+        message = str(exception)
+    except Exception:
+        return None
+    if len(message) > MAX_EXCEPTION_MESSAGE:
+        message = message[:MAX_EXCEPTION_MESSAGE] + "..."
+    return message
+
 MONITOR_TOOL_ID = sys.monitoring.PROFILER_ID
 
 class SpaceTimeMonitor:
     _instance = None
 
-    _monitored_functions = {}
-    _tracked_functions = {}
+    # Capture plans of the monitored code objects, built by pymonitor
+    _capture_plans: dict[types.CodeType, CapturePlan] = {}
 
     @classmethod
     def get_instance(cls) -> 'SpaceTimeMonitor | None':
@@ -37,12 +80,24 @@ class SpaceTimeMonitor:
         """
         return cls._instance
 
-    def __init__(self, db_path="monitoring.db", pickle_config: PickleConfig | None = None, in_memory=True, performance=False):
+    def __init__(self, db_path="monitoring.db", pickle_config: PickleConfig | None = None, in_memory=True, performance=False,
+                 flush_rows=1000, flush_bytes=8 * 1024 * 1024, flush_interval=1.0,
+                 pipeline=False, queue_size=1000, backpressure="block",
+                 sample_every=None, line_sample_every=None, max_calls_per_second=None,
+                 max_overhead=None, governor_window=1.0, keyframe_every=10,
+                 strict_capture=False, digest=None, delta_encoding=False,
+                 compression=None, compression_level=None, compression_dictionaries=False,
+                 max_size=None, max_length=None, max_depth=None, type_strategies=None,
+                 max_forks=MAX_CHILDREN, fork_spool_dir=None, shard_processes=False):
         if hasattr(self, 'initialized') and self._instance is not None:
             return
         self.initialized = True
+        # Settings passed on to the monitors of the child processes (see shards.py)
+        self.config = {name: value for name, value in locals().items() if name != "self"}
+        self.shard_processes = shard_processes
+        self.parent_process_id: int | None = None  # Set when recording a child process into its shard
         self.db_path = db_path
-        self.call_stack : list[FunctionCall] = []  # Stack to keep track of FunctionCall objects instead of just IDs
+        self._threads = ThreadStates()  # Call stacks of each thread, see thread_state.py
         self.MONITOR_TOOL_ID = MONITOR_TOOL_ID
         self.in_memory = in_memory
         # Custom pickle configuration
@@ -50,27 +105,50 @@ class SpaceTimeMonitor:
 
         # Recording flag
         self.is_recording_enabled = True
+        self._paused_events: dict[types.CodeType, int] = {}  # Event masks of the code objects paused by disable_recording
+
+        # Default sampling policy, monitored functions can override it
+        sampling = SamplingPolicy(sample_every, line_sample_every, max_calls_per_second)
+        self.sampling = sampling if sampling.is_active() else None
+        self._samplers: dict[types.CodeType, Sampler | None] = {}  # Sampling state per code object, None if not sampled
+
+        # Default size limits of the captured values, monitored functions can override them
+        capture_policy = CapturePolicy(max_size, max_length, max_depth)
+        self.capture_policy = capture_policy if capture_policy.is_active() else None
+        self._capture_policies: dict[CapturePlan, CapturePolicy | None] = {}  # Policy of each capture plan, merged with the default
+
+        # Strategy of some types (skip, repr only) and negative cache of the unpicklable types
+        self.type_strategies = TypeStrategies(type_strategies)
+
+        # Line snapshots of the functions monitored with fork=True are captured in forked children
+        self.forks = ForkCapture(max_forks, fork_spool_dir)
+        self._forked_snapshots: dict[int, StackSnapshot] = {}  # Fork key -> snapshot waiting for its variables
+
+        # Lowers the capture fidelity when the callbacks take too much of the wall time
+        self.governor = OverheadGovernor(max_overhead, governor_window) if max_overhead is not None else None
 
         # Current session information
         self.current_session : MonitoringSession | None = None  # Current monitoring session
-        self.session_function_calls = {}  # Dict mapping function names to lists of call IDs
+        self.session_function_calls = {}  # Dict mapping function names to their most recent call IDs
         self._current_session_first_call_id = None # ID of the first call in the current session chain
         self._current_session_last_call_id = None  # ID of the last call in the current session chain
-        self._parent_id_for_next_call: int | None = None
 
         # Performance optimization: In-memory counters to avoid database queries
         self._current_session_call_count = 0  # Counter for order_in_session
         self._parent_call_child_counts = {}  # Dict[parent_id, child_count] for order_in_parent
         self._function_snapshot_counts = {}  # Dict[function_call_id, snapshot_count] for order_in_call
+        self._last_snapshots = {}  # Dict[function_call_id, StackSnapshot] to link snapshots without querying
+        self._last_snapshot_refs = {}  # Dict[function_call_id, (locals_refs, globals_refs)] of the last snapshot, to compute deltas
+        self.keyframe_every = keyframe_every  # Store the full refs every N snapshots of a call, the others only store changes
 
         # Performance optimization: Multi-layered caching for get_used_globals
         self._bytecode_cache = {}  # Cache for static bytecode analysis (code -> set of accessed names)
-        self._type_cache = {}  # Cache for type checking results (id(obj) -> type_info)
-        self._type_cache_max_size = 10000  # Prevent memory leaks
-        self._globals_result_cache = {}  # Cache for final results (code_id + globals_hash -> result)
+        self._globals_closures: dict[types.CodeType, GlobalsClosure] = {}  # Global variables reachable from each code object
 
         # Performance optimization: Cache for code definitions to avoid expensive inspect operations
         self._code_definition_cache = {}  # Cache for code definition results (func_obj -> {code_def_id, mtime, module_path})
+        # Code definitions resolved on capture plans are only valid for this key, renewed when they may be gone
+        self._code_definitions_key = object()
 
         # Functions to skip one line snapshot (e.g. hotswap function trampoline skip frame)
         self.skip_one_line_snapshot = set()
@@ -78,13 +156,36 @@ class SpaceTimeMonitor:
         # Initialize the database and managers
         try:
             # First, initialize the database and ensure tables are created
-            Session = init_db(self.db_path, in_memory)
+            Session = init_db(self.db_path, in_memory, digest=digest)
 
             # Initialize the function call tracker
             self.session = Session()
 
             self.call_tracker = FunctionCallRepository(self.session, pickle_config=self.pickle_config)
-            self.object_manager = ObjectManager(self.session, pickle_config=self.pickle_config)
+            self.object_manager = self.call_tracker.object_manager
+
+            # Rows are committed in batches instead of one transaction per event
+            self.write_buffer = WriteBuffer(self.session, max_rows=flush_rows, max_bytes=flush_bytes, max_interval=flush_interval)
+            self.object_manager.write_buffer = self.write_buffer
+
+            # IDs are allocated in-process so buffered rows can be linked without flushing
+            self.id_allocator = IdAllocator(self.session, (FunctionCall, StackSnapshot, ObjectIdentity))
+            self.object_manager.id_allocator = self.id_allocator
+            self.write_buffer.add_reset_hook(self.object_manager.clear_pending)
+            self.write_buffer.add_reset_hook(self._reset_snapshot_chains)
+            self.write_buffer.add_reset_hook(self._reset_code_definitions)
+
+            # Objects whose fingerprint didn't change since their last capture aren't pickled again
+            self.object_manager.change_detector = None if strict_capture else ChangeDetector()
+            self.object_manager.delta_encoding = delta_encoding
+            # Reducers of the type strategies are used by every pickle of the recording
+            self.object_manager.pickle_config.dispatch_table.update(self.type_strategies.reducers)
+            if compression is not None:
+                self.object_manager.compressor = Compressor(compression, compression_level, dictionaries=compression_dictionaries)
+
+            # Storage can be moved to a writer thread, the callbacks then only capture values
+            self._write_lock = threading.RLock()
+            self.pipeline = RecordingPipeline(self._write_lock, queue_size, backpressure) if pipeline else None
 
             logger.info(f"Database initialized successfully at {self.db_path}")
         except Exception as e:
@@ -99,20 +200,42 @@ class SpaceTimeMonitor:
             sys.monitoring.register_callback(
                 self.MONITOR_TOOL_ID,
                 sys.monitoring.events.PY_START,
-                self.monitor_callback_function_start
+                self._timed_callback(self.monitor_callback_function_start)
             )
 
             sys.monitoring.register_callback(
                 self.MONITOR_TOOL_ID,
                 sys.monitoring.events.PY_RETURN,
-                self.monitor_callback_function_return
+                self._timed_callback(self.monitor_callback_function_return)
             )
 
             sys.monitoring.register_callback(
                 self.MONITOR_TOOL_ID,
                 sys.monitoring.events.LINE,
-                self.monitor_callback_line
+                self._timed_callback(self.monitor_callback_line)
+            )
+
+            # Suspensions of the monitored coroutines
+            sys.monitoring.register_callback(
+                self.MONITOR_TOOL_ID,
+                sys.monitoring.events.PY_YIELD,
+                self._timed_callback(self.monitor_callback_function_yield)
             )
+            for event in (sys.monitoring.events.PY_RESUME, sys.monitoring.events.PY_THROW):
+                sys.monitoring.register_callback(
+                    self.MONITOR_TOOL_ID, event, self._timed_callback(self.monitor_callback_function_resume)
+                )
+
+            # Calls ended by an exception, PY_UNWIND and PY_THROW can't be set per code object
+            sys.monitoring.register_callback(
+                self.MONITOR_TOOL_ID,
+                sys.monitoring.events.PY_UNWIND,
+                self._timed_callback(self.monitor_callback_function_unwind)
+            )
+            self._update_global_events()
+
+            # Locations disabled by a previous monitor's callbacks must be reported to this one
+            sys.monitoring.restart_events()
 
             logger.info("Registered monitoring callbacks")
         except Exception as e:
@@ -132,11 +255,47 @@ class SpaceTimeMonitor:
                 "function_failed_serialization": 0,
                 "function_failed_type": set(),
                 "function_captured_locals": 0,
+                "return_failed_serialization": 0,
+                "return_failed_type": set(),
+                "return_captured_locals": 0,
+                # Values not pickled because of their type (see type_strategies.py)
+                "line_cached_unserializable": 0,
+                "line_skipped_type": 0,
+                "line_repr_only": 0,
+                "function_cached_unserializable": 0,
+                "function_skipped_type": 0,
+                "function_repr_only": 0,
+                "return_cached_unserializable": 0,
+                "return_skipped_type": 0,
+                "return_repr_only": 0,
+                # Exceptions ending monitored calls
+                "exception_failed_serialization": 0,
+                "exception_failed_type": set(),
+                "exception_captured_locals": 0,
+                "exception_cached_unserializable": 0,
+                "exception_skipped_type": 0,
+                "exception_repr_only": 0,
             }
 
         SpaceTimeMonitor._instance = self
+        if self.shard_processes:
+            share_config(self)
         logger.info("Monitoring initialized successfully")
 
+    @property
+    def call_stack(self) -> list[FunctionCall | None]:
+        """FunctionCall rows of the recorded calls still running in the current thread"""
+        return self._threads.state.call_stack
+
+    @property
+    def _parent_id_for_next_call(self) -> int | None:
+        """Parent of the next call of the current thread, set when replaying"""
+        return self._threads.state.parent_id_for_next_call
+
+    @_parent_id_for_next_call.setter
+    def _parent_id_for_next_call(self, parent_id: int | None):
+        self._threads.state.parent_id_for_next_call = parent_id
+
     def shutdown(self):
         """Gracefully shut down monitoring"""
         logger.info("Starting SpaceTimeMonitor shutdown")
@@ -144,11 +303,21 @@ class SpaceTimeMonitor:
             with open("monitoring_performance.json", "w") as f:
                 self.performance_data["line_failed_type"] = [str(t) for t in self.performance_data["line_failed_type"]]
                 self.performance_data["function_failed_type"] = [str(t) for t in self.performance_data["function_failed_type"]]
+                self.performance_data["return_failed_type"] = [str(t) for t in self.performance_data["return_failed_type"]]
+                self.performance_data["exception_failed_type"] = [str(t) for t in self.performance_data["exception_failed_type"]]
                 json.dump(self.performance_data, f)
 
+        # Global events fire for all the code, monitored or not
+        sys.monitoring.set_events(self.MONITOR_TOOL_ID, 0)
+
         if hasattr(self, 'session'):
             try:
                 logger.info("Committing final changes and closing session")
+                if self.pipeline is not None:
+                    self.pipeline.stop()
+                if self.parent_process_id is not None and self.current_session is not None:
+                    self.end_session()
+                self.flush()
                 if self.in_memory:
                     self.export_db()
                     self.session.commit()
@@ -164,9 +333,14 @@ class SpaceTimeMonitor:
 
         This can be useful when you want to run code without monitoring overhead
         or when you want to exclude certain parts of your program from monitoring.
+        The events of the monitored code objects are turned off, so paused
+        functions run without any callback.
         """
         logger.info("Disabling monitoring recording")
         self.is_recording_enabled = False
+        for code in list(SpaceTimeMonitor._capture_plans):
+            self._pause_code(code)
+        self._update_global_events()
 
     def enable_recording(self):
         """Re-enable recording of function calls and line execution.
@@ -175,6 +349,48 @@ class SpaceTimeMonitor:
         """
         logger.info("Enabling monitoring recording")
         self.is_recording_enabled = True
+        paused_events, self._paused_events = self._paused_events, {}
+        for code, events in paused_events.items():
+            sys.monitoring.set_local_events(self.MONITOR_TOOL_ID, code, events)
+        self._update_global_events()
+
+    def _update_global_events(self):
+        """Turn the global events on only while something is recorded.
+
+        PY_UNWIND and PY_THROW can't be set per code object, they fire for every
+        exception of the process, monitored or not. They are off while recording
+        is paused and until a function is monitored, so exceptions then cost
+        the same as without monitoring.
+        """
+        events = 0
+        if self.is_recording_enabled and SpaceTimeMonitor._capture_plans:
+            events = sys.monitoring.events.PY_UNWIND | sys.monitoring.events.PY_THROW
+        if sys.monitoring.get_events(self.MONITOR_TOOL_ID) != events:
+            sys.monitoring.set_events(self.MONITOR_TOOL_ID, events)
+
+    def _timed_callback(self, callback):
+        """Wrap a monitoring callback to account its duration to the overhead governor"""
+        governor = self.governor
+        if governor is None:
+            return callback
+
+        def timed_callback(*args):
+            t1 = perf_counter()
+            try:
+                return callback(*args)
+            finally:
+                if governor.account(perf_counter() - t1) == FULL:
+                    # Back to full fidelity, re-arm the line events disabled meanwhile
+                    sys.monitoring.restart_events()
+
+        return timed_callback
+
+    def _pause_code(self, code: types.CodeType):
+        """Turn off the events of a code object, keeping its mask for enable_recording()"""
+        events = sys.monitoring.get_local_events(self.MONITOR_TOOL_ID, code)
+        if events:
+            self._paused_events[code] = self._paused_events.get(code, 0) | events
+            sys.monitoring.set_local_events(self.MONITOR_TOOL_ID, code, 0)
 
     def export_db(self):
         """Exports the current monitoring database to a specified file.
@@ -190,15 +406,64 @@ class SpaceTimeMonitor:
                         connection cannot be established.
             Exception: Any exceptions raised during the database backup process.
         """
+        self.flush()
         export_db(self.session, self.db_path)
 
+    def flush(self):
+        """Write all buffered monitoring rows to the database and commit them.
+
+        Rows are normally written in batches (see ``flush_rows``, ``flush_bytes``
+        and ``flush_interval``); call this before reading the database from
+        another connection to make sure it contains everything recorded so far.
+        """
+        if getattr(self, 'write_buffer', None) is None:
+            return
+        if self.pipeline is not None:
+            self.pipeline.drain()
+        with self._write_lock:
+            try:
+                self._merge_forks(block=True)
+                self.write_buffer.flush()
+            except Exception as e:
+                logger.error(f"Error flushing monitoring data: {e}")
+                logger.error(traceback.format_exc())
+
+    def _recover_session(self):
+        """Roll back only if a failed flush left the session unusable.
+
+        Rows buffered by earlier events are kept whenever possible, since a
+        rollback discards the whole pending batch.
+        """
+        if not self.session.is_active:
+            self.write_buffer.rollback()
+
+    def _reset_snapshot_chains(self, committed: bool):
+        """Write buffer reset hook: after a rollback, the next snapshot of each call is a keyframe
+
+        The last snapshots may have been rolled back, a delta against them couldn't be rebuilt.
+        """
+        if not committed:
+            self._last_snapshots.clear()
+            self._last_snapshot_refs.clear()
+
+    def _reset_code_definitions(self, committed: bool):
+        """Write buffer reset hook: the code definitions stored since the last commit were rolled back"""
+        if not committed:
+            self._code_definition_cache.clear()
+            self._code_definitions_key = object()
+
     def clear_caches(self):
         """Clear all performance caches. Useful for memory management."""
         self._bytecode_cache.clear()
-        self._type_cache.clear()
-        self._globals_result_cache.clear()
+        self._globals_closures.clear()
+        self._code_definitions_key = object()
         self._function_snapshot_counts.clear()
+        self._last_snapshots.clear()
+        self._last_snapshot_refs.clear()
         self._code_definition_cache.clear()
+        if self.object_manager.change_detector is not None:
+            self.object_manager.change_detector.clear()
+        self.type_strategies.clear()
         logger.info("Cleared all performance caches")
 
     def start_session(self, name=None, description=None, metadata=None):
@@ -216,20 +481,20 @@ class SpaceTimeMonitor:
             logger.warning("Call tracker is not initialized. Session will not be created.")
             return None
 
-        # Commit any pending changes to ensure data consistency
-        try:
-            self.session.commit()
-        except Exception as e:
-            logger.error(f"Error committing session before starting new monitoring session: {e}")
-            self.session.rollback()
+        # Write any buffered rows to ensure data consistency
+        self.flush()
 
         # Create a new session
         try:
+            metadata = dict(metadata or {})
+            if self.shard_processes:
+                # Lets merge_databases() find the parent of the sessions of child processes
+                metadata.setdefault("process_id", os.getpid())
             new_session = MonitoringSession(
                 name=name,
                 description=description,
                 start_time=datetime.datetime.now(),
-                session_metadata=metadata or {},
+                session_metadata=metadata,
             )
 
             self.session.add(new_session)
@@ -245,10 +510,15 @@ class SpaceTimeMonitor:
             self._current_session_call_count = 0
             self._parent_call_child_counts = {}
             self._function_snapshot_counts = {}
+            self._last_snapshots = {}
+            self._last_snapshot_refs = {}
+            self._samplers = {}
+            if self.governor is not None:
+                self.governor.reset()
             # Note: Don't reset bytecode cache or code definition cache as they're static
-            # Only clear type cache for new session (objects may change)
-            self._type_cache = {}
 
+            if self.shard_processes:
+                share_config(self)
             logger.info(f"Started new monitoring session {new_session.id}: {name}")
             return new_session.id
 
@@ -270,6 +540,10 @@ class SpaceTimeMonitor:
 
         session_id = self.current_session.id
 
+        # Let the writer thread store the events captured so far
+        if self.pipeline is not None:
+            self.pipeline.drain()
+
         try:
             # Update the session with end time
             setattr(self.current_session, 'end_time', datetime.datetime.now())
@@ -281,13 +555,30 @@ class SpaceTimeMonitor:
             else:
                 logger.warning(f"No first function call recorded for session {session_id}. Entry point not set.")
 
-            # Commit the changes including the entry point
-            self.session.commit()
+            # Keep the number of calls seen and recorded by each sampled function
+            sampling_stats = {
+                code.co_qualname: sampler.stats() for code, sampler in self._samplers.items() if sampler is not None
+            }
+            session_metadata = dict(self.current_session.session_metadata or {})
+            if sampling_stats:
+                session_metadata["sampling"] = sampling_stats
+            # Keep the fidelity changes made by the overhead governor
+            if self.governor is not None:
+                session_metadata["governor"] = self.governor.stats()
+            if session_metadata != self.current_session.session_metadata:
+                self.current_session.session_metadata = session_metadata
+
+            # Write the buffered rows and the changes including the entry point
+            with self._write_lock:
+                self._merge_forks(block=True)
+                self.write_buffer.flush()
 
             logger.info(f"Ended monitoring session {session_id}")
 
             # Reset current session and linked list trackers
             self.current_session = None
+            if self.shard_processes:
+                share_config(self)
             self.session_function_calls = {}
             self._current_session_first_call_id = None
             self._current_session_last_call_id = None
@@ -296,16 +587,17 @@ class SpaceTimeMonitor:
             self._current_session_call_count = 0
             self._parent_call_child_counts = {}
             self._function_snapshot_counts = {}
+            self._last_snapshots = {}
+            self._last_snapshot_refs = {}
+            self._samplers = {}
             # Note: Don't reset bytecode cache or code definition cache as they're static
-            # Only clear type cache for new session (objects may change)
-            self._type_cache = {}
 
             return session_id
 
         except Exception as e:
             logger.error(f"Error ending monitoring session: {e}")
             logger.error(traceback.format_exc())
-            self.session.rollback()
+            self._recover_session()
             return None
 
     def add_function_call_to_session(self, function_name, call_id):
@@ -318,34 +610,130 @@ class SpaceTimeMonitor:
         if self.current_session is None or call_id is None:
             return
 
-        # Initialize the list for this function if it doesn't exist
+        # Initialize the IDs of this function if it doesn't have any
         if function_name not in self.session_function_calls:
-            self.session_function_calls[function_name] = []
+            self.session_function_calls[function_name] = deque(maxlen=MAX_SESSION_CALL_IDS)
 
         # Add the call ID to the list
         self.session_function_calls[function_name].append(call_id)
 
-    def _store_variables(self, variables: dict[str, Any]) -> dict[str, str]:
-        """Store variables and return a dictionary of variable names to object references"""
-        refs = {}
+    def _capture_variables(self, variables: dict[str, Any], kind: str = "function", skip_special: bool = True,
+                           ignore: frozenset[str] = frozenset(), policy: CapturePolicy | None = None) -> dict[str, Any]:
+        """Capture the current state of variables so they can be stored later.
+
+        Args:
+            variables: Dictionary of variable names to values
+            kind: "function" or "line", selects the performance counters and how
+                failures are reported ("function" keeps them as "<unserializable>")
+            skip_special: Whether to skip dunder names and callables
+            ignore: Variable names to skip
+            policy: Size limits above which values are summarized
+
+        Returns:
+            Dictionary of variable names to captured objects
+        """
+        captured = {}
         for name, value in variables.items():
             # Skip special variables and functions
-            if name.startswith('__') or callable(value):
+            if skip_special and (name.startswith('__') or callable(value)):
+                continue
+            if name in ignore:
                 continue
+            obj = self._capture_value(value, kind, policy)
+            # Keep the variable visible even if we can't store its value, except in line snapshots
+            if obj is not None and (not isinstance(obj, str) or kind == "function"):
+                captured[name] = obj
+        return captured
+
+    def _capture_value(self, value: Any, kind: str, policy: CapturePolicy | None = None) -> Any:
+        """Capture one value according to the strategy of its type.
+
+        Args:
+            value: The value to capture
+            kind: "function", "line", "return" or "exception", selects the performance counters
+            policy: Size limits above which the value is summarized
+
+        Returns:
+            The captured object, "<unserializable>" if the value can't be pickled,
+            or None if values of its type are skipped
+        """
+        value_type = type(value)
+        strategy = self.type_strategies.lookup(value_type)
+        if strategy is None:
             try:
-                # Store the value and get its reference
-                ref = self.object_manager.store(value)
-                # Always store the reference, not the value
-                refs[name] = ref
-            except Exception as e:
-                # Log warning but continue if we can't store a variable
-                refs[name] = "<unserializable>"
+                captured = self.object_manager.capture(value, policy)
+            except Exception as e:  # Pickling runs the reducers of arbitrary types
+                if kind == "return":
+                    logger.warning(f"Could not store return value: {e}")
+                else:
+                    logger.debug(f"Could not capture a {value_type.__name__} value: {e}", exc_info=True)
+                # Values of this type may not be tried again for a while
+                self.type_strategies.failed(value_type, e)
                 if self.performance:
-                    self.performance_data["function_failed_serialization"] += 1
-                    self.performance_data["function_failed_type"].add(type(value))
+                    self.performance_data[f"{kind}_failed_serialization"] += 1
+                    self.performance_data[f"{kind}_failed_type"].add(value_type)
+                return "<unserializable>"
+            self.type_strategies.succeeded(value_type)
+            if self.performance:
+                self.performance_data[f"{kind}_captured_locals"] += 1
+            return captured
+
+        if strategy == SKIP:
+            if self.performance:
+                self.performance_data[f"{kind}_skipped_type"] += 1
+            return None
+        if strategy == REPR:
+            if self.performance:
+                self.performance_data[f"{kind}_repr_only"] += 1
+            return self.object_manager.capture_repr(value)
+        if self.performance:
+            self.performance_data[f"{kind}_cached_unserializable"] += 1
+        return "<unserializable>"
+
+    def _store_captured(self, captured: dict[str, Any]) -> dict[str, str]:
+        """Store captured variables and return a dictionary of variable names to object references"""
+        refs = {}
+        for name, obj in captured.items():
+            if isinstance(obj, str):
+                # Placeholder reference such as "<unserializable>"
+                refs[name] = obj
+                continue
+            try:
+                refs[name] = self.object_manager.store_captured(obj)
+            except Exception as e:
+                logger.warning(f"Failed to store variable {name}: {e}")
         return refs
 
-    def _get_cached_code_definition(self, func_obj, code_name: str) -> str | None:
+    def _dispatch(self, func, *args, required: bool = True) -> bool:
+        """Apply a captured event, inline or on the pipeline writer thread.
+
+        Returns:
+            False if the event was dropped by the pipeline backpressure policy
+        """
+        if self.pipeline is None:
+            # Threads store their events one at a time, the session is shared
+            with self._write_lock:
+                func(*args)
+            return True
+        return self.pipeline.submit(func, *args, required=required)
+
+    def _should_summarize(self) -> bool:
+        """Return True if events should be captured without their variables"""
+        if self.pipeline is None or self.pipeline.backpressure != "summary" or not self.pipeline.is_full():
+            return False
+        self.pipeline.stats["degraded"] += 1
+        return True
+
+    def _code_definition_id(self, plan: CapturePlan) -> str | None:
+        """Code definition ID of a monitored function, resolved once per capture plan"""
+        resolved = plan.code_definition
+        if resolved is not None and resolved[0] is self._code_definitions_key:
+            return resolved[1]
+        code_def_id = self._get_cached_code_definition(plan.func, plan.name, plan.module_path)
+        plan.code_definition = (self._code_definitions_key, code_def_id)
+        return code_def_id
+
+    def _get_cached_code_definition(self, func_obj, code_name: str, module_path: str | None = None) -> str | None:
         """Get cached code definition ID for a function object (performance optimization)
 
         Checks file modification time to ensure cache validity when source files change.
@@ -353,6 +741,7 @@ class SpaceTimeMonitor:
         Args:
             func_obj: The function object to get code definition for
             code_name: Name of the code object (for fallback)
+            module_path: File of the module defining the function, if already known
 
         Returns:
             Code definition ID or None if not available
@@ -362,13 +751,13 @@ class SpaceTimeMonitor:
             return None
 
         # Get the module path first to check modification time
-        module_path = None
-        try:
-            if inspect.isfunction(func_obj):
-                module = inspect.getmodule(func_obj)
-                module_path = module.__file__ if module and hasattr(module, '__file__') else None
-        except Exception:
-            pass
+        if module_path is None:
+            try:
+                if inspect.isfunction(func_obj):
+                    module = inspect.getmodule(func_obj)
+                    module_path = module.__file__ if module and hasattr(module, '__file__') else None
+            except Exception:
+                pass
 
         # If no module path, we can't cache effectively
         if not module_path:
@@ -443,7 +832,8 @@ class SpaceTimeMonitor:
 
         return code_def_id
 
-    def create_stack_snapshot(self, call_id: int, line_number: int, locals_dict: dict[str, str], globals_dict: dict[str, str], order_in_call: int | None = None) -> StackSnapshot | None:
+    def create_stack_snapshot(self, call_id: int, line_number: int, locals_dict: dict[str, str], globals_dict: dict[str, str], order_in_call: int | None = None,
+                              timestamp: datetime.datetime | None = None, call: FunctionCall | None = None) -> StackSnapshot | None:
         """
         Create a stack snapshot for a function call.
 
@@ -453,6 +843,8 @@ class SpaceTimeMonitor:
             locals_dict: Dictionary of local variable references
             globals_dict: Dictionary of global variable references
             order_in_call: Position in the execution sequence (optional)
+            timestamp: Time the line was executed, defaults to now (optional)
+            call: The function call, if already at hand (optional)
 
         Returns:
             The created StackSnapshot object or None if creation fails
@@ -461,47 +853,110 @@ class SpaceTimeMonitor:
             return None
 
         try:
-            # Get the function call
-            call = self.session.get(FunctionCall, call_id)
+            # Get the function call, usually the one on top of the stack
+            if call is None or call.id != call_id:
+                stack = self.call_stack
+                if stack and stack[-1] is not None and stack[-1].id == call_id:
+                    call = stack[-1]
+                else:
+                    call = self.session.get(FunctionCall, call_id)
             if not call:
                 logger.error(f"Function call {call_id} not found during stack snapshot creation")
                 return None
 
-            # Find the previous snapshot if any
-            prev_snapshot = None
-            if order_in_call is not None and order_in_call > 0:
-                prev_snapshot = self.session.query(StackSnapshot).filter(
-                    StackSnapshot.function_call_id == call_id,
-                    StackSnapshot.order_in_call == order_in_call - 1
-                ).first()
+            # Previous snapshot of this call, kept in memory to avoid a query
+            prev_snapshot = self._last_snapshots.get(call_id)
+            prev_refs = self._last_snapshot_refs.get(call_id)
+
+            # Store only the changes since the previous snapshot, with a full keyframe every N snapshots
+            is_keyframe = (prev_snapshot is None or prev_refs is None or not self.keyframe_every
+                           or (order_in_call or 0) % self.keyframe_every == 0)
+            if is_keyframe:
+                locals_stored, globals_stored = locals_dict, globals_dict
+            else:
+                locals_stored = self._refs_delta(prev_refs[0], locals_dict)
+                globals_stored = self._refs_delta(prev_refs[1], globals_dict)
 
             # Create the new snapshot
             snapshot = StackSnapshot(
+                id=self.id_allocator.next_id(StackSnapshot),
                 function_call_id=call_id,
                 line_number=line_number,
-                locals_refs=locals_dict,
-                globals_refs=globals_dict,
-                order_in_call=order_in_call
+                locals_delta=locals_stored,
+                globals_delta=globals_stored,
+                is_keyframe=is_keyframe,
+                order_in_call=order_in_call,
+                timestamp=timestamp or datetime.datetime.now()
             )
-
-            # Set bidirectional link if previous snapshot exists
-            if prev_snapshot:
+            if not is_keyframe:
+                snapshot._full_refs = (locals_dict, globals_dict)
+            self.write_buffer.add(snapshot, self._refs_size(locals_stored) + self._refs_size(globals_stored))
+            self._last_snapshots[call_id] = snapshot
+            self._last_snapshot_refs[call_id] = (locals_dict, globals_dict)
+
+            # Link the previous snapshot to this one
+            if prev_snapshot is not None:
                 prev_snapshot.next_snapshot_id = snapshot.id
 
-            self.session.add(snapshot)
-
             # If this is the first snapshot for this call, update the call record
-            if order_in_call == 0 or not call.first_snapshot_id:
+            if order_in_call == 0 or (prev_snapshot is None and not call.first_snapshot_id):
                 call.first_snapshot_id = snapshot.id
 
-            self.session.flush()  # Flush to get the ID
-
             return snapshot
         except Exception as e:
             logger.error(f"Error creating stack snapshot for call {call_id}: {e}")
             logger.error(traceback.format_exc())
             return None
 
+    def _get_sampler(self, plan: CapturePlan) -> Sampler | None:
+        """Get the sampling state of a monitored code object, None if all its calls are recorded"""
+        try:
+            return self._samplers[plan.code]
+        except KeyError:
+            policy = plan.sampling.merged(self.sampling) if plan.sampling is not None else self.sampling
+            sampler = Sampler(policy) if policy is not None and policy.is_active() else None
+            self._samplers[plan.code] = sampler
+            return sampler
+
+    def _get_capture_policy(self, plan: CapturePlan | None) -> CapturePolicy | None:
+        """Get the size limits of the values captured for a monitored code object, None if unlimited"""
+        if plan is None:
+            return self.capture_policy
+        try:
+            return self._capture_policies[plan]
+        except KeyError:
+            policy = plan.capture_policy.merged(self.capture_policy) if plan.capture_policy is not None else self.capture_policy
+            policy = policy if policy is not None and policy.is_active() else None
+            self._capture_policies[plan] = policy
+            return policy
+
+    @staticmethod
+    def _get_capture_plan(code: types.CodeType, frame) -> CapturePlan:
+        """Get the capture plan of a code object.
+
+        Code objects monitored without going through pymonitor (e.g. a function
+        whose code was swapped at runtime) get a default plan on their first call.
+        """
+        plan = SpaceTimeMonitor._capture_plans.get(code)
+        if plan is None:
+            func_obj = frame.f_globals.get(code.co_name)
+            plan = CapturePlan(func_obj if inspect.isfunction(func_obj) else None, code=code)
+            SpaceTimeMonitor._capture_plans[code] = plan
+        return plan
+
+    @staticmethod
+    def _refs_size(refs: dict[str, str | None]) -> int:
+        """Approximate the stored size of a refs dictionary"""
+        return sum(len(name) + len(ref or "") for name, ref in refs.items())
+
+    @staticmethod
+    def _refs_delta(previous: dict[str, str], current: dict[str, str]) -> dict[str, str | None]:
+        """Changed and new refs of current, with None for the names removed since previous"""
+        delta: dict[str, str | None] = {name: ref for name, ref in current.items() if previous.get(name) != ref}
+        for name in previous.keys() - current.keys():
+            delta[name] = None
+        return delta
+
     def monitor_callback_function_start(self, code: types.CodeType, offset):
         # Check if recording is enabled
         logger.info(f"Monitoring function start: {code.co_name}")
@@ -517,69 +972,46 @@ class SpaceTimeMonitor:
             return
 
         frame = current_frame.f_back
-        func_name = code.co_name
-        func_obj = frame.f_globals.get(func_name)
-
-        # Check if this is a tracked function and if so,
-        # verify that its tracking function is in our call stack
-        is_tracked_function = False
-        tracking_function_name = None
-
-        # Check direct attribute on function object
-        if func_obj and func_name in SpaceTimeMonitor._tracked_functions:
-            tracking_function_name = SpaceTimeMonitor._tracked_functions[func_name]["parent_tracking_function"]
-
-        # If we found tracking information, verify it's in our call stack
-        if tracking_function_name:
-            if not self.call_stack:
-                return
-
-            for call in self.call_stack:
-                if call.function == tracking_function_name:
-                    is_tracked_function = True
-                    break
-
-            if not is_tracked_function:
-                return
-
+        plan = self._get_capture_plan(code, frame)
+        thread = self._threads.state
+        capture_stack = thread.capture_stack
+
+        # If this is a tracked function, verify that its tracking function is in our call stack
+        if plan.tracked_by is not None and plan.tracked_by not in capture_stack:
+            # Mark the call as not recorded so its return is ignored
+            capture_stack.append(None)
+            return
 
-        # Get the function's parameter names from its code object
-        arg_names = code.co_varnames[:code.co_argcount]
+        # Unsampled calls are only counted, the calls they make attach to the nearest recorded ancestor
+        sampler = self._get_sampler(plan)
+        if sampler is not None and not sampler.sample_call():
+            capture_stack.append(None)
+            return
+        governor = self.governor
+        if governor is not None and not governor.sample_call(code):
+            capture_stack.append(None)
+            return
 
-        # Get the values of the arguments from the frame's locals
-        function_locals = {}
-        for arg_name in arg_names:
-            if arg_name in frame.f_locals:
-                function_locals[arg_name] = frame.f_locals[arg_name]
+        # Get the values of the arguments from the frame's locals, without the ignored ones
+        frame_locals = frame.f_locals
+        ignore = plan.ignore
+        function_locals = {
+            name: frame_locals[name] for name in plan.arg_names
+            if name in frame_locals and name not in ignore
+        }
         # Get used globals
-        globals_used = self.get_used_globals(code, frame.f_globals)
-        # Get ignored variables from the function object itself
-        ignored_variables = []
-        if func_obj and func_name in SpaceTimeMonitor._monitored_functions:
-            ignored_variables = SpaceTimeMonitor._monitored_functions[func_name]["ignore"] or [] # Ensure it's a list
-
-        # Get hooks from the function object
-        start_hooks = []
-        if func_obj:
-            # Safely get start_hooks, handling case where function isn't registered
-            if func_name in SpaceTimeMonitor._monitored_functions:
-                start_hooks = SpaceTimeMonitor._monitored_functions[func_name]["start_hooks"] or []
-            else:
-                # Function not explicitly registered for monitoring, use empty hooks
-                logger.debug(f"Function '{func_name}' not found in _monitored_functions, using empty start_hooks")
-                start_hooks = []
-
-        # Filter locals and globals based on the ignore list
-        function_locals = {k: v for k, v in function_locals.items() if k not in ignored_variables}
-        globals_used = {k: v for k, v in globals_used.items() if k not in ignored_variables}
-
-        # Get cached code definition (performance optimization)
-        code_def_id = self._get_cached_code_definition(func_obj, code.co_name) if func_obj else None
+        if governor is not None and governor.level >= ARGS:
+            # Degraded fidelity, only the arguments are captured
+            globals_used = {}
+        else:
+            globals_used = self.get_used_globals(code, frame.f_globals, accessed_names=plan.global_names)
+        if ignore:
+            globals_used = {k: v for k, v in globals_used.items() if k not in ignore}
 
         # Execute start hooks and collect initial metadata
         start_metadata = {}
 
-        for hook in start_hooks:
+        for hook in plan.start_hooks:
             try:
                 hook_metadata = hook(self, code, offset)
                 if isinstance(hook_metadata, dict):
@@ -590,35 +1022,60 @@ class SpaceTimeMonitor:
                 logger.error(f"Error executing start hook {hook.__name__} for {code.co_name}: {hook_exc}")
                 logger.error(traceback.format_exc())
 
-        # Get the actual file and line number from the code object
-        file_name = code.co_filename
-        line_number = code.co_firstlineno
-
         # Get function qualname for better tracking
-        function_qualname = code.co_name
+        function_qualname = plan.qualname(frame_locals)
+
+        # Check if a parent ID was set for replay
+        parent_id = thread.parent_id_for_next_call
+        if parent_id is not None:
+            # Reset the flag immediately after reading it
+            thread.parent_id_for_next_call = None
+            logger.info(f"Replay detected: Setting parent_call_id to {parent_id} for next call.")
+
         try:
-            if 'self' in frame.f_locals and hasattr(frame.f_locals['self'], '__class__'):
-                function_qualname = f"{frame.f_locals['self'].__class__.__name__}.{code.co_name}"
-        except Exception:
-            pass  # Use simple name if extraction fails
+            if self._should_summarize():
+                # The writer is behind, record the call without its variables
+                locals_captured, globals_captured = {}, {}
+                start_metadata["recording_degraded"] = True
+            else:
+                policy = self._get_capture_policy(plan)
+                locals_captured = self._capture_variables(function_locals, policy=policy)
+                globals_captured = self._capture_variables(globals_used, policy=policy)
+
+            recorded = self._dispatch(
+                self._record_call_start, thread, plan, function_qualname, locals_captured, globals_captured,
+                start_metadata, parent_id, datetime.datetime.now(),
+                required=False
+            )
+            # Dropped calls stay on the stack so their lines and return are ignored
+            capture_stack.append(function_qualname if recorded else None)
+        except Exception as e:
+            logger.error(f"Error capturing function call: {e}")
+            logger.error(traceback.format_exc())
+            capture_stack.append(None)
+
+        if self.performance:
+            t2 = perf_counter()
+            elapsed = t2 - t1
+            self.performance_data["function_starts"].append((code.co_name, elapsed))
 
+    def _record_call_start(self, thread: ThreadState, plan: CapturePlan, function_qualname, locals_captured, globals_captured,
+                           start_metadata, parent_id, start_time):
+        """Store a captured function start and push the new call on the call stack of its thread"""
+        # Get cached code definition (performance optimization)
+        code_def_id = self._code_definition_id(plan) if plan.func else None
+        call_stack = thread.call_stack
+        depth = len(call_stack)
 
         # Create the function call directly (inlined capture_call)
         try:
             # Store local and global variables
-            locals_refs = self._store_variables(function_locals)
-            globals_refs = self._store_variables(globals_used)
-
-            # Check if a parent ID was set for replay
-            parent_id = self._parent_id_for_next_call
-            if parent_id is not None:
-                # Reset the flag immediately after reading it
-                self._parent_id_for_next_call = None
-                logger.info(f"Replay detected: Setting parent_call_id to {parent_id} for next call.")
+            locals_refs = self._store_captured(locals_captured)
+            globals_refs = self._store_captured(globals_captured)
 
             # If we're inside another monitored function (stack isn't empty), get the parent ID
-            if not parent_id and len(self.call_stack) > 0:
-                parent_id = self.call_stack[-1].id
+            if not parent_id:
+                parent_id = next((c.id for c in reversed(call_stack) if c is not None), None)
 
             # Calculate order in session using in-memory counter (performance optimization)
             order_in_session = None
@@ -637,10 +1094,11 @@ class SpaceTimeMonitor:
 
             # Create function call record directly
             call = FunctionCall(
+                id=self.id_allocator.next_id(FunctionCall),
                 function=function_qualname,
-                file=file_name,
-                line=line_number,
-                start_time=datetime.datetime.now(),
+                file=plan.code.co_filename,
+                line=plan.code.co_firstlineno,
+                start_time=start_time,
                 locals_refs=locals_refs,
                 globals_refs=globals_refs,
                 code_definition_id=code_def_id,
@@ -648,18 +1106,15 @@ class SpaceTimeMonitor:
                 parent_call_id=parent_id,
                 session_id=current_session_id,
                 order_in_session=order_in_session,
-                order_in_parent=order_in_parent
+                order_in_parent=order_in_parent,
+                thread_id=thread.thread_id,
+                task_id=thread.task_id
             )
 
-            self.session.add(call)
-            self.session.flush()  # Flush to get the ID
-            if call.id is None:
-                logger.error(f"Failed to obtain ID for new FunctionCall for {function_qualname}")
-                self.session.rollback()
-                return
+            self.write_buffer.add(call, self._refs_size(locals_refs) + self._refs_size(globals_refs))
 
             # Add the FunctionCall object to the stack instead of just the ID
-            self.call_stack.append(call)
+            call_stack.append(call)
 
             # Track the first call in the session as the entry point
             if self._current_session_first_call_id is None:
@@ -683,15 +1138,15 @@ class SpaceTimeMonitor:
             # Initialize snapshot counter for this function call
             self._function_snapshot_counts[call.id] = 0
 
+            self.write_buffer.maybe_flush()
+
         except Exception as e:
             logger.error(f"Error capturing function call: {e}")
             logger.error(traceback.format_exc())
-            self.session.rollback()
-
-        if self.performance:
-            t2 = perf_counter()
-            elapsed = t2 - t1
-            self.performance_data["function_starts"].append((func_name, elapsed))
+            self._recover_session()
+            # Keep the stack aligned with the return events
+            if len(call_stack) == depth:
+                call_stack.append(None)
 
 
     def monitor_callback_function_return(self, code: types.CodeType, offset, return_value):
@@ -700,7 +1155,8 @@ class SpaceTimeMonitor:
         if not self.is_recording_enabled:
             return
 
-        if self.call_tracker is None or not self.call_stack:
+        thread = self._threads.state
+        if self.call_tracker is None or not thread.capture_stack:
             return
 
         if self.performance:
@@ -708,23 +1164,12 @@ class SpaceTimeMonitor:
 
         collected_return_metadata = {}
         try:
-            # Get the FunctionCall object for this function
-            call = self.call_stack.pop()
-
-            # Get the function object from the frame
-            frame = inspect.currentframe()
-            if frame is None or frame.f_back is None:
+            # Calls that were not recorded have nothing to close
+            if thread.capture_stack.pop() is None:
                 return
-            func_obj = frame.f_back.f_globals.get(code.co_name)
-            return_hooks = []
-            if func_obj:
-                # Safely get return_hooks, handling case where function isn't registered
-                if code.co_name in SpaceTimeMonitor._monitored_functions:
-                    return_hooks = SpaceTimeMonitor._monitored_functions[code.co_name]["return_hooks"] or []
-                else:
-                    # Function not explicitly registered for monitoring, use empty hooks
-                    logger.debug(f"Function '{code.co_name}' not found in _monitored_functions, using empty return_hooks")
-                    return_hooks = []
+
+            plan = SpaceTimeMonitor._capture_plans.get(code)
+            return_hooks = plan.return_hooks if plan is not None else ()
 
             # Execute return hooks if any
             for hook in return_hooks:
@@ -740,259 +1185,260 @@ class SpaceTimeMonitor:
                     logger.error(f"Error executing return hook {hook.__name__} for {code.co_name}: {hook_exc}")
                     logger.error(traceback.format_exc())
 
-            # Inline capture_return functionality - store return value and update call
-            try:
-                return_ref = self.call_tracker.object_manager.store(return_value)
-                call.return_ref = return_ref
-                call.end_time = datetime.datetime.now()
-
-                # Update metadata with hook results (if any)
-                if collected_return_metadata:
-                    # If there's existing metadata, merge it with the new data
-                    if call.call_metadata:
-                        # Create a new dict to avoid modifying the original
-                        updated_metadata = dict(call.call_metadata)
-                        updated_metadata.update(collected_return_metadata)
-                        call.call_metadata = updated_metadata
-                    else:
-                        call.call_metadata = collected_return_metadata
-
-                # Clean up snapshot counter (performance optimization)
-                if call.id in self._function_snapshot_counts:
-                    del self._function_snapshot_counts[call.id]
-
-                # Commit the changes
-                self.session.commit()
+            return_captured = self._capture_value(return_value, "return", self._get_capture_policy(plan))
 
-            except Exception as e:
-                logger.warning(f"Could not store return value: {e}")
-                self.session.rollback()
+            # Always dispatched so the call is closed even under backpressure
+            self._dispatch(self._record_return, thread, return_captured, collected_return_metadata, datetime.datetime.now())
+            # The task of a coroutine can't stay suspended once it returned
+            thread.suspended_at = None
 
         except Exception as e:
             logger.error(f"Error capturing function return: {e}")
             logger.error(traceback.format_exc())
-            self.session.rollback()
 
         if self.performance:
             t2 = perf_counter()
             elapsed = t2 - t1
             self.performance_data["function_returns"].append((code.co_name, elapsed))
 
-    def _get_accessed_global_names(self, code: types.CodeType, processed_functions=None):
-        """Extract global names accessed by bytecode (static analysis, cached)"""
-        if code in self._bytecode_cache:
-            return self._bytecode_cache[code]
+    def monitor_callback_function_unwind(self, code: types.CodeType, offset, exception):
+        """Callback for calls exiting with an exception, fired for all the code"""
+        plan = SpaceTimeMonitor._capture_plans.get(code)
+        if not self.is_recording_enabled or plan is None:
+            return
+        thread = self._threads.state
+        if self.call_tracker is None or not thread.capture_stack:
+            return
+        thread.suspended_at = None
+        if thread.capture_stack.pop() is None:
+            return
+        try:
+            exception_info = (
+                exception_type_name(type(exception)),
+                exception_message(exception),
+                self._capture_value(exception, "exception", self._get_capture_policy(plan)),
+            )
+        except Exception as e:
+            logger.error(f"Error capturing exception of {code.co_name}: {e}")
+            exception_info = None
+        # The call is closed without a return value, always dispatched like returns
+        self._dispatch(self._record_return, thread, None, {}, datetime.datetime.now(), exception_info)
+
+    def monitor_callback_function_yield(self, code: types.CodeType, offset, value):
+        """Callback for monitored coroutines yielding to the event loop, their task is suspended"""
+        if not self.is_recording_enabled or self.call_tracker is None:
+            return
+        # Only the innermost coroutine of the stack starts the suspension
+        thread = self._threads.state
+        if thread.capture_stack and thread.suspended_at is None:
+            thread.suspended_at = datetime.datetime.now()
+
+    def monitor_callback_function_resume(self, code: types.CodeType, offset, exception=None):
+        """Callback for coroutines resumed by their task (PY_RESUME, or PY_THROW for all the code)"""
+        thread = self._threads.state
+        suspended_at = thread.suspended_at
+        if suspended_at is None:
+            return
+        # Only the outermost coroutine of the stack ends the suspension
+        thread.suspended_at = None
+        if self.is_recording_enabled:
+            self._dispatch(self._record_suspension, thread, suspended_at, datetime.datetime.now())
+
+    def _record_suspension(self, thread: ThreadState, suspended_at: datetime.datetime, resumed_at: datetime.datetime):
+        """Add the time a task spent awaiting to each call of its stack"""
+        duration = (resumed_at - suspended_at).total_seconds()
+        for call in thread.call_stack:
+            if call is None:
+                continue
+            call.awaiting_time = (call.awaiting_time or 0.0) + duration
+            suspensions = call.suspensions or []
+            if len(suspensions) < MAX_SUSPENSIONS:
+                start = (suspended_at - call.start_time).total_seconds()
+                call.suspensions = [*suspensions, [round(start, 6), round(start + duration, 6)]]
+        self.write_buffer.record()
+
+    def _record_return(self, thread: ThreadState, return_captured, return_metadata, end_time, exception_info=None):
+        """Store a captured return value and pop the call from the call stack of its thread.
+
+        Calls ended by an exception have no return value, exception_info holds the
+        type name, message and captured object of the exception instead.
+        """
+        if not thread.call_stack:
+            return
+        # Get the FunctionCall object for this function
+        call = thread.call_stack.pop()
+        if call is None:
+            return
+
+        # Inline capture_return functionality - store return value and update call
+        try:
+            if return_captured is None or isinstance(return_captured, str):
+                # Placeholder reference, or no reference if the type of the value is skipped
+                call.return_ref = return_captured
+            else:
+                call.return_ref = self.object_manager.store_captured(return_captured)
+            if exception_info is not None:
+                call.exception_type, call.exception_message, exception_captured = exception_info
+                if exception_captured is None or isinstance(exception_captured, str):
+                    call.exception_ref = exception_captured
+                else:
+                    call.exception_ref = self.object_manager.store_captured(exception_captured)
+            call.end_time = end_time
+
+            # Update metadata with hook results (if any)
+            if return_metadata:
+                # If there's existing metadata, merge it with the new data
+                if call.call_metadata:
+                    # Create a new dict to avoid modifying the original
+                    updated_metadata = dict(call.call_metadata)
+                    updated_metadata.update(return_metadata)
+                    call.call_metadata = updated_metadata
+                else:
+                    call.call_metadata = return_metadata
+
+            # Clean up snapshot and child counters (performance optimization)
+            if call.id in self._function_snapshot_counts:
+                del self._function_snapshot_counts[call.id]
+            self._parent_call_child_counts.pop(call.id, None)
+            self._last_snapshots.pop(call.id, None)
+            self._last_snapshot_refs.pop(call.id, None)
+
+            # Rows are committed in batches by the write buffer
+            self.write_buffer.record()
+            if self.parent_process_id is not None and not thread.call_stack:
+                # Pool workers are often terminated, a shard commits after each outermost call
+                self.write_buffer.flush()
+            else:
+                self.write_buffer.maybe_flush()
 
-        if processed_functions is None:
-            processed_functions = set()
+        except Exception as e:
+            logger.warning(f"Could not store return value: {e}")
+            self._recover_session()
 
-        accessed_names = set()
+    def _merge_forks(self, block: bool = False):
+        """Store the variables captured by the finished forked children in their snapshots.
 
-        # Scan bytecode for LOAD_GLOBAL operations
-        for instr in dis.get_instructions(code):
-            if instr.opname == "LOAD_GLOBAL":
-                name = instr.argval
-                # Skip special dunder methods
-                if (name.startswith('__') and name.endswith('__')):
-                    continue
-                # Skip built-in variables
-                if name in sys.builtin_module_names:
-                    continue
-                # Skip if it's a default function(like print, len, etc)
-                if name in __builtins__:
-                    continue
+        Args:
+            block: Wait for all the children, otherwise only merge the ones already done
+        """
+        for key, result in self.forks.collect(block):
+            snapshot = self._forked_snapshots.pop(key, None)
+            if snapshot is None or result is None:
+                continue  # Dropped line event, or failed capture
+            try:
+                captured = [
+                    {name: record if isinstance(record, str) else SpooledObject(
+                        record, self.object_manager.pickle_config, self.object_manager.digest
+                    ) for name, record in records.items()}
+                    for records in result
+                ]
+                snapshot.locals_delta = self._store_captured(captured[0])
+                snapshot.globals_delta = self._store_captured(captured[1])
+                snapshot.is_keyframe = True
+                snapshot._full_refs = None
+                self.write_buffer.record(self._refs_size(snapshot.locals_delta) + self._refs_size(snapshot.globals_delta))
+            except Exception as e:
+                logger.error(f"Error merging forked snapshot {snapshot.id}: {e}")
+                logger.error(traceback.format_exc())
+                self._recover_session()
+
+    def _get_accessed_global_names(self, code: types.CodeType):
+        """Extract global names accessed by bytecode (static analysis, cached)"""
+        if code in self._bytecode_cache:
+            return self._bytecode_cache[code]
 
-                accessed_names.add(name)
+        accessed_names = accessed_global_names(code)
 
         # Cache the result (this never changes for a given code object)
         self._bytecode_cache[code] = accessed_names
         return accessed_names
 
-    def _get_object_type_info(self, obj):
-        """Get cached type information for an object"""
-        obj_id = id(obj)
-
-        # Check if we already have type info for this object
-        if obj_id in self._type_cache:
-            return self._type_cache[obj_id]
-
-        # Prevent memory leaks by limiting cache size
-        if len(self._type_cache) >= self._type_cache_max_size:
-            # Clear half the cache (simple LRU approximation)
-            items_to_remove = len(self._type_cache) // 2
-            for _ in range(items_to_remove):
-                self._type_cache.popitem()
-
-        # Determine type info once and cache it
-        type_info = {
-            'is_module': isinstance(obj, types.ModuleType),
-            'is_function': isinstance(obj, types.FunctionType),
-            'should_include': True  # Default to include unless explicitly excluded
-        }
+    def get_used_globals(self, code: types.CodeType, globals: dict, processed_functions=None, accessed_names=None):
+        """Find the global variables used by a code object and by the functions it calls
 
-        # If it's a module, don't include it
-        if type_info['is_module']:
-            type_info['should_include'] = False
-
-        self._type_cache[obj_id] = type_info
-        return type_info
-
-    def get_used_globals(self, code: types.CodeType, globals: dict, processed_functions=None):
-        """Analyze function bytecode to find accessed global variables (optimized version)
+        The (globals, name) pairs reachable from each code object are resolved once
+        (see GlobalsClosure), each call only looks their current values up.
 
         Args:
             code: The code object to analyze
             globals: The globals dictionary
             processed_functions: Set of function names already processed to avoid infinite recursion
+            accessed_names: Global names accessed by code, if already known (e.g. from its capture plan)
 
         Returns:
             Dictionary of global variables used by the function and its called functions
         """
-        if processed_functions is None:
-            processed_functions = set()
-
-        # Step 1: Get the static list of accessed global names (cached)
-        accessed_names = self._get_accessed_global_names(code, processed_functions)
-
-        # Step 2: For each accessed name, get its current value with type caching
-        globals_used = {}
-
-        for name in accessed_names:
-            if name not in globals:
-                continue
-
-            value = globals[name]
-            type_info = self._get_object_type_info(value)
-
-            # Skip modules
-            if type_info['is_module']:
-                continue
-
-            # Handle functions recursively
-            if type_info['is_function']:
-                # Store the function itself if needed
-                # globals_used[name] = value
-
-                # Recursively process function if not already processed
-                if name not in processed_functions:
-                    processed_functions.add(name)
-                    try:
-                        func_code = value.__code__
-                        func_globals = value.__globals__
-                        nested_globals = self.get_used_globals(func_code, func_globals, processed_functions)
-                        globals_used.update(nested_globals)
-                    except AttributeError:
-                        # Handle edge cases where function doesn't have __code__ or __globals__
-                        pass
-                continue
-
-            # Include regular variables
-            if type_info['should_include']:
-                globals_used[name] = value
-
-        return globals_used
+        if processed_functions is not None:
+            # Partial walk, not cached
+            closure = GlobalsClosure(code, globals, self._get_accessed_global_names, accessed_names, processed_functions)
+            return closure.values() or {}
+
+        closure = self._globals_closures.get(code)
+        if closure is not None and closure.globals is globals:
+            globals_used = closure.values()
+            if globals_used is not None:
+                return globals_used
+        # First use, or a function it reaches was rebound
+        closure = GlobalsClosure(code, globals, self._get_accessed_global_names, accessed_names)
+        self._globals_closures[code] = closure
+        return closure.values() or {}
 
     def monitor_callback_line(self, code: types.CodeType, line_number):
         """Callback function for line events"""
+        plan = SpaceTimeMonitor._capture_plans.get(code)
+        if plan is not None and plan.allowed_lines is not None and line_number not in plan.allowed_lines:
+            # Filtered out line, CPython stops reporting this location until set_line_filter() re-arms it
+            return sys.monitoring.DISABLE
+        if self.governor is not None and self.governor.level >= FUNCTION:
+            # Degraded fidelity, lines are re-armed when the governor gets back to full fidelity
+            return sys.monitoring.DISABLE
+
         # Check if recording is enabled
         logger.info(f"Monitoring line: {code.co_name} at line {line_number}")
         if not self.is_recording_enabled:
-            return
+            return None
 
         if self.call_tracker is None:
-            return
+            return None
 
         if self.performance:
             t1 = perf_counter()
 
         current_frame = inspect.currentframe()
         if current_frame is None or current_frame.f_back is None:
-            return
-
-        if (
-            code.co_name in SpaceTimeMonitor._monitored_functions and
-            "lines" in SpaceTimeMonitor._monitored_functions[code.co_name] and
-            SpaceTimeMonitor._monitored_functions[code.co_name]["lines"] is not None and
-            line_number not in SpaceTimeMonitor._monitored_functions[code.co_name]["lines"]
-        ):
-            return
-
-        if (
-            code.co_name in SpaceTimeMonitor._monitored_functions and
-            "use_tag_line" in SpaceTimeMonitor._monitored_functions[code.co_name] and
-            SpaceTimeMonitor._monitored_functions[code.co_name]["use_tag_line"] and
-            "#tag" not in linecache.getline(code.co_filename, line_number)
-        ):
-            return
+            return None
 
         # The parent frame should be the actual function being executed
         frame = current_frame.f_back
 
         try:
-            # Get the current function call from the stack
-            if not self.call_stack:
-                return
-            current_call = self.call_stack[-1]
+            # Lines of calls that were not recorded are ignored
+            thread = self._threads.state
+            if not thread.capture_stack or thread.capture_stack[-1] is None:
+                return None
             if code.co_name in self.skip_one_line_snapshot:
                 self.skip_one_line_snapshot.remove(code.co_name)
-                return
-            # Get function's locals and globals
-            function_locals = {}
-            globals_used = {}
-
-            # Capture locals
-            for name, value in frame.f_locals.items():
-                try:
-                    # Skip special variables and functions
-                    if name.startswith('__') or callable(value):
-                        continue
-                    ref = self.call_tracker.object_manager.store(value)
-                    function_locals[name] = ref
-                    if self.performance:
-                        self.performance_data["line_captured_locals"] += 1
-                except Exception as e:
-                    if self.performance:
-                        self.performance_data["line_failed_serialization"] += 1
-                        self.performance_data["line_failed_type"].add(type(value))
-                    #logger.warning(f"Failed to store local variable {name}: {e}")
-
-            # Capture used globals
-            for name, value in self.get_used_globals(code, frame.f_globals).items():
-                try:
-                    ref = self.call_tracker.object_manager.store(value)
-                    globals_used[name] = ref
-                except Exception as e:
-                    if self.performance:
-                        self.performance_data["line_failed_serialization"] += 1
-                        self.performance_data["line_failed_type"].add(type(value))
-                    #logger.warning(f"Failed to store global variable {name}: {e}")
-
-            # Create a new stack snapshot
-            try:
-                # Get the current snapshot count using in-memory counter (performance optimization)
-                snapshots_count = self._function_snapshot_counts.get(current_call.id, 0)
-
-                self.create_stack_snapshot(
-                    current_call.id,
-                    line_number,
-                    function_locals,
-                    globals_used,
-                    order_in_call=snapshots_count
-                )
-
-                # Increment the snapshot counter for this function call
-                self._function_snapshot_counts[current_call.id] = snapshots_count + 1
-
-                # Log for debugging
-                logger.debug(f"Created stack snapshot for line {line_number} in function {code.co_name}")
+                return None
+            sampler = self._samplers.get(code)
+            if sampler is not None and not sampler.sample_line(line_number):
+                return None
 
-                # Commit to ensure the snapshot is saved
-                self.session.commit()
+            fork_key = None
+            if self._should_summarize():
+                # The writer is behind, only keep the line position
+                function_locals, globals_used = {}, {}
+            elif plan is not None and plan.fork and self.forks.available:
+                # The child captures the variables, they are added to the snapshot when it is merged
+                self._register_identities(frame, code, plan)
+                fork_key = self.forks.spawn(partial(self._capture_line_in_child, frame, code, plan))
+                function_locals, globals_used = {}, {}
+            else:
+                function_locals, globals_used = self._capture_line(frame, code, plan)
 
-            except Exception as e:
-                logger.error(f"Error creating stack snapshot: {e}")
-                logger.error(traceback.format_exc())
-                self.session.rollback()
+            self._dispatch(
+                self._record_line, thread, line_number, function_locals, globals_used, datetime.datetime.now(), fork_key,
+                required=False
+            )
 
         except Exception as e:
             logger.error(f"Error in line monitoring callback: {e}")
@@ -1002,8 +1448,89 @@ class SpaceTimeMonitor:
             t2 = perf_counter()
             elapsed = t2 - t1
             self.performance_data["line_events"].append((code.co_name, elapsed))
+        return None
+
+    def _capture_line(self, frame, code: types.CodeType, plan: CapturePlan | None) -> tuple[dict[str, Any], dict[str, Any]]:
+        """Capture the locals and used globals of a frame at a line event"""
+        accessed_names, ignore = (plan.global_names, plan.ignore) if plan is not None else (None, frozenset())
+        policy = self._get_capture_policy(plan)
+        function_locals = self._capture_variables(frame.f_locals, kind="line", ignore=ignore, policy=policy)
+        globals_used = self._capture_variables(
+            self.get_used_globals(code, frame.f_globals, accessed_names=accessed_names),
+            kind="line", skip_special=False, ignore=ignore, policy=policy
+        )
+        return function_locals, globals_used
+
+    def _register_identities(self, frame, code: types.CodeType, plan: CapturePlan):
+        """Give an identity to the values of a frame before forking, so successive children share it"""
+        identities = self.object_manager.identities
+        variables = [
+            *(value for name, value in frame.f_locals.items() if not name.startswith('__') and not callable(value)),
+            *self.get_used_globals(code, frame.f_globals, accessed_names=plan.global_names).values(),
+        ]
+        for value in variables:
+            if not isinstance(value, _PRIMITIVES):
+                identities.identity_of(value)
+
+    def _capture_line_in_child(self, frame, code: types.CodeType, plan: CapturePlan) -> tuple[dict[str, Any], dict[str, Any]]:
+        """Capture a line event in a forked child (see fork_capture.py)"""
+        self.is_recording_enabled = False
+        # Identities of the objects first captured here must not collide with the parent's
+        self.object_manager.identities.reset_prefix()
+        # Its lock may have been held by another thread when forking, and nothing is captured twice here
+        self.object_manager.change_detector = None
+        return self._capture_line(frame, code, plan)
+
+    def _record_line(self, thread: ThreadState, line_number, locals_captured, globals_captured, timestamp, fork_key=None):
+        """Store a captured line event as a stack snapshot of the current call of its thread"""
+        # Get the current function call from the stack
+        if not thread.call_stack or thread.call_stack[-1] is None:
+            return
+        current_call = thread.call_stack[-1]
+        if fork_key is not None:
+            # The variables of a forked snapshot are complete once merged, it is a keyframe
+            self._last_snapshot_refs.pop(current_call.id, None)
+
+        # Create a new stack snapshot
+        try:
+            function_locals = self._store_captured(locals_captured)
+            globals_used = self._store_captured(globals_captured)
+
+            # Get the current snapshot count using in-memory counter (performance optimization)
+            snapshots_count = self._function_snapshot_counts.get(current_call.id, 0)
+
+            snapshot = self.create_stack_snapshot(
+                current_call.id,
+                line_number,
+                function_locals,
+                globals_used,
+                order_in_call=snapshots_count,
+                timestamp=timestamp,
+                call=current_call
+            )
+            if fork_key is not None and snapshot is not None:
+                self._forked_snapshots[fork_key] = snapshot
+                # The next snapshot can't be stored as changes against this one before the merge
+                self._last_snapshot_refs.pop(current_call.id, None)
+                self._merge_forks()
+
+            # Increment the snapshot counter for this function call
+            self._function_snapshot_counts[current_call.id] = snapshots_count + 1
 
-def pymonitor(mode="function", ignore=None, start_hooks=None, return_hooks=None, track=None, lines=None, use_tag_line=False):
+            # Log for debugging
+            logger.debug(f"Created stack snapshot for line {line_number} in function {current_call.function}")
+
+            # Rows are committed in batches by the write buffer
+            self.write_buffer.maybe_flush()
+
+        except Exception as e:
+            logger.error(f"Error creating stack snapshot: {e}")
+            logger.error(traceback.format_exc())
+            self._recover_session()
+
+def pymonitor(mode="function", ignore=None, start_hooks=None, return_hooks=None, track=None, lines=None, use_tag_line=False,
+              sample_every=None, line_sample_every=None, max_calls_per_second=None,
+              max_size=None, max_length=None, max_depth=None, fork=False):
     """
     Unified decorator for monitoring Python function execution.
 
@@ -1021,6 +1548,22 @@ def pymonitor(mode="function", ignore=None, start_hooks=None, return_hooks=None,
             outside a monitored context. Defaults to None.
         lines (list[int], optional): Specific line numbers to monitor within the function if mode is "line". Defaults to None (monitor all lines).
         use_tag_line (bool, optional): If True and mode is "line", only monitor lines containing the comment "#tag". Defaults to False.
+        sample_every (int, optional): Record only 1 call in N, the other calls are counted but not recorded.
+            Defaults to None (use the monitor's policy, see init_monitoring).
+        line_sample_every (int, optional): In line mode, record a line only every Kth time it runs.
+            Defaults to None (use the monitor's policy).
+        max_calls_per_second (int, optional): Maximum number of calls recorded per second.
+            Defaults to None (use the monitor's policy).
+        max_size (int, optional): Maximum serialized size in bytes of a captured value.
+            Defaults to None (use the monitor's limit, see init_monitoring).
+        max_length (int, optional): Maximum length of a captured container or string.
+            Defaults to None (use the monitor's limit).
+        max_depth (int, optional): Maximum nesting depth of a captured value.
+            Defaults to None (use the monitor's limit).
+        fork (bool, optional): In line mode, capture each line snapshot in a forked child process
+            while the function continues, the variables are stored when the child is merged back
+            (see fork_capture.py). Meant for a few chosen lines (lines or use_tag_line) of functions
+            holding very large values. Ignored where os.fork is not available. Defaults to False.
 
     Returns:
         The decorated function with monitoring enabled
@@ -1047,6 +1590,13 @@ def pymonitor(mode="function", ignore=None, start_hooks=None, return_hooks=None,
     if mode not in ["function", "line"]:
         raise ValueError(f"Invalid monitoring mode: {mode}. Must be 'function' or 'line'")
 
+    sampling = None
+    if sample_every is not None or line_sample_every is not None or max_calls_per_second is not None:
+        sampling = SamplingPolicy(sample_every, line_sample_every, max_calls_per_second)
+    capture_policy = None
+    if max_size is not None or max_length is not None or max_depth is not None:
+        capture_policy = CapturePolicy(max_size, max_length, max_depth)
+
     def _decorator(func):
         # Add logging to see which function is being decorated
         logger.info(f"Applying pymonitor decorator to function: {func.__name__}")
@@ -1055,51 +1605,58 @@ def pymonitor(mode="function", ignore=None, start_hooks=None, return_hooks=None,
         if sys.monitoring.get_tool(MONITOR_TOOL_ID) is None:
             sys.monitoring.use_tool_id(MONITOR_TOOL_ID, "py_monitoring")
 
-        # Set events based on mode
-        if mode == "line":
-            events = (sys.monitoring.events.LINE |
-                     sys.monitoring.events.PY_START |
-                     sys.monitoring.events.PY_RETURN)
-        else:  # mode == "function"
-            events = sys.monitoring.events.PY_START | sys.monitoring.events.PY_RETURN
-
-        # Enable monitoring for this function
-        sys.monitoring.set_local_events(MONITOR_TOOL_ID, func.__code__, events)
-
-        # Store metadata on the function object
-        SpaceTimeMonitor._monitored_functions[func.__name__] = {
-            "ignore": ignore,
-            "start_hooks": start_hooks,
-            "return_hooks": return_hooks,
-            "tracked_functions": track,
-            "lines": lines,  # Specific lines to monitor if in line mode
-            "use_tag_line": use_tag_line  # Whether to only monitor lines with #tag
-        }
+        # Enable monitoring for this function, with the suspensions of coroutines
+        sys.monitoring.set_local_events(MONITOR_TOOL_ID, func.__code__, monitored_events(func.__code__, mode))
+
+        # Precompute what the callbacks capture for this code object
+        replaced_plan = SpaceTimeMonitor._capture_plans.get(func.__code__)
+        SpaceTimeMonitor._capture_plans[func.__code__] = CapturePlan(
+            func,
+            mode=mode,
+            ignore=ignore,
+            start_hooks=start_hooks,
+            return_hooks=return_hooks,
+            lines=lines,  # Specific lines to monitor if in line mode
+            use_tag_line=use_tag_line,  # Whether to only monitor lines with #tag
+            sampling=sampling,
+            capture_policy=capture_policy,
+            fork=fork
+        )
+        if replaced_plan is not None and replaced_plan.allowed_lines is not None:
+            # Lines disabled under the previous filter must be reported again
+            sys.monitoring.restart_events()
 
         # Also enable monitoring for tracked functions
         for tracked_func in track:
             if callable(tracked_func):
-                # Mark the tracked function with the parent that's tracking it
+                if not hasattr(tracked_func, '__code__'):
+                    logger.warning(f"Tracked function {tracked_func.__name__} has no __code__ attribute, skipping monitoring")
+                    continue
 
-                SpaceTimeMonitor._tracked_functions[tracked_func.__name__] = {
-                    "parent_tracking_function": func.__name__
-                }
-
-                if tracked_func.__name__ not in SpaceTimeMonitor._monitored_functions:
-                    SpaceTimeMonitor._monitored_functions[tracked_func.__name__] = {
-                        "ignore": [],
-                        "start_hooks": [],
-                        "return_hooks": [],
-                        "tracked_functions": []
-                    }
+                # Mark the tracked function with the parent that's tracking it
+                tracked_plan = SpaceTimeMonitor._capture_plans.get(tracked_func.__code__)
+                if tracked_plan is None:
+                    tracked_plan = CapturePlan(tracked_func)
+                    SpaceTimeMonitor._capture_plans[tracked_func.__code__] = tracked_plan
+                tracked_plan.tracked_by = func.__name__
                 logger.info(f"Enabling monitoring for tracked function: {tracked_func.__name__} (tracked by {func.__name__})")
 
                 # Use function mode for tracked functions to avoid overhead
-                tracked_events = sys.monitoring.events.PY_START | sys.monitoring.events.PY_RETURN
-                if not hasattr(tracked_func, '__code__'):
-                    logger.warning(f"Tracked function {tracked_func.__name__} has no __code__ attribute, skipping monitoring")
-                    continue
-                sys.monitoring.set_local_events(MONITOR_TOOL_ID, tracked_func.__code__, tracked_events)
+                sys.monitoring.set_local_events(MONITOR_TOOL_ID, tracked_func.__code__, monitored_events(tracked_func.__code__))
+
+        # Functions decorated while recording is paused stay silent until it resumes
+        monitor = SpaceTimeMonitor.get_instance()
+        if monitor is None:
+            # Spawned child of a process recording into shards
+            monitor = monitor_from_environment(SpaceTimeMonitor)
+        if monitor is not None and not monitor.is_recording_enabled:
+            monitor._pause_code(func.__code__)
+            for tracked_func in track:
+                if hasattr(tracked_func, '__code__'):
+                    monitor._pause_code(tracked_func.__code__)
+        elif monitor is not None:
+            # The first monitored function turns the exception events on
+            monitor._update_global_events()
 
         return func
 
@@ -1182,14 +1739,106 @@ def line(ignore=None, start_hooks=None, return_hooks=None, track=None, lines=Non
                      return_hooks=return_hooks, track=track, lines=lines, use_tag_line=use_tag_line)
 
 
+def set_line_filter(func, lines=None, use_tag_line=False):
+    """
+    Change which lines of a line-monitored function are recorded.
+
+    Line locations filtered out are disabled in sys.monitoring, this re-arms
+    them so that the new filter applies to every line.
+
+    Args:
+        func (callable): A function decorated with pymonitor.
+        lines (list[int], optional): Line numbers to monitor. Defaults to None (monitor all lines).
+        use_tag_line (bool, optional): If True, only monitor lines containing the comment "#tag". Defaults to False.
+
+    Raises:
+        ValueError: If the function is not monitored.
+
+    Example:
+        @pymonitor(mode="line", use_tag_line=True)
+        def process_items(items):
+            ...
+
+        set_line_filter(process_items, lines=[12, 13])
+    """
+    plan = SpaceTimeMonitor._capture_plans.get(getattr(func, '__code__', None))
+    if plan is None:
+        raise ValueError(f"Function {getattr(func, '__name__', func)} is not monitored, decorate it with pymonitor first")
+    plan.set_line_filter(lines, use_tag_line)
+    sys.monitoring.restart_events()
+
+
 def init_monitoring(*args, **kwargs):
     """
     Initialize the monitoring system.
 
     Args:
         db_path (str, optional): Path to the database file. Defaults to "monitoring.db".
-        queue_size (int, optional): Size of the monitoring queue. Defaults to 1000.
-        flush_interval (float, optional): Interval for flushing the queue. Defaults to 1.0.
+        flush_rows (int, optional): Number of buffered rows that triggers a write to the database. Defaults to 1000.
+        flush_bytes (int, optional): Approximate size in bytes of buffered rows that triggers a write. Defaults to 8 MiB.
+        flush_interval (float, optional): Maximum time in seconds rows stay buffered before being written.
+            Checked on each monitoring event. Defaults to 1.0.
+        pipeline (bool, optional): Store the recorded values from a background writer thread, the
+            monitored code only captures them. Defaults to False.
+        queue_size (int, optional): Maximum number of events waiting for the writer thread. Defaults to 1000.
+        backpressure (str, optional): What to do when the queue is full: "block" waits for the writer,
+            "drop" drops line events and calls (their lines and returns included), "summary" records
+            events without their variables. Defaults to "block".
+        sample_every (int, optional): Record only 1 call in N of each monitored function, the other calls
+            are counted in the session metadata but not recorded. Defaults to None (record every call).
+        line_sample_every (int, optional): Record a line snapshot only every Kth time a given line runs.
+            Defaults to None (record every line).
+        max_calls_per_second (int, optional): Maximum number of calls recorded per second for each monitored
+            function. Defaults to None (no limit).
+            These three settings can be overridden per function with pymonitor.
+        max_overhead (float, optional): Maximum share of the wall time spent recording, e.g. 0.1 for 10%.
+            Above it the capture fidelity is lowered step by step (no line snapshots, then arguments only,
+            then sampled calls) and raised again when there is headroom. The changes are saved in the session
+            metadata under "governor". Defaults to None (always full fidelity).
+        governor_window (float, optional): Length in seconds of the overhead measurement window. Defaults to 1.0.
+        keyframe_every (int, optional): Store the full variable references every N line snapshots of a call,
+            the snapshots in between only store the changed and removed variables. Defaults to 10.
+        strict_capture (bool, optional): Pickle every captured object, even when its fingerprint shows it
+            didn't change since its last capture. Slower, for auditing recordings. Defaults to False.
+            Fingerprints only sample 16 elements of a container and 3 levels of nesting, without strict
+            capture a change outside of them is recorded up to 100 captures of the object late (the
+            object is recorded unchanged in between).
+        digest (str, optional): Digest of the object references of a new database: "blake2b", "sha256",
+            "md5" or "xxh3_128" (needs the xxhash package). Existing databases keep the digest they were
+            created with. Defaults to "xxh3_128" if xxhash is installed, "blake2b" otherwise.
+        delta_encoding (bool, optional): Store the new versions of lists, dicts and plain objects as patches
+            against their previous version, with a full version every 20. Smaller databases, at the cost of
+            loading each new version once when storing it. Defaults to False.
+        compression (str, optional): Compress the stored states: "zlib" or "lzma". Small states and states
+            that don't get smaller are stored uncompressed. Existing databases can be recompressed with
+            `spacetimepy recompress`. Defaults to None (no compression).
+        compression_level (int, optional): zlib level or lzma preset. Defaults to the codec default.
+        compression_dictionaries (bool, optional): Train a zlib dictionary on the first states of each type,
+            used to compress the next ones. Defaults to False.
+        max_size (int, optional): Maximum serialized size in bytes of a captured value. Larger values are
+            stored as a summary (type, length, shape, a sample of elements and a fingerprint hash), marked
+            with StoredObject.is_summary. The size is estimated before pickling, from a sample of the
+            elements of containers. Defaults to None (no limit).
+        max_length (int, optional): Maximum length of a captured container or string, longer ones are
+            summarized. Defaults to None (no limit).
+        max_depth (int, optional): Maximum nesting depth of containers and objects in a captured value,
+            deeper ones are summarized. Defaults to None (no limit).
+            These three limits can be overridden per function with pymonitor.
+        type_strategies (dict, optional): How the values of some types are captured, checked before pickling
+            them: "skip" (not recorded), "repr" (stored as a summary holding their repr) or a reduce function
+            added to the pickle dispatch table, e.g. {socket.socket: "repr"}. Types whose values fail to
+            pickle are also remembered and reported "<unserializable>" without trying again, except every
+            1000 values. Defaults to None.
+        max_forks (int, optional): Maximum number of forked children capturing line snapshots at the same
+            time for the functions monitored with fork=True, a new snapshot waits for the oldest child.
+            Defaults to 2.
+        fork_spool_dir (str, optional): Directory where the forked children write their captures until
+            they are merged. Defaults to the system temporary directory.
+        shard_processes (bool, optional): Record each child process (multiprocessing workers, os.fork) into its
+            own shard next to the database, monitoring.<pid>.db for monitoring.db, with the settings of the
+            parent. Monitoring must be initialized before the children start. The shards are combined with
+            `spacetimepy merge`, which links the sessions of the children to the session of their parent.
+            Defaults to False.
         pickle_config (PickleConfig, optional): Custom pickle configuration for serializing objects.
             This can include custom reducers for specific types. Defaults to None.
         custom_picklers (list, optional): List of module names to load custom picklers from.
@@ -1219,5 +1868,31 @@ def _cleanup_monitoring():
     if SpaceTimeMonitor._instance is not None:
         SpaceTimeMonitor._instance.shutdown()
 
+
+def _start_shard_in_child():
+    """Record a forked child into its own shard, if its parent records into shards"""
+    parent = SpaceTimeMonitor._instance
+    # The children capturing forked snapshots don't record anything
+    if parent is None or not parent.shard_processes or parent.forks.forking:
+        return
+    session = parent.current_session
+    try:
+        monitor = start_shard(SpaceTimeMonitor, parent.config, os.getppid(),
+                              session.id if session is not None else None, session.name if session is not None else None)
+    except Exception as e:
+        logger.error(f"Could not start recording the child process: {e}")
+        return
+    # The connection of the parent is never used, closed or rolled back by the child
+    monitor._parent_monitor = parent
+    # multiprocessing clears the exit hooks of its children after forking, they are registered again
+    multiprocessing.util.register_after_fork(monitor, _register_shard_exit)
+
+
+def _register_shard_exit(monitor):
+    multiprocessing.util.Finalize(None, monitor.shutdown, exitpriority=10)
+
+
 atexit.register(_cleanup_monitoring)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_start_shard_in_child)
 
@@ -0,0 +1,134 @@
+"""
+In-process index of the objects stored in the database.
+
+Storing a value needs to know whether its state is already stored and which
+version number its identity is at. The ObjectIndex keeps both in memory so
+the ObjectManager only queries the database for what the index doesn't know.
+"""
+
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .models import ObjectChunk, ObjectIdentity, StoredObject
+
+logger = logging.getLogger(__name__)
+
+
+class ObjectIndex:
+    """Known object references, chunks and identity versions, with LRU eviction.
+
+    The index is complete when it contains every stored object and identity:
+    a reference it doesn't know is then new and needs no query. It starts
+    complete if the database is small enough to be loaded, and stops being
+    complete once an entry is evicted.
+
+    Args:
+        max_refs: Maximum number of object references kept
+        max_identities: Maximum number of identities kept
+        max_chunks: Maximum number of chunk IDs kept
+    """
+
+    def __init__(self, max_refs: int = 100_000, max_identities: int = 100_000, max_chunks: int = 100_000):
+        self.max_refs = max_refs
+        self.max_identities = max_identities
+        self.max_chunks = max_chunks
+        self.complete = False
+        self._refs: OrderedDict[str, None] = OrderedDict()
+        self._chunks: OrderedDict[str, None] = OrderedDict()
+        # identity_hash -> (identity_id, latest version number)
+        self._identities: OrderedDict[str, tuple[int, int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def load(self, session: Session):
+        """Load the stored objects and identities if they fit in the index"""
+        with session.no_autoflush:
+            ref_count = session.query(func.count(StoredObject.id)).scalar() or 0
+            identity_count = session.query(func.count(ObjectIdentity.id)).scalar() or 0
+            chunk_count = session.query(func.count(ObjectChunk.id)).scalar() or 0
+            if ref_count > self.max_refs or identity_count > self.max_identities or chunk_count > self.max_chunks:
+                logger.debug(f"{ref_count} objects stored, the object index won't be complete")
+                self.complete = False
+                return
+
+            self._refs = OrderedDict.fromkeys(ref for (ref,) in session.query(StoredObject.id))
+            self._chunks = OrderedDict.fromkeys(chunk_id for (chunk_id,) in session.query(ObjectChunk.id))
+            versions = session.query(
+                ObjectIdentity.identity_hash, ObjectIdentity.id, func.max(StoredObject.version_number)
+            ).outerjoin(StoredObject, StoredObject.identity_id == ObjectIdentity.id).group_by(ObjectIdentity.id)
+            self._identities = OrderedDict(
+                (identity_hash, (identity_id, version or 0)) for identity_hash, identity_id, version in versions
+            )
+        self.complete = True
+
+    def has_ref(self, ref: str) -> bool:
+        """Return True if an object with this reference is known to be stored"""
+        if ref in self._refs:
+            self._refs.move_to_end(ref)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def knows_ref(self, ref: str) -> bool:
+        """Same as has_ref without counting or reordering, for the threads capturing values"""
+        return ref in self._refs
+
+    def add_ref(self, ref: str):
+        """Remember that an object is stored"""
+        self._refs[ref] = None
+        self._refs.move_to_end(ref)
+        if len(self._refs) > self.max_refs:
+            self._refs.popitem(last=False)
+            self._evicted()
+
+    def has_chunk(self, chunk_id: str) -> bool:
+        """Return True if a chunk is known to be stored"""
+        if chunk_id in self._chunks:
+            self._chunks.move_to_end(chunk_id)
+            return True
+        return False
+
+    def add_chunk(self, chunk_id: str):
+        """Remember that a chunk is stored"""
+        self._chunks[chunk_id] = None
+        self._chunks.move_to_end(chunk_id)
+        if len(self._chunks) > self.max_chunks:
+            self._chunks.popitem(last=False)
+            self._evicted()
+
+    def get_identity(self, identity_hash: str) -> tuple[int, int] | None:
+        """Get the ID and latest version number of an identity, None if unknown"""
+        state = self._identities.get(identity_hash)
+        if state is not None:
+            self._identities.move_to_end(identity_hash)
+        return state
+
+    def set_identity(self, identity_hash: str, identity_id: int, version: int):
+        """Remember the ID and latest version number of an identity"""
+        self._identities[identity_hash] = (identity_id, version)
+        self._identities.move_to_end(identity_hash)
+        if len(self._identities) > self.max_identities:
+            self._identities.popitem(last=False)
+            self._evicted()
+
+    def clear(self):
+        """Forget everything, e.g. after a rollback"""
+        self._refs.clear()
+        self._chunks.clear()
+        self._identities.clear()
+        self.complete = False
+
+    def stats(self) -> dict[str, int]:
+        """Hits and misses of the reference lookups, and evicted entries"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "refs": len(self._refs)}
+
+    def _evicted(self):
+        self.evictions += 1
+        if self.complete:
+            logger.debug("Object index full, unknown objects will be looked up in the database")
+            self.complete = False
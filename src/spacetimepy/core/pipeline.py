@@ -0,0 +1,106 @@
+"""
+Background storage pipeline for the monitor.
+
+In pipeline mode the monitoring callbacks only capture the state of the frame
+(serialized values, line numbers, timestamps) and enqueue it. A writer thread
+consumes the queue and does the hashing, deduplication and database writes,
+so the monitored thread does not wait on SQLAlchemy.
+"""
+
+import logging
+import queue
+import threading
+import traceback
+from collections.abc import Callable
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+BACKPRESSURE_POLICIES = ("block", "drop", "summary")
+
+
+class RecordingPipeline:
+    """Bounded queue of monitoring events consumed by a single writer thread.
+
+    Events are ``(function, args)`` tuples applied in order by the writer
+    thread while holding ``lock``. When the queue is full, the backpressure
+    policy decides what happens:
+
+    - ``"block"``: the monitored thread waits for room in the queue
+    - ``"drop"``: optional events are dropped, required ones still wait
+    - ``"summary"``: the monitor captures a cheaper summary of the event
+      (see ``SpaceTimeMonitor``), which then waits for room in the queue
+    """
+
+    def __init__(self, lock: threading.RLock, queue_size: int = 1000, backpressure: str = "block"):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Invalid backpressure policy: {backpressure}. Must be one of {BACKPRESSURE_POLICIES}")
+        self.lock = lock
+        self.backpressure = backpressure
+        self._queue: queue.Queue[tuple[Callable[..., Any], tuple] | None] = queue.Queue(maxsize=queue_size)
+
+        self.stats = {
+            "submitted": 0,
+            "processed": 0,
+            "dropped": 0,
+            "degraded": 0,
+            "errors": 0,
+        }
+
+        self._thread = threading.Thread(target=self._run, name="spacetimepy-writer", daemon=True)
+        self._thread.start()
+
+    def is_full(self) -> bool:
+        """Return True if submitting an event would hit the backpressure policy"""
+        return self._queue.full()
+
+    def submit(self, func: Callable[..., Any], *args, required: bool = True) -> bool:
+        """Enqueue an event for the writer thread.
+
+        Args:
+            func: Function applied by the writer thread
+            *args: Arguments passed to func
+            required: Whether the event can be dropped under the "drop" policy
+
+        Returns:
+            True if the event was enqueued, False if it was dropped
+        """
+        if self.backpressure == "drop" and not required:
+            try:
+                self._queue.put_nowait((func, args))
+            except queue.Full:
+                self.stats["dropped"] += 1
+                return False
+        else:
+            self._queue.put((func, args))
+        self.stats["submitted"] += 1
+        return True
+
+    def drain(self):
+        """Wait until every enqueued event has been applied"""
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def stop(self):
+        """Apply the remaining events and stop the writer thread"""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            try:
+                if event is None:
+                    return
+                func, args = event
+                with self.lock:
+                    func(*args)
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Error applying monitoring event in writer thread: {e}")
+                logger.error(traceback.format_exc())
+            finally:
+                self._queue.task_done()
@@ -167,7 +167,7 @@ def execute_function_call(
             # Control recording based on enable_monitoring parameter
             if monitor_instance and not enable_monitoring:
                 original_recording_state = monitor_instance.is_recording_enabled
-                monitor_instance.is_recording_enabled = False
+                monitor_instance.disable_recording()
 
             # Create a FunctionCallRepository for reading data
             call_repository = FunctionCallRepository(session)
@@ -234,8 +234,8 @@ def execute_function_call(
 
         finally:
             # Restore original recording state if it was changed
-            if monitor_instance and original_recording_state is not None:
-                monitor_instance.is_recording_enabled = original_recording_state
+            if monitor_instance and original_recording_state:
+                monitor_instance.enable_recording()
 
 
 def load_snapshot(
@@ -538,7 +538,7 @@ def replay_session_sequence(
         original_parent_id_for_next_call = monitor_instance._parent_id_for_next_call
         if not enable_monitoring:
             original_recording_state = monitor_instance.is_recording_enabled
-            monitor_instance.is_recording_enabled = False
+            monitor_instance.disable_recording()
 
     try:
         # 1. Load Starting State (using read_session)
@@ -591,6 +591,8 @@ def replay_session_sequence(
 
         # Check if the call was actually recorded by the monitor (only if monitoring enabled)
         if enable_monitoring and monitor_instance:
+            # Make sure a pipeline writer thread has stored the call
+            monitor_instance.flush()
             first_replayed_call_id = monitor_instance._current_session_last_call_id
             if monitor_instance._parent_id_for_next_call is not None:
                 # This means the flag wasn't reset by monitor_callback_function_start,
@@ -696,7 +698,7 @@ def replay_session_sequence(
             logger.info(
                 f"Committing monitor session to save replayed calls (starting from {first_replayed_call_id})."
             )
-            monitor_instance.session.commit()
+            monitor_instance.flush()
             logger.info("Replay sequence committed.")
 
         return first_replayed_call_id  # Return ID of the start of the new branch
@@ -719,8 +721,8 @@ def replay_session_sequence(
                 monitor_instance._parent_id_for_next_call = (
                     original_parent_id_for_next_call
                 )
-            if original_recording_state is not None:
-                monitor_instance.is_recording_enabled = original_recording_state
+            if original_recording_state:
+                monitor_instance.enable_recording()
         # Close the separate read session
         read_session.commit()
         assert monitor_instance is not None
@@ -786,7 +788,7 @@ def replay_session_subsequence(
         original_parent_id_for_next_call = monitor_instance._parent_id_for_next_call
         if not enable_monitoring:
             original_recording_state = monitor_instance.is_recording_enabled
-            monitor_instance.is_recording_enabled = False
+            monitor_instance.disable_recording()
 
     try:
         # 1. Load Starting State (using read_session)
@@ -839,6 +841,8 @@ def replay_session_subsequence(
 
         # Check if the call was actually recorded by the monitor (only if monitoring enabled)
         if enable_monitoring and monitor_instance:
+            # Make sure a pipeline writer thread has stored the call
+            monitor_instance.flush()
             first_replayed_call_id = monitor_instance._current_session_last_call_id
             if monitor_instance._parent_id_for_next_call is not None:
                 # This means the flag wasn't reset by monitor_callback_function_start,
@@ -948,7 +952,7 @@ def replay_session_subsequence(
             logger.info(
                 f"Committing monitor session to save replayed calls (starting from {first_replayed_call_id})."
             )
-            monitor_instance.session.commit()
+            monitor_instance.flush()
             logger.info("Replay sequence committed.")
 
         return first_replayed_call_id  # Return ID of the start of the new branch
@@ -971,8 +975,8 @@ def replay_session_subsequence(
                 monitor_instance._parent_id_for_next_call = (
                     original_parent_id_for_next_call
                 )
-            if original_recording_state is not None:
-                monitor_instance.is_recording_enabled = original_recording_state
+            if original_recording_state:
+                monitor_instance.enable_recording()
         # Close the separate read session
         read_session.commit()
         assert monitor_instance is not None
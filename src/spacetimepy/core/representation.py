@@ -6,31 +6,89 @@ import io
 import logging
 import pickle
 import sys
+import threading
+from collections import OrderedDict
 from collections.abc import Mapping, Sequence
 from enum import Enum
 from pathlib import Path
 from typing import Any, TypeVar
 
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
-from .models import CodeDefinition, CodeObjectLink, ObjectIdentity, StoredObject
+from .arrays import (
+    array_ref,
+    decode_frame,
+    encode_frame,
+    is_array,
+    is_array_frame,
+    split_array,
+    writable,
+)
+from .capture_policy import CapturePolicy, ValueSummary, repr_summary
+from .chunking import CHUNK_THRESHOLD, split_chunks, split_fixed
+from .compression import Compressor, decompress
+from .delta import apply_patch, make_patch, supports_delta
+from .digest import LEGACY_DIGEST, Digest, get_digest
+from .identity import IdentityRegistry
+from .models import (
+    CodeDefinition,
+    CodeObjectLink,
+    CompressionDictionary,
+    DatabaseInfo,
+    ObjectChunk,
+    ObjectIdentity,
+    StoredObject,
+)
+from .object_index import ObjectIndex
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Delta encoding: a full state every N versions, and number of identities whose last state is kept
+DELTA_FULL_EVERY = 20
+DELTA_MAX_BASES = 1000
+# Number of states rebuilt from patches kept to rebuild the next versions
+RECONSTRUCTED_CACHE_SIZE = 256
+
 class ObjectType(Enum):
     PRIMITIVE = "primitive"
     LIST = "list"
     DICT = "dict"
     CUSTOM = "custom"
+    ARRAY = "array"
+    SUMMARY = "summary"
 
 T = TypeVar('T')
 
+def _find_class(module_name, qualname):
+    """Load a class by module and qualified name, used to pickle classes under another module path"""
+    obj = importlib.import_module(module_name)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+class _ModulePathPickler(pickle.Pickler):
+    """Pickler saving a class under another module path, without changing the class"""
+    def __init__(self, file, cls, module_path):
+        super().__init__(file)
+        self.cls = cls
+        self.module_path = module_path
+
+    def reducer_override(self, obj):
+        if obj is self.cls:
+            return _find_class, (self.module_path, obj.__qualname__)
+        return NotImplemented
+
 class PickleConfig:
     """Configuration for custom pickling behavior"""
     def __init__(self, dispatch_table=None, custom_picklers=None):
         self.dispatch_table = dispatch_table or copyreg.dispatch_table.copy()
+        # Pickler and buffer of each thread, reused by dumps()
+        self._local = threading.local()
+        # Trained compression dictionaries by ID, and a function loading the missing ones
+        self.dictionaries: dict[int, bytes] = {}
+        self.dictionary_loader = None
 
         # Load custom picklers if specified
         if custom_picklers:
@@ -99,35 +157,64 @@ class PickleConfig:
 
     def dumps(self, obj, correct_module_path=None):
         """Pickle an object with custom reducers and optional module path normalization"""
-        # Handle module path normalization for custom classes
-        original_modules = {}
-        if correct_module_path and hasattr(obj, '__class__'):
-            cls = obj.__class__
-            if hasattr(cls, '__module__') and cls.__module__ != correct_module_path:
-                original_modules[cls] = cls.__module__
-                cls.__module__ = correct_module_path
-                logger.debug(f"Temporarily changed {cls.__name__}.__module__ from {original_modules[cls]} to {correct_module_path}")
+        # Save the class of the object under the given module path
+        cls = type(obj)
+        if correct_module_path and getattr(cls, '__module__', correct_module_path) != correct_module_path:
+            try:
+                f = io.BytesIO()
+                pickler = _ModulePathPickler(f, cls, correct_module_path)
+                if self.dispatch_table:
+                    pickler.dispatch_table = self.dispatch_table
+                pickler.dump(obj)
+                return f.getvalue()
+            except pickle.PicklingError: # Ignore unpicklable objects
+                return None
 
+        # Reuse the pickler and buffer of this thread, creating a pickler costs more than pickling small objects
+        local = self._local
+        reusable = getattr(local, 'reusable', None)
+        if reusable is None or reusable[2] is not self.dispatch_table:
+            buffer = io.BytesIO()
+            reusable = (buffer, self.create_pickler(buffer), self.dispatch_table)
+        buffer, pickler, _ = reusable
+        local.reusable = None  # A reducer calling dumps() gets its own pickler
         try:
-            f = io.BytesIO()
-            pickler = self.create_pickler(f)
             pickler.dump(obj)
-            return f.getvalue()
+            return buffer.getvalue()
         except pickle.PicklingError: # Ignore unpicklable objects
             return None
         finally:
-            # Restore original module paths
-            for cls, original_module in original_modules.items():
-                cls.__module__ = original_module
-                logger.debug(f"Restored {cls.__name__}.__module__ to {original_module}")
+            # Release the pickled objects and the data
+            pickler.clear_memo()
+            buffer.seek(0)
+            buffer.truncate()
+            local.reusable = reusable
 
     def loads(self, data, correct_module_path=None):
-        """Unpickle an object with optional module path fixing"""
+        """Unpickle an object with optional module path fixing, decompressing it if needed"""
+        data = self.decompress(data)
+        if is_array_frame(data):
+            # Rebuild the array over the payload, without copying its data
+            meta, buffers = decode_frame(data)
+            return pickle.loads(meta, buffers=buffers)
         f = io.BytesIO(data)
         unpickler = self.create_unpickler(f, correct_module_path)
         return unpickler.load()
 
 
+    def decompress(self, data):
+        """Decompress a stored payload (see compression.py), uncompressed ones are returned as is"""
+        return decompress(data, self._get_dictionary)
+
+    def _get_dictionary(self, dict_id):
+        dictionary = self.dictionaries.get(dict_id)
+        if dictionary is None and self.dictionary_loader is not None:
+            dictionary = self.dictionary_loader(dict_id)
+            if dictionary is not None:
+                self.dictionaries[dict_id] = dictionary
+        return dictionary
+
+
 class ModulePathFixingUnpickler(pickle.Unpickler):
     """Custom unpickler that fixes module path mismatches using stored metadata"""
 
@@ -169,11 +256,15 @@ class ModulePathFixingUnpickler(pickle.Unpickler):
 
 class Object:
     """Represent an object at a certain state in the program"""
-    def __init__(self, value: Any, pickle_config: PickleConfig | None = None):
+    def __init__(self, value: Any, pickle_config: PickleConfig | None = None, digest: Digest | None = None):
         self.value = value
+        self.value_type = type(value)
         self.type = self._get_type()
         self._hash = None
+        self._data: bytes | None = None
+        self._identity: str | None = None
         self.pickle_config = pickle_config or PickleConfig()
+        self.digest = digest or get_digest(LEGACY_DIGEST)
 
     def _get_type(self) -> ObjectType:
         """Determine the type of the object"""
@@ -192,15 +283,9 @@ class Object:
                 "type": self.type.value,
                 "value": self.value
             }
-        if self.type in (ObjectType.LIST, ObjectType.DICT):
-            return {
-                "type": self.type.value,
-                "value": self.pickle_config.dumps(self.value).hex() # type: ignore
-            }
-        # Custom type
         return {
             "type": self.type.value,
-            "value": self.pickle_config.dumps(self.value).hex() # type: ignore
+            "value": self.data().hex() # type: ignore
         }
 
     @classmethod
@@ -217,43 +302,132 @@ class Object:
         """Return a string representation of the object"""
         return str(self.value)
 
+    def data(self) -> bytes | None:
+        """Return the pickled state of the object, serializing it on first use"""
+        if self._data is None and self.type != ObjectType.PRIMITIVE:
+            data = self.pickle_config.dumps(self.value)
+            if data is None:
+                raise pickle.PicklingError(f"Cannot pickle object of type {self.value_type.__name__}")
+            self._data = data
+        return self._data
+
+    def capture(self) -> 'Object':
+        """Freeze the current state of the object so it can be stored later.
+
+        The state is serialized immediately and the live value is released, so
+        the object can safely be handed to another thread for storage.
+        """
+        if self.type != ObjectType.PRIMITIVE:
+            if self._identity is None:
+                self._identity = str(id(self.value))
+            self.data()
+            self.value = None
+        return self
+
     def ref(self) -> str:
         """Return a reference to the object"""
         if self._hash is None:
             if self.type == ObjectType.PRIMITIVE:
                 self._hash = str(self.value)
             else:
-                self._hash = hashlib.md5(self.pickle_config.dumps(self.value)).hexdigest() # type: ignore
+                self._hash = self.digest(self.data()) # type: ignore
         return self._hash
 
 class Primitive(Object):
     """Represent a primitive value at a certain state in the program"""
-    def __init__(self, value: int | float | bool | str | None, pickle_config: PickleConfig | None = None):
-        super().__init__(value, pickle_config)
+    def __init__(self, value: int | float | bool | str | None, pickle_config: PickleConfig | None = None, digest: Digest | None = None):
+        super().__init__(value, pickle_config, digest)
         if not isinstance(value, int | float | bool | str | type(None)):
             raise TypeError("Primitive objects can only store primitive types")
 
 class List(Object):
     """Represent a list at a certain state in the program"""
-    def __init__(self, value: list, pickle_config: PickleConfig | None = None):
-        super().__init__(value, pickle_config)
+    def __init__(self, value: list, pickle_config: PickleConfig | None = None, digest: Digest | None = None):
+        super().__init__(value, pickle_config, digest)
         if not isinstance(value, list):
             raise TypeError("List objects can only store lists")
 
 class DictObject(Object):
     """Represent a dictionary at a certain state in the program"""
-    def __init__(self, value: dict, pickle_config: PickleConfig | None = None):
-        super().__init__(value, pickle_config)
+    def __init__(self, value: dict, pickle_config: PickleConfig | None = None, digest: Digest | None = None):
+        super().__init__(value, pickle_config, digest)
         if not isinstance(value, dict):
             raise TypeError("DictObject objects can only store dictionaries")
 
 class CustomClass(Object):
     """Represent a custom class at a certain state in the program"""
-    def __init__(self, value: Any, pickle_config: PickleConfig | None = None):
-        super().__init__(value, pickle_config)
+    def __init__(self, value: Any, pickle_config: PickleConfig | None = None, digest: Digest | None = None):
+        super().__init__(value, pickle_config, digest)
         if isinstance(value, int | float | bool | str | type(None) | list | dict):
             raise TypeError("CustomClass objects cannot store primitive or structured types")
 
+class ArrayObject(Object):
+    """Represent a NumPy array at a certain state in the program (see arrays.py)
+
+    The reference is hashed over the buffer of the array, its data is only
+    copied when the state must be stored.
+    """
+    def __init__(self, value: Any, pickle_config: PickleConfig | None = None, digest: Digest | None = None):
+        super().__init__(value, pickle_config, digest)
+        if not is_array(value):
+            raise TypeError("ArrayObject objects can only store NumPy arrays")
+        self._parts: tuple[bytes, list[memoryview]] | None = None
+        self._uncopied = False
+
+    def _get_type(self) -> ObjectType:
+        return ObjectType.ARRAY
+
+    def _split(self) -> tuple[bytes, list[memoryview]]:
+        """Pickle of the array without its data, and views on its buffers"""
+        if self._parts is None:
+            self._parts = split_array(self.value, self.pickle_config.dispatch_table)
+        return self._parts
+
+    def data(self) -> bytes | None:
+        """Return the stored payload of the array, copying its data on first use
+
+        Raises:
+            ValueError: If the array was captured without a copy and changed since
+        """
+        if self._data is None:
+            parts = self._split()
+            if self._uncopied and array_ref(*parts, self.digest) != self._hash:
+                raise ValueError("The array changed since its state was captured, and that state is no longer stored")
+            self._data = encode_frame(*parts)
+        return self._data
+
+    def capture(self, stored: bool = False) -> 'Object':
+        """Freeze the current state of the array, see Object.capture
+
+        Args:
+            stored: The state is already stored, the data isn't copied. The
+                array is kept until the capture is stored, in case the stored
+                state is rolled back in between.
+        """
+        self.ref()  # Hashed over the live buffer before it is copied
+        if stored:
+            self._uncopied = True
+        else:
+            super().capture()
+        self._parts = None
+        return self
+
+    def ref(self) -> str:
+        """Return a reference to the array, computed without copying it"""
+        if self._hash is None:
+            meta, buffers = self._split() if self._data is None else decode_frame(self._data)
+            self._hash = array_ref(meta, buffers, self.digest)
+        return self._hash
+
+class SummaryObject(Object):
+    """Represent a value too large to be captured, or captured by its repr only, by its ValueSummary (see capture_policy.py)"""
+    def __init__(self, value: Any, summary: ValueSummary, pickle_config: PickleConfig | None = None, digest: Digest | None = None):
+        super().__init__(summary, pickle_config, digest)
+        self.value_type = type(value)  # Stored under the type of the summarized value
+
+    def _get_type(self) -> ObjectType:
+        return ObjectType.SUMMARY
+
 class ObjectManager:
     """Manage objects in the program"""
     def __init__(self, session: Session, pickle_config: PickleConfig | None = None):
@@ -267,14 +441,70 @@ class ObjectManager:
             logger.warning("CodeManager/ClassLoader not available, code tracking disabled")
             self.code_manager = None
             self.class_loader = None
-        self._obj_cache = []
+        # Identity of the live objects, stable until they are collected
+        self.identities = IdentityRegistry()
+        # Objects already stored and latest version of each identity, to avoid querying for them
+        self.index = ObjectIndex()
+        self._index_loaded = False
+        # Optional WriteBuffer and IdAllocator used by the monitor to batch commits
+        self.write_buffer = None
+        self.id_allocator = None
+        # Optional ChangeDetector used by the monitor to skip capturing unchanged objects
+        self.change_detector = None
+        # Store new versions of lists, dicts and plain objects as patches against the previous one
+        self.delta_encoding = False
+        self._delta_bases: OrderedDict[int, tuple[str, Any, int]] = OrderedDict()  # identity_id -> (ref, value, patches since the last full state)
+        self._reconstructed: OrderedDict[str, bytes] = OrderedDict()  # ref -> pickled state rebuilt from patches
+        # Optional Compressor of the stored states and chunks
+        self.compressor: Compressor | None = None
+        self._dictionaries_loaded = False
+        self.pickle_config.dictionary_loader = self._load_dictionary
+        # Rows added since the last commit, the database can't see them without a flush
+        self._pending_objects: dict[str, StoredObject] = {}
+        self._pending_identities: dict[str, ObjectIdentity] = {}
+        self._pending_versions: dict[int, int] = {}  # identity_id -> latest version number
+        self._pending_chunks: set[str] = set()
+        # Code definition reference of each custom class (None if its source is unavailable)
+        self._class_code_refs: dict[type, str | None] = {}
+        # Digest of the object references, recorded in the database
+        self.digest = self._load_digest()
+
+    def _load_digest(self) -> Digest:
+        """Get the digest used for the object references of the database"""
+        with self.session.no_autoflush:
+            info = self.session.get(DatabaseInfo, "object_digest")
+        name = info.value if info is not None else LEGACY_DIGEST
+        try:
+            return get_digest(name)
+        except ValueError as e:
+            # The references of new objects won't match the ones of the same states already stored
+            logger.warning(f"{e}, new objects will use {LEGACY_DIGEST}")
+            return get_digest(LEGACY_DIGEST)
+
+    def clear_pending(self, committed: bool = True):
+        """Forget the rows added since the last commit, once committed or rolled back"""
+        if not committed:
+            # The rolled back rows must be stored again, reload the index from the database
+            self.index.clear()
+            self._index_loaded = False
+            self._delta_bases.clear()
+            self._class_code_refs.clear()
+            if self.compressor is not None:
+                # Dictionaries trained since the last commit were rolled back with the states using them
+                self.compressor.clear_dictionaries()
+                self._dictionaries_loaded = False
+        self._pending_objects.clear()
+        self._pending_identities.clear()
+        self._pending_versions.clear()
+        self._pending_chunks.clear()
 
     def _get_identity(self, obj: Object) -> str:
         """Get the identity of an object (independent of its state)"""
         if obj.type == ObjectType.PRIMITIVE:
             return obj.ref()  # For primitives, ref is the identity
-        # For non-primitives, identity is based on object id
-        return str(id(obj.value))
+        if obj._identity is not None:
+            return obj._identity  # Captured object, the live value is gone
+        return self.identities.identity_of(obj.value)
 
     def _get_correct_module_path_for_object(self, stored_obj: StoredObject) -> str | None:
         """Get the correct module path for an object from stored metadata"""
@@ -289,47 +519,81 @@ class ObjectManager:
             logger.debug(f"Could not get module path for object {stored_obj.id}: {e}")
         return None
 
+    def _find_object(self, ref: str) -> StoredObject | None:
+        """Find a stored object by reference, including the ones not written yet"""
+        stored_obj = self._pending_objects.get(ref)
+        if stored_obj is None:
+            with self.session.no_autoflush:
+                stored_obj = self.session.query(StoredObject).filter(StoredObject.id == ref).first()
+        return stored_obj
+
+    def _get_identity_state(self, identity_hash: str, name: str) -> tuple[int, int]:
+        """Get the ID and latest version number of an identity, creating the identity if needed"""
+        state = self.index.get_identity(identity_hash)
+        if state is not None:
+            return state
+
+        identity = self._pending_identities.get(identity_hash)
+        if identity is None and not self.index.complete and not self.identities.is_new(identity_hash):
+            with self.session.no_autoflush:
+                identity = self.session.query(ObjectIdentity).filter(ObjectIdentity.identity_hash == identity_hash).first()
+        if identity is None:
+            identity = self._create_identity(identity_hash, name)
+            state = (identity.id, 0)
+        else:
+            state = (identity.id, self._latest_version_number(identity.id))
+
+        self.index.set_identity(identity_hash, *state)
+        return state
+
+    def _create_identity(self, identity_hash: str, name: str) -> ObjectIdentity:
+        """Create the identity record of an object"""
+        identity = ObjectIdentity(
+            identity_hash=identity_hash,
+            name=name,
+            creation_time=datetime.datetime.now()
+        )
+        if self.id_allocator is not None:
+            self.id_allocator.assign(identity)
+            self.session.add(identity)
+            self._pending_identities[identity_hash] = identity
+        else:
+            self.session.add(identity)
+            self.session.flush()  # Ensure identity gets an ID
+        self.identities.persisted(identity_hash)
+        return identity
+
+    def _latest_version_number(self, identity_id: int) -> int:
+        """Get the version number of the latest state of an identity, 0 if it has none"""
+        latest = self._pending_versions.get(identity_id)
+        if latest is None:
+            with self.session.no_autoflush:
+                latest = self.session.query(func.max(StoredObject.version_number)).filter(
+                    StoredObject.identity_id == identity_id
+                ).scalar()
+        return latest or 0
+
     def _store_object(self, obj: Object) -> StoredObject:
         """Store an object in the database"""
         ref = obj.ref()
 
-        # Check if object already exists
-        stored_obj = self.session.query(StoredObject).filter(StoredObject.id == ref).first()
-        if stored_obj:
-            return stored_obj
+        # Check if object already exists, a complete index knows all of them
+        if not self.index.complete:
+            stored_obj = self._find_object(ref)
+            if stored_obj:
+                return stored_obj
 
         # Get or create an identity for the object
         identity_hash = self._get_identity(obj)
-        identity = self.session.query(ObjectIdentity).filter(ObjectIdentity.identity_hash == identity_hash).first()
-
-        if not identity:
-            identity = ObjectIdentity(
-                identity_hash=identity_hash,
-                name=type(obj.value).__name__
-            )
-            self.session.add(identity)
-            self.session.flush()  # Ensure identity gets an ID
-
-        # For custom objects, determine the correct module path for consistent storage
-        correct_module_path = None
-        if obj.type == ObjectType.CUSTOM and hasattr(obj.value, '__class__'):
-            cls = obj.value.__class__
-            if hasattr(cls, '__module__'):
-                # Normalize __main__ to the actual module name if we can determine it
-                if cls.__module__ == "__main__":
-                    # Try to find a better module name from the file path or other context
-                    # For now, we'll store as __main__ but this could be enhanced
-                    correct_module_path = "__main__"
-                else:
-                    correct_module_path = cls.__module__
+        identity_id, latest_version = self._get_identity_state(identity_hash, obj.value_type.__name__)
 
         # Create new stored object
         if obj.type == ObjectType.PRIMITIVE:
             stored_obj = StoredObject(
                 id=ref,
-                identity_id=identity.id,
-                version_number=1,  # First version
-                type_name=type(obj.value).__name__,  # Store actual type name (int, float, etc.)
+                identity_id=identity_id,
+                version_number=1,  # Primitives have a single state
+                type_name=obj.value_type.__name__,  # Store actual type name (int, float, etc.)
                 is_primitive=True,
                 primitive_value=str(obj.value)
             )
@@ -341,36 +605,172 @@ class ObjectManager:
                 actual_type_name = 'dict'
             else:
                 # For custom types, get the actual class name
-                actual_type_name = obj.value.__class__.__name__
-
-            # Use the correct module path for pickling if available
-            pickle_data = self.pickle_config.dumps(obj.value, correct_module_path)
+                actual_type_name = obj.value_type.__name__
+
+            # Reuse the serialized state used to compute the reference
+            pickle_data = obj.data()
+            encoding = base_ref = None
+            if self.delta_encoding:
+                delta = self._make_delta(identity_id, ref, pickle_data) # type: ignore
+                if delta is not None:
+                    encoding = "delta"
+                    base_ref, pickle_data = delta
+            # Large states are stored as chunks, of fixed size for arrays which are modified in place
+            chunk_refs = None
+            if len(pickle_data) >= CHUNK_THRESHOLD: # type: ignore
+                chunk_refs = self._store_chunks(pickle_data, fixed_size=obj.type == ObjectType.ARRAY) # type: ignore
 
             stored_obj = StoredObject(
                 id=ref,
-                identity_id=identity.id,
-                version_number=1,  # First version
+                identity_id=identity_id,
+                version_number=latest_version + 1,  # New state of this identity
                 type_name=actual_type_name,  # Use the actual class name instead of our representation type
                 is_primitive=False,
-                pickle_data=pickle_data
+                pickle_data=None if chunk_refs else self._compress(pickle_data, actual_type_name), # type: ignore
+                chunk_refs=chunk_refs,
+                encoding=encoding,
+                base_ref=base_ref,
+                is_summary=obj.type == ObjectType.SUMMARY
             )
 
         # Add to session
         self.session.add(stored_obj)
-        self.session.flush()
+        self.index.set_identity(identity_hash, identity_id, stored_obj.version_number)
+        if self.write_buffer is not None:
+            self._pending_objects[ref] = stored_obj
+            self._pending_versions[identity_id] = stored_obj.version_number
+            self.write_buffer.record(len(stored_obj.pickle_data or b""))
+        else:
+            self.session.flush()
 
         # If it's a custom class and we have a code manager, store the class definition
         if (obj.type == ObjectType.CUSTOM and self.code_manager is not None and
-            not isinstance(obj.value, int | float | bool | str | list | dict | type(None))):
+            not issubclass(obj.value_type, int | float | bool | str | list | dict | type(None))):
             try:
-                code_ref = self.code_manager.store_class(type(obj.value))
+                if obj.value_type not in self._class_code_refs:
+                    self._class_code_refs[obj.value_type] = self.code_manager.store_class(obj.value_type)
+                code_ref = self._class_code_refs[obj.value_type]
                 if code_ref:
-                    self.code_manager.link_object(ref, code_ref)
+                    # The object is new, it can't be linked yet
+                    self.code_manager.link_object(ref, code_ref, check_existing=False)
             except Exception as e:
                 logger.warning(f"Error storing class definition: {e}")
 
         return stored_obj
 
+    def _store_chunks(self, data: bytes, fixed_size: bool = False) -> list[str]:
+        """Store the chunks of a large state that aren't stored yet and return their IDs"""
+        chunk_refs = []
+        for chunk in split_fixed(data) if fixed_size else split_chunks(data):
+            chunk_id = self.digest(chunk)
+            chunk_refs.append(chunk_id)
+            if self.index.has_chunk(chunk_id) or chunk_id in self._pending_chunks:
+                continue
+            if not self.index.complete:
+                with self.session.no_autoflush:
+                    if self.session.query(ObjectChunk.id).filter(ObjectChunk.id == chunk_id).first() is not None:
+                        self.index.add_chunk(chunk_id)
+                        continue
+
+            data = self._compress(chunk)
+            stored_chunk = ObjectChunk(id=chunk_id, data=data, compressed=data is not chunk)
+            self.session.add(stored_chunk)
+            self.index.add_chunk(chunk_id)
+            if self.write_buffer is not None:
+                self._pending_chunks.add(chunk_id)
+                self.write_buffer.record(len(stored_chunk.data))
+        return chunk_refs
+
+    def _make_delta(self, identity_id: int, ref: str, data: bytes) -> tuple[str, bytes] | None:
+        """Encode a new state as a patch against the previous state of its identity.
+
+        Returns:
+            The reference of the previous state and the pickled patch, None to store the full state
+        """
+        try:
+            value = self.pickle_config.loads(data)
+        except Exception as e:
+            logger.debug(f"Could not load state {ref} to encode it as a delta: {e}")
+            self._delta_bases.pop(identity_id, None)
+            return None
+        if not supports_delta(value):
+            return None
+
+        delta = None
+        depth = 0
+        base = self._delta_bases.get(identity_id)
+        # Store a full state every DELTA_FULL_EVERY versions to bound the reconstruction
+        if base is not None and base[2] < DELTA_FULL_EVERY:
+            base_ref, base_value, base_depth = base
+            patch = make_patch(base_value, value)
+            patch_data = self.pickle_config.dumps(patch) if patch is not None else None
+            # Only worth it if the patch is much smaller than the state
+            if patch_data is not None and len(patch_data) < len(data) // 2:
+                delta = (base_ref, patch_data)
+                depth = base_depth + 1
+
+        self._delta_bases[identity_id] = (ref, value, depth)
+        self._delta_bases.move_to_end(identity_id)
+        if len(self._delta_bases) > DELTA_MAX_BASES:
+            self._delta_bases.popitem(last=False)
+        return delta
+
+    def _compress(self, data: bytes, type_name: str | None = None) -> bytes:
+        """Compress a payload before storing it, storing the dictionaries trained meanwhile"""
+        compressor = self.compressor
+        if compressor is None:
+            return data
+        if compressor.dictionaries and not self._dictionaries_loaded:
+            # Keep using the dictionaries of the database
+            with self.session.no_autoflush:
+                for dictionary in self.session.query(CompressionDictionary):
+                    compressor.add_dictionary(dictionary.type_name, dictionary.id, dictionary.data)
+                    self.pickle_config.dictionaries[dictionary.id] = dictionary.data
+            self._dictionaries_loaded = True
+
+        compressed = compressor.compress(data, type_name)
+        for dict_id, dict_type_name, dictionary in compressor.take_new_dictionaries():
+            self.session.add(CompressionDictionary(id=dict_id, type_name=dict_type_name, data=dictionary))
+            self.pickle_config.dictionaries[dict_id] = dictionary
+        return compressed
+
+    def _load_dictionary(self, dict_id: int) -> bytes | None:
+        """Load a compression dictionary from the database"""
+        with self.session.no_autoflush:
+            dictionary = self.session.get(CompressionDictionary, dict_id)
+        return dictionary.data if dictionary is not None else None
+
+    def _load_data(self, stored_obj: StoredObject) -> bytes | None:
+        """Get the pickled state of a stored object, reassembling its chunks and applying its patch if needed"""
+        chunk_refs = stored_obj.chunk_refs
+        if not chunk_refs:
+            data = self.pickle_config.decompress(stored_obj.pickle_data)
+        else:
+            chunks = {
+                chunk_id: self.pickle_config.decompress(chunk_data) if compressed else chunk_data
+                for chunk_id, chunk_data, compressed in self.session.query(
+                    ObjectChunk.id, ObjectChunk.data, ObjectChunk.compressed
+                ).filter(ObjectChunk.id.in_(set(chunk_refs)))
+            }
+            data = b"".join(chunks[chunk_id] for chunk_id in chunk_refs)
+        if stored_obj.encoding != "delta":
+            return data
+
+        # Rebuild the state from the previous one, keeping the recent ones for the next versions
+        full_data = self._reconstructed.get(stored_obj.id)
+        if full_data is None:
+            base = self.session.query(StoredObject).filter(StoredObject.id == stored_obj.base_ref).first()
+            if base is None:
+                raise ValueError(f"Previous state {stored_obj.base_ref} of {stored_obj.id} not found")
+            base_value = self.pickle_config.loads(self._load_data(base))
+            full_data = self.pickle_config.dumps(apply_patch(base_value, self.pickle_config.loads(data)))
+            self._reconstructed[stored_obj.id] = full_data # type: ignore
+            if len(self._reconstructed) > RECONSTRUCTED_CACHE_SIZE:
+                self._reconstructed.popitem(last=False)
+        else:
+            self._reconstructed.move_to_end(stored_obj.id)
+        return full_data
+
     def store_code_definition(self, name: str, type: str, module_path: str, code_content: str, first_line_no: int | None = None) -> str:
         """Store a code definition and return its ID"""
         # Create a hash of the code content as the ID
@@ -394,86 +794,96 @@ class ObjectManager:
         self.session.flush()
         return code_hash
 
-    def store(self, value: Any) -> str:
-        """Store an object and return its reference"""
-        # Create appropriate Object instance
+    def _make_object(self, value: Any) -> Object:
+        """Create the appropriate Object instance for a value"""
         if isinstance(value, int | float | bool | str | type(None)):
-            obj = Primitive(value, pickle_config=self.pickle_config)
-        elif isinstance(value, list):
-            obj = List(value, pickle_config=self.pickle_config)
-        elif isinstance(value, dict):
-            obj = DictObject(value, pickle_config=self.pickle_config)
-        else:
-            obj = CustomClass(value, pickle_config=self.pickle_config)
-
-        ref = obj.ref()
+            return Primitive(value, pickle_config=self.pickle_config, digest=self.digest)
+        if isinstance(value, list):
+            return List(value, pickle_config=self.pickle_config, digest=self.digest)
+        if isinstance(value, dict):
+            return DictObject(value, pickle_config=self.pickle_config, digest=self.digest)
+        if is_array(value):
+            return ArrayObject(value, pickle_config=self.pickle_config, digest=self.digest)
+        return CustomClass(value, pickle_config=self.pickle_config, digest=self.digest)
 
-        if ref in self._obj_cache:
-            return ref
+    def capture(self, value: Any, policy: CapturePolicy | None = None) -> Object:
+        """Capture the current state of a value without touching the database.
 
-        identity = self._get_identity(obj)
+        The returned object can be passed to store_captured() later, possibly
+        from another thread, even if the value has been modified in between.
 
-        # Store the object
-        stored_obj = self._store_object(obj)
+        Args:
+            value: The value to capture
+            policy: Size limits above which a summary of the value is captured instead
 
-        # Handle versioning for non-primitive types
+        Raises:
+            Exception: If the value cannot be serialized
+        """
+        if isinstance(value, int | float | bool | type(None)):
+            return self._capture_object(value)
+        if policy is not None:
+            reason = policy.check(value)
+            if reason is not None:
+                return self._capture_summary(value, policy.summarize(value, reason))
+
+        if self.change_detector is None or isinstance(value, str):
+            captured = self._capture_object(value)
+        else:
+            # Reuse the previous capture if the value didn't change since
+            identity = self.identities.identity_of(value)
+            captured, key = self.change_detector.lookup(value, identity)
+            if captured is None:
+                captured = self._capture_object(value)
+                if key is not None:
+                    self.change_detector.remember(value, identity, key, captured)
+
+        if policy is not None and captured.type not in (ObjectType.PRIMITIVE, ObjectType.ARRAY):
+            # The size was underestimated, the pickled state is dropped (the size of arrays is exact)
+            size = len(captured.data()) # type: ignore
+            reason = policy.check_size(size)
+            if reason is not None:
+                return self._capture_summary(value, policy.summarize(value, reason, size))
+        return captured
+
+    def capture_repr(self, value: Any) -> Object:
+        """Capture a value by its repr only, without pickling it (see type_strategies.py)"""
+        return self._capture_summary(value, repr_summary(value))
+
+    def _capture_summary(self, value: Any, summary: ValueSummary) -> Object:
+        """Capture the summary stored instead of a value"""
+        obj = SummaryObject(value, summary, pickle_config=self.pickle_config, digest=self.digest)
+        # The summaries of a large string aren't versions of a live object, and it must not be kept alive
+        obj._identity = obj.ref() if isinstance(value, str) else self.identities.identity_of(value)
+        return obj.capture()
+
+    def _capture_object(self, value: Any) -> Object:
+        """Capture a value along with the identity of the live object"""
+        obj = self._make_object(value)
         if obj.type != ObjectType.PRIMITIVE:
-            # Get or create identity record
-            identity_record = self.session.query(ObjectIdentity).filter(
-                ObjectIdentity.identity_hash == identity
-            ).first()
-
-            if not identity_record:
-                identity_record = ObjectIdentity(
-                    identity_hash=identity,
-                    creation_time=datetime.datetime.now()
-                )
-                self.session.add(identity_record)
-                try:
-                    self.session.flush()
-                except SQLAlchemyError as e:
-                    logger.warning(f"Error creating identity: {e}")
-                    self.session.rollback()
-                    identity_record = self.session.query(ObjectIdentity).filter(
-                        ObjectIdentity.identity_hash == identity
-                    ).first()
-                    if not identity_record:
-                        raise
-
-            # Check if this exact state already exists in the version history
-            existing_version = self.session.query(StoredObject).filter(
-                StoredObject.identity_id == identity_record.id,
-                StoredObject.id == stored_obj.id
-            ).first()
+            obj._identity = self.identities.identity_of(value)
+        if isinstance(obj, ArrayObject):
+            # The data of an array is only copied if its state isn't stored yet
+            return obj.capture(stored=self.index.knows_ref(obj.ref()))
+        return obj.capture()
 
-            if existing_version:
-                # This exact state already exists, return its reference
-                if ref not in self._obj_cache:
-                    self._obj_cache.append(ref)
-                return ref
-
-            # Get latest version number
-            latest_version = self.session.query(StoredObject).filter(
-                StoredObject.identity_id == identity_record.id
-            ).order_by(StoredObject.version_number.desc()).first()
+    def store(self, value: Any) -> str:
+        """Store an object and return its reference"""
+        return self.store_captured(self._make_object(value))
 
-            # No need to create a version record, as StoredObject now includes versioning
-            # Just set the version number on the stored_obj
-            new_version_num = 1
-            if latest_version:
-                new_version_num = latest_version.version_number + 1
-            setattr(stored_obj, 'version_number', new_version_num)
+    def store_captured(self, obj: Object) -> str:
+        """Store an Object (live or captured) and return its reference"""
+        ref = obj.ref()
 
-            try:
-                self.session.flush()
-            except SQLAlchemyError as e:
-                logger.warning(f"Error creating version: {e}")
-                self.session.rollback()
-                raise
+        if not self._index_loaded:
+            self.index.load(self.session)
+            self._index_loaded = True
+        if self.index.has_ref(ref):
+            return ref
 
-        if ref not in self._obj_cache:
-            self._obj_cache.append(ref)
+        # Store the object, a new state of a non-primitive gets the next version number
+        self._store_object(obj)
 
+        self.index.add_ref(ref)
         return ref
 
     def get(self, ref: str) -> tuple[Any, str]:
@@ -497,12 +907,13 @@ class ObjectManager:
             if stored_obj.type_name == 'NoneType':
                 return None, 'NoneType'
             raise ValueError(f"Unknown primitive type: {stored_obj.type_name}")
+        pickle_data = self._load_data(stored_obj)
         try:
             # Get the correct module path from stored metadata
             correct_module_path = self._get_correct_module_path_for_object(stored_obj)
 
             # Use the module path fixing unpickler
-            return self.pickle_config.loads(stored_obj.pickle_data, correct_module_path), stored_obj.type_name # type: ignore
+            return self.pickle_config.loads(pickle_data, correct_module_path), stored_obj.type_name # type: ignore
         except (ImportError, AttributeError, ModuleNotFoundError) as e:
             # First try to load the class using the stored code if available
             if self.class_loader is not None and self.code_manager is not None:
@@ -519,7 +930,7 @@ class ObjectManager:
                             if stored_obj.type_name in namespace:
                                 # Try unpickling again now that we have recreated the class
                                 correct_module_path = self._get_correct_module_path_for_object(stored_obj)
-                                return self.pickle_config.loads(stored_obj.pickle_data, correct_module_path), stored_obj.type_name # type: ignore
+                                return self.pickle_config.loads(pickle_data, correct_module_path), stored_obj.type_name # type: ignore
                             # Store the code info for the UnpickleableObject
                             self._last_code_info = code_info
                 except Exception as loader_e:
@@ -567,7 +978,7 @@ class ObjectManager:
                         }
                     return None
 
-            return UnpickleableObject(stored_obj.type_name, stored_obj.pickle_data,
+            return UnpickleableObject(stored_obj.type_name, pickle_data,
                                     getattr(self, '_last_code_info', None)), stored_obj.type_name # type: ignore
         except Exception as e:
             logger.error(f"Unexpected error unpickling object of type {stored_obj.type_name}: {e}")
@@ -649,7 +1060,8 @@ class ObjectManager:
             ref: The reference to the stored object
 
         Returns:
-            The rehydrated object
+            The rehydrated object, arrays are writable copies. Values that were too large
+            to be captured are rehydrated as their ValueSummary.
 
         Raises:
             ValueError: If the reference is invalid or object cannot be rehydrated
@@ -657,9 +1069,12 @@ class ObjectManager:
         if ref is None:
             return None
         try:
-            return self.get(ref)[0]
+            value = writable(self.get(ref)[0])
         except Exception as e:
             raise ValueError(f"Could not rehydrate object with reference {ref}: {e}")
+        if isinstance(value, ValueSummary):
+            logger.warning(f"Only a summary of {ref} was recorded, it is replayed incomplete: {value!r}")
+        return value
 
     def rehydrate_dict(self, refs: Mapping[str, str | None]) -> dict[str, Any]:
         """
@@ -0,0 +1,93 @@
+"""
+Statistical sampling of monitored calls and lines.
+
+A sampling policy can be set for all monitored functions (init_monitoring) or
+per function (pymonitor). Calls that are not sampled are counted but not
+recorded; the calls they make attach to the nearest recorded ancestor.
+"""
+
+from time import perf_counter
+
+
+class SamplingPolicy:
+    """Which calls and line executions of a function are recorded.
+
+    Args:
+        sample_every: Record 1 call in N
+        line_sample_every: Record a line snapshot every Kth time a given line runs
+        max_calls_per_second: Maximum number of calls recorded per second
+
+    Raises:
+        ValueError: If one of the values is not a positive integer
+    """
+
+    FIELDS = ("sample_every", "line_sample_every", "max_calls_per_second")
+
+    def __init__(self, sample_every: int | None = None, line_sample_every: int | None = None,
+                 max_calls_per_second: int | None = None):
+        for name, value in zip(self.FIELDS, (sample_every, line_sample_every, max_calls_per_second), strict=True):
+            if value is not None and (not isinstance(value, int) or value < 1):
+                raise ValueError(f"{name} must be a positive integer, got {value!r}")
+        self.sample_every = sample_every
+        self.line_sample_every = line_sample_every
+        self.max_calls_per_second = max_calls_per_second
+
+    def is_active(self) -> bool:
+        """Return True if the policy skips anything"""
+        return ((self.sample_every or 1) > 1 or (self.line_sample_every or 1) > 1
+                or self.max_calls_per_second is not None)
+
+    def merged(self, defaults: 'SamplingPolicy | None') -> 'SamplingPolicy':
+        """Return this policy with its unset values taken from defaults"""
+        if defaults is None:
+            return self
+        return SamplingPolicy(*(
+            getattr(self, name) if getattr(self, name) is not None else getattr(defaults, name)
+            for name in self.FIELDS
+        ))
+
+    def __repr__(self) -> str:
+        values = ", ".join(f"{name}={getattr(self, name)}" for name in self.FIELDS if getattr(self, name) is not None)
+        return f"SamplingPolicy({values})"
+
+
+class Sampler:
+    """Sampling state of one monitored function"""
+
+    def __init__(self, policy: SamplingPolicy):
+        self.policy = policy
+        self.calls = 0
+        self.recorded = 0
+        self._line_hits: dict[int, int] = {}
+        self._window_start = 0.0
+        self._window_calls = 0
+
+    def sample_call(self) -> bool:
+        """Count a call and return True if it should be recorded"""
+        self.calls += 1
+        policy = self.policy
+        if policy.sample_every is not None and (self.calls - 1) % policy.sample_every:
+            return False
+        if policy.max_calls_per_second is not None:
+            now = perf_counter()
+            if now - self._window_start >= 1.0:
+                self._window_start = now
+                self._window_calls = 0
+            if self._window_calls >= policy.max_calls_per_second:
+                return False
+            self._window_calls += 1
+        self.recorded += 1
+        return True
+
+    def sample_line(self, line_number: int) -> bool:
+        """Count an execution of a line and return True if it should be recorded"""
+        every = self.policy.line_sample_every
+        if every is None:
+            return True
+        hits = self._line_hits.get(line_number, 0)
+        self._line_hits[line_number] = hits + 1
+        return hits % every == 0
+
+    def stats(self) -> dict[str, int]:
+        """Number of calls seen and recorded"""
+        return {"calls": self.calls, "recorded": self.recorded}
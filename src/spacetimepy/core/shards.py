@@ -0,0 +1,261 @@
+"""
+Per-process shards of a recording, and their merge into one database.
+
+Processes can't share a monitoring database: SQLite serializes the writers,
+and an in-memory database is only exported by the process that created it.
+With shard_processes=True, each child process of the monitored program
+records into its own shard next to the database of its parent,
+monitoring.<pid>.db for monitoring.db:
+
+- forked children (multiprocessing "fork" start method, os.fork) replace the
+  monitor they inherited by a new one writing to their shard;
+- children started from scratch ("spawn" and "forkserver" start methods) find
+  the configuration of their parent in the SPACETIMEPY_SHARD environment
+  variable, their monitor is created when the first monitored function is
+  defined. Only the JSON serializable settings are passed this way.
+
+Each child records a session linked to the session of its parent through its
+metadata (process_id, parent_process_id, parent_session_id). The rows of a
+shard are committed each time the outermost monitored call of a thread
+returns, pool workers are often terminated without running any exit hook.
+
+merge_databases() (`spacetimepy merge`) copies shards into one database. The
+integer IDs of calls, snapshots, sessions and identities are shifted past the
+ones of the target, the content addressed rows (stored objects, chunks,
+compression dictionaries, code definitions) are only added if missing, and
+the sessions of children get the merged ID of their parent session in
+MonitoringSession.parent_session_id.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from typing import Any
+
+from .models import init_db
+
+logger = logging.getLogger(__name__)
+
+# Configuration of the parent process for the children started from scratch
+SHARD_ENV = "SPACETIMEPY_SHARD"
+
+
+def shard_path(db_path: str, pid: int) -> str:
+    """Path of the shard of a process, next to the database of the parent"""
+    if db_path == ":memory:":
+        db_path = "monitoring.db"
+    root, ext = os.path.splitext(db_path)
+    return f"{root}.{pid}{ext or '.db'}"
+
+
+def share_config(monitor: Any):
+    """Publish the configuration and session of a monitor to its future children"""
+    config = {}
+    for name, value in monitor.config.items():
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            logger.debug(f"Setting {name} is not passed to spawned children")
+            continue
+        config[name] = value
+    session = monitor.current_session
+    os.environ[SHARD_ENV] = json.dumps({
+        "config": config,
+        "process_id": os.getpid(),
+        "session_id": session.id if session is not None else None,
+        "session_name": session.name if session is not None else None,
+    })
+
+
+def start_shard(monitor_class: type, config: dict[str, Any], parent_process_id: int,
+                parent_session_id: int | None = None, parent_session_name: str | None = None) -> Any:
+    """Start recording the current child process into its own shard.
+
+    Args:
+        monitor_class: SpaceTimeMonitor
+        config: Settings of the monitor of the parent process
+        parent_process_id: PID of the parent process
+        parent_session_id: Session of the parent when the child started, if any
+        parent_session_name: Name of that session, reused by the session of the child
+
+    Returns:
+        The monitor of the child process
+    """
+    pid = os.getpid()
+    config = dict(config, db_path=shard_path(config.get("db_path", "monitoring.db"), pid), in_memory=False)
+    monitor = monitor_class(**config)
+    monitor.parent_process_id = parent_process_id
+    monitor.start_session(parent_session_name, f"Process {pid}", {
+        "parent_process_id": parent_process_id,
+        "parent_session_id": parent_session_id,
+    })
+    logger.info(f"Recording process {pid} into {config['db_path']}")
+    return monitor
+
+
+def monitor_from_environment(monitor_class: type) -> Any:
+    """Start the shard of a spawned child from the configuration of its parent, None if there's none"""
+    shared = os.environ.get(SHARD_ENV)
+    if not shared:
+        return None
+    try:
+        parent = json.loads(shared)
+    except ValueError:
+        logger.warning(f"Ignoring the invalid {SHARD_ENV} environment variable")
+        return None
+    if parent["process_id"] == os.getpid():
+        return None
+    return start_shard(monitor_class, parent["config"], parent["process_id"], parent["session_id"], parent["session_name"])
+
+
+# Integer IDs shifted when merging, with the columns referencing them
+_ID_COLUMNS = {
+    "function_calls": {"id": "function_calls", "parent_call_id": "function_calls", "session_id": "monitoring_sessions",
+                       "first_snapshot_id": "stack_snapshots"},
+    "stack_snapshots": {"id": "stack_snapshots", "function_call_id": "function_calls", "next_snapshot_id": "stack_snapshots"},
+    "monitoring_sessions": {"id": "monitoring_sessions", "parent_session_id": "monitoring_sessions"},
+}
+
+# Content addressed tables, a row already in the target is the same row
+_CONTENT_TABLES = ("object_chunks", "compression_dictionaries", "code_definitions")
+
+
+def merge_databases(target: str, sources: list[str]) -> dict[str, int]:
+    """Merge recorded databases, usually the shards of child processes, into a target database.
+
+    The target is created if it doesn't exist. Sources are migrated to the
+    current schema first, and must use the object digest of the target.
+
+    Args:
+        target: Path of the database receiving the rows
+        sources: Paths of the databases to copy
+
+    Returns:
+        Number of function calls, snapshots and sessions copied
+
+    Raises:
+        ValueError: If a source is the target, or uses another object digest
+    """
+    target = os.path.abspath(target)
+    digests = {}
+    for source in sources:
+        if os.path.abspath(source) == target:
+            raise ValueError(f"Cannot merge {source} into itself")
+        if not os.path.exists(source):
+            raise ValueError(f"Database not found: {source}")
+        init_db(source, in_memory=False).kw["bind"].dispose()
+        with closing(sqlite3.connect(source)) as connection:
+            digests[source] = connection.execute(
+                "SELECT value FROM database_info WHERE key = 'object_digest'"
+            ).fetchone()[0]
+
+    # A new target uses the digest of the sources
+    init_db(target, in_memory=False, digest=next(iter(digests.values()), None)).kw["bind"].dispose()
+    connection = sqlite3.connect(target, isolation_level=None)
+    counts = {"function_calls": 0, "stack_snapshots": 0, "monitoring_sessions": 0}
+    try:
+        digest = connection.execute("SELECT value FROM database_info WHERE key = 'object_digest'").fetchone()[0]
+        for source, source_digest in digests.items():
+            if source_digest != digest:
+                raise ValueError(f"{source} uses the {source_digest} digest, {target} uses {digest}")
+
+        # (process ID, session ID in its recording) -> merged session ID
+        sessions = _session_ids(connection, "main", 0)
+
+        for source in sources:
+            connection.execute("ATTACH DATABASE ? AS src", (os.path.abspath(source),))
+            try:
+                connection.execute("BEGIN")
+                for table, count in _merge_source(connection, sessions).items():
+                    counts[table] += count
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            finally:
+                connection.execute("DETACH DATABASE src")
+            logger.info(f"Merged {source} into {target}")
+
+        connection.execute("BEGIN")
+        _link_sessions(connection, sessions)
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+    return counts
+
+
+def _columns(connection: sqlite3.Connection, table: str) -> list[str]:
+    return [row[1] for row in connection.execute(f"PRAGMA main.table_info({table})")]
+
+
+def _session_ids(connection: sqlite3.Connection, schema: str, offset: int) -> dict[tuple[int, int], int]:
+    """Map the sessions recorded by known processes to their ID once merged"""
+    sessions = {}
+    for session_id, metadata in connection.execute(f"SELECT id, session_metadata FROM {schema}.monitoring_sessions"):
+        metadata = json.loads(metadata) if metadata else None
+        if isinstance(metadata, dict) and "process_id" in metadata:
+            sessions[(metadata["process_id"], session_id)] = session_id + offset
+    return sessions
+
+
+def _merge_source(connection: sqlite3.Connection, sessions: dict[tuple[int, int], int]) -> dict[str, int]:
+    """Copy the rows of the attached src database into main, in one transaction"""
+    offsets = {
+        table: connection.execute(f"SELECT COALESCE(MAX(id), 0) FROM main.{table}").fetchone()[0]
+        for table in (*_ID_COLUMNS, "object_identities")
+    }
+    sessions.update(_session_ids(connection, "src", offsets["monitoring_sessions"]))
+
+    # Identities are matched by token, primitives share theirs across processes
+    connection.execute(
+        "INSERT INTO main.object_identities (id, identity_hash, name, creation_time) "
+        "SELECT id + ?, identity_hash, name, creation_time FROM src.object_identities "
+        "WHERE identity_hash NOT IN (SELECT identity_hash FROM main.object_identities)",
+        (offsets["object_identities"],),
+    )
+    columns = _columns(connection, "stored_objects")
+    selected = ", ".join("target.id" if column == "identity_id" else f"stored.{column}" for column in columns)
+    connection.execute(
+        f"INSERT OR IGNORE INTO main.stored_objects ({', '.join(columns)}) SELECT {selected} "
+        "FROM src.stored_objects AS stored "
+        "JOIN src.object_identities AS source ON source.id = stored.identity_id "
+        "JOIN main.object_identities AS target ON target.identity_hash = source.identity_hash"
+    )
+    for table in _CONTENT_TABLES:
+        columns = ", ".join(_columns(connection, table))
+        connection.execute(f"INSERT OR IGNORE INTO main.{table} ({columns}) SELECT {columns} FROM src.{table}")
+    connection.execute(
+        "INSERT INTO main.code_object_links (object_id, definition_id, timestamp) "
+        "SELECT object_id, definition_id, timestamp FROM src.code_object_links AS link WHERE NOT EXISTS ("
+        "SELECT 1 FROM main.code_object_links AS existing "
+        "WHERE existing.object_id = link.object_id AND existing.definition_id = link.definition_id)"
+    )
+
+    counts = {}
+    for table in ("monitoring_sessions", "function_calls", "stack_snapshots"):
+        columns = _columns(connection, table)
+        shifted = _ID_COLUMNS[table]
+        selected = ", ".join(
+            f"{column} + {int(offsets[shifted[column]])}" if column in shifted else column for column in columns
+        )
+        cursor = connection.execute(
+            f"INSERT INTO main.{table} ({', '.join(columns)}) SELECT {selected} FROM src.{table}"
+        )
+        counts[table] = cursor.rowcount
+    return counts
+
+
+def _link_sessions(connection: sqlite3.Connection, sessions: dict[tuple[int, int], int]):
+    """Set the parent session of the sessions recorded by child processes"""
+    children = connection.execute(
+        "SELECT id, session_metadata FROM monitoring_sessions WHERE parent_session_id IS NULL"
+    ).fetchall()
+    for session_id, metadata in children:
+        metadata = json.loads(metadata) if metadata else None
+        if not isinstance(metadata, dict) or metadata.get("parent_session_id") is None:
+            continue
+        parent = sessions.get((metadata.get("parent_process_id"), metadata["parent_session_id"]))
+        if parent is not None:
+            connection.execute("UPDATE monitoring_sessions SET parent_session_id = ? WHERE id = ?", (parent, session_id))
@@ -0,0 +1,86 @@
+"""
+Per-thread and per-task recording state of the monitor.
+
+sys.monitoring callbacks fire on every thread, each thread has its own stack
+of monitored calls. The callbacks of a thread only touch its capture stack,
+the storage side (inline under the monitor's write lock, or on the pipeline
+writer thread) keeps the FunctionCall rows of its running calls in its call
+stack, the ThreadState is passed along with each captured event.
+
+Tasks running concurrently on an asyncio event loop interleave their calls on
+one thread, so each task gets its own state too. When a monitored coroutine
+yields to the event loop, the whole stack of its task is suspended until one
+of its coroutines resumes, the suspension is recorded on each call of the
+stack (see FunctionCall.suspensions).
+"""
+
+import itertools
+import sys
+import threading
+import weakref
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    import datetime  # noqa: ICN001
+
+    from .models import FunctionCall
+
+# IDs of the asyncio tasks, unique within the process
+_task_ids = itertools.count(1)
+
+
+class ThreadState:
+    """Recording state of one thread, or of one asyncio task.
+
+    Attributes:
+        thread_id: Native ID of the thread, recorded on its FunctionCall rows
+        task_id: ID of the asyncio task, None for the state of the thread itself
+        capture_stack: Qualnames of the calls seen by the callbacks, None if not recorded.
+            Only used by the thread itself.
+        call_stack: FunctionCall rows of the recorded calls still running, None for the
+            ones that could not be stored. Only used by the storage side.
+        parent_id_for_next_call: Parent of the next call of the thread, set when replaying
+        suspended_at: Time the task yielded to the event loop, None while it runs
+    """
+
+    def __init__(self, thread_id: int, task_id: int | None = None):
+        self.thread_id = thread_id
+        self.task_id = task_id
+        self.capture_stack: list[str | None] = []
+        self.call_stack: list[FunctionCall | None] = []
+        self.parent_id_for_next_call: int | None = None
+        self.suspended_at: datetime.datetime | None = None
+        self._tasks: weakref.WeakKeyDictionary[Any, ThreadState] | None = None
+
+    def task_state(self, task: Any) -> 'ThreadState':
+        """Get the state of an asyncio task running on this thread, dropped with the task"""
+        if self._tasks is None:
+            self._tasks = weakref.WeakKeyDictionary()
+        state = self._tasks.get(task)
+        if state is None:
+            state = self._tasks[task] = ThreadState(self.thread_id, next(_task_ids))
+        return state
+
+    def __repr__(self) -> str:
+        task = f", task={self.task_id}" if self.task_id is not None else ""
+        return f"ThreadState({self.thread_id}{task}, depth={len(self.capture_stack)})"
+
+
+class ThreadStates(threading.local):
+    """Recording state of the current thread or asyncio task, created on first use"""
+
+    def __init__(self):
+        self.thread = ThreadState(threading.get_native_id())
+
+    @property
+    def state(self) -> ThreadState:
+        """State of the task running on the current thread, or of the thread itself"""
+        # asyncio is only looked at if the monitored program imported it
+        asyncio = sys.modules.get("asyncio")
+        if asyncio is not None:
+            loop = asyncio._get_running_loop()
+            if loop is not None:
+                task = asyncio.current_task(loop)
+                if task is not None:
+                    return self.thread.task_state(task)
+        return self.thread
@@ -52,6 +52,7 @@ class TraceExporter:
             snapshots = self.session.query(StackSnapshot).filter(
                 StackSnapshot.function_call_id == function_id
             ).order_by(StackSnapshot.order_in_call.asc()).all()
+            StackSnapshot.reconstruct(self.session, snapshots)
 
             if not snapshots:
                 logger.warning(f"No stack snapshots found for {function_id}")
@@ -0,0 +1,107 @@
+"""
+Capture strategy of each type, and negative cache of unpicklable types.
+
+Values that can't be pickled (sockets, generators, pygame Surfaces...) make
+every capture raise and catch an exception. A type is put in a negative
+cache when pickling fails because of the type itself (the error names it), or
+after FAILURES_BEFORE_CACHING values of the type failed in a row, since a
+failure can come from the content of one instance only (e.g. a dataclass
+holding a lock once). The next values of a cached type are reported
+unserializable without trying, except every `retry_every` of them. Containers
+(builtin ones, their subclasses and the collections types) are never cached,
+their failures come from their elements.
+
+Types can also be given a strategy up front: "skip" (the variable isn't
+recorded), "repr" (only the repr of the value is stored, as a ValueSummary)
+or a reduce function added to the pickle dispatch table.
+"""
+
+import collections
+import logging
+from collections.abc import Callable, Mapping
+
+logger = logging.getLogger(__name__)
+
+SKIP = "skip"
+REPR = "repr"
+# Strategy of the types in the negative cache
+UNPICKLABLE = "unpicklable"
+
+# Values of a cached type skipped between two pickling attempts
+RETRY_EVERY = 1000
+# Values of a type failing in a row before it is cached, when the error doesn't name the type
+FAILURES_BEFORE_CACHING = 3
+
+_CONTAINERS = (list, tuple, dict, set, frozenset)
+
+
+class TypeStrategies:
+    """Decide how the values of each type are captured, before pickling them.
+
+    Args:
+        strategies: Strategy per type: "skip", "repr" or a reduce function
+            (called with the value, returns a reduce tuple like copyreg reducers)
+        retry_every: Try to pickle a value of a cached unpicklable type every N values
+
+    Raises:
+        ValueError: If a strategy is unknown
+    """
+
+    def __init__(self, strategies: Mapping[type, str | Callable] | None = None, retry_every: int = RETRY_EVERY):
+        self.strategies: dict[type, str] = {}
+        self.reducers: dict[type, Callable] = {}
+        for value_type, strategy in (strategies or {}).items():
+            if callable(strategy):
+                self.reducers[value_type] = strategy
+            elif strategy in (SKIP, REPR):
+                self.strategies[value_type] = strategy
+            else:
+                raise ValueError(f"Unknown strategy {strategy!r} for {value_type.__name__}, "
+                                 f"use {SKIP!r}, {REPR!r} or a reduce function")
+        self.retry_every = retry_every
+        self._unpicklable: dict[type, int] = {}  # type -> values skipped since the last attempt
+        self._failures: dict[type, int] = {}  # type -> values failing in a row, not cached yet
+
+    def lookup(self, value_type: type) -> str | None:
+        """Get the strategy of a type: "skip", "repr", "unpicklable", or None to pickle the value"""
+        strategy = self.strategies.get(value_type)
+        if strategy is not None:
+            return strategy
+        skipped = self._unpicklable.get(value_type)
+        if skipped is None:
+            return None
+        if skipped >= self.retry_every:
+            # Try again, failed() puts the type back if it still fails
+            self._unpicklable.pop(value_type, None)
+            self._failures[value_type] = FAILURES_BEFORE_CACHING - 1
+            return None
+        self._unpicklable[value_type] = skipped + 1
+        return UNPICKLABLE
+
+    def failed(self, value_type: type, error: Exception | None = None):
+        """Record that a value of a type couldn't be captured, with the error raised"""
+        if (issubclass(value_type, _CONTAINERS) or value_type.__module__ == collections.__name__
+                or value_type in self.reducers):
+            return
+        failures = self._failures.pop(value_type, 0) + 1
+        names_type = isinstance(error, TypeError) and value_type.__name__ in str(error)
+        if not names_type and failures < FAILURES_BEFORE_CACHING:
+            self._failures[value_type] = failures
+            return
+        if value_type not in self._unpicklable:
+            logger.debug(f"{value_type.__qualname__} values can't be pickled, they won't be tried again")
+        self._unpicklable[value_type] = 0
+
+    def succeeded(self, value_type: type):
+        """Record that a value of a type was captured, its earlier failures weren't in a row"""
+        if self._failures:
+            self._failures.pop(value_type, None)
+
+    def unpicklable_types(self) -> list[type]:
+        """Types currently in the negative cache"""
+        return list(self._unpicklable)
+
+    def clear(self):
+        """Forget the unpicklable types"""
+        self._unpicklable.clear()
+        self._failures.clear()
@@ -0,0 +1,131 @@
+"""
+Write-behind buffering for the monitoring database.
+
+The monitor produces many small rows (function calls, stack snapshots, stored
+objects). Committing each of them in its own transaction makes the SQLite
+transaction cost dominate line-mode recording, so rows are accumulated in the
+open transaction and committed in batches instead.
+
+Primary keys of the buffered rows are allocated in-process by an IdAllocator,
+so rows can reference each other before anything is written.
+"""
+
+import itertools
+import logging
+from collections.abc import Callable, Iterable
+from time import perf_counter
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBuffer:
+    """Accumulate pending rows and commit them in batches.
+
+    A flush is triggered when any of the thresholds is reached:
+    the number of pending rows, their approximate size in bytes, or the time
+    elapsed since the last flush. ``flush()`` can also be called explicitly.
+    """
+
+    def __init__(self, session: Session, max_rows: int = 1000, max_bytes: int = 8 * 1024 * 1024, max_interval: float | None = 1.0):
+        self.session = session
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval
+
+        self.pending_rows = 0
+        self.pending_bytes = 0
+        self._last_flush = perf_counter()
+
+        # Callbacks run once the pending rows are committed or discarded
+        self._reset_hooks: list[Callable[[bool], None]] = []
+
+        self.stats = {
+            "flushes": 0,
+            "rows_written": 0,
+            "bytes_written": 0,
+        }
+
+    def add(self, obj, nbytes: int = 0):
+        """Add a new ORM object to the session and account for it"""
+        self.session.add(obj)
+        self.record(nbytes)
+
+    def record(self, nbytes: int = 0, rows: int = 1):
+        """Account for rows that were added to the session by someone else"""
+        self.pending_rows += rows
+        self.pending_bytes += nbytes
+
+    def add_reset_hook(self, hook: Callable[[bool], None]):
+        """Register a callback run once pending rows are committed (True) or rolled back (False)"""
+        self._reset_hooks.append(hook)
+
+    def _reset(self, committed: bool):
+        self.pending_rows = 0
+        self.pending_bytes = 0
+        for hook in self._reset_hooks:
+            hook(committed)
+
+    def should_flush(self) -> bool:
+        """Return True if one of the flush thresholds has been reached"""
+        if self.pending_rows == 0:
+            return False
+        if self.max_rows is not None and self.pending_rows >= self.max_rows:
+            return True
+        if self.max_bytes is not None and self.pending_bytes >= self.max_bytes:
+            return True
+        return self.max_interval is not None and perf_counter() - self._last_flush >= self.max_interval
+
+    def maybe_flush(self) -> bool:
+        """Flush if a threshold has been reached. Returns True if a flush happened."""
+        if self.should_flush():
+            self.flush()
+            return True
+        return False
+
+    def rollback(self):
+        """Discard all pending rows"""
+        self.session.rollback()
+        self._reset(committed=False)
+
+    def flush(self):
+        """Write all pending rows and commit the transaction"""
+        try:
+            self.session.commit()
+        except Exception as e:
+            logger.error(f"Error flushing write buffer: {e}")
+            self.rollback()
+            raise
+        finally:
+            self._last_flush = perf_counter()
+
+        self.stats["flushes"] += 1
+        self.stats["rows_written"] += self.pending_rows
+        self.stats["bytes_written"] += self.pending_bytes
+        self._reset(committed=True)
+
+
+class IdAllocator:
+    """Allocate integer primary keys in-process.
+
+    Each counter is seeded from the largest ID already in its table, so new
+    rows get their ID as soon as they are created instead of after a flush.
+    This assumes the monitor is the only writer of the database.
+    """
+
+    def __init__(self, session: Session, models: Iterable[type]):
+        self._counters = {}
+        for model in models:
+            start = session.query(func.max(model.id)).scalar() or 0
+            self._counters[model] = itertools.count(start + 1)
+
+    def next_id(self, model: type) -> int:
+        """Return a new primary key for a row of model"""
+        return next(self._counters[model])
+
+    def assign(self, obj):
+        """Set a new primary key on an ORM object and return it"""
+        obj.id = self.next_id(type(obj))
+        return obj
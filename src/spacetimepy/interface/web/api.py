@@ -283,6 +283,7 @@ async def get_stack_recording(function_id: str):
         snapshots = session.query(StackSnapshot).filter(
             StackSnapshot.function_call_id == function_id
         ).order_by(StackSnapshot.order_in_call.asc()).all()
+        StackSnapshot.reconstruct(session, snapshots)
         if not snapshots:
             return {
                 "function": {
@@ -847,6 +848,7 @@ async def get_function_call(call_id: str):
             stack_snapshots = session.query(StackSnapshot).filter(
                 StackSnapshot.function_call_id == call_id
             ).order_by(StackSnapshot.order_in_call.asc()).all()
+            StackSnapshot.reconstruct(session, stack_snapshots)
 
             for snapshot in stack_snapshots:
                 # Process locals from the snapshot's locals_refs
@@ -912,7 +914,8 @@ async def get_monitoring_sessions():
                 "duration": ms.duration,  # Use the new duration property
                 "function_calls": [f.id for f in call_sequence],
                 "function_count": {f.function: sum(1 for x in call_sequence if x.function == f.function) for f in call_sequence},
-                "metadata": ms.session_metadata
+                "metadata": ms.session_metadata,
+                "parent_session_id": ms.parent_session_id
             }
             result.append(session_data)
 
@@ -1037,6 +1040,8 @@ async def get_session_details(session_id: str):
             "function_calls_map": function_calls_map,
             "function_count": {f.function: sum(1 for x in call_sequence if x.function == f.function) for f in call_sequence},
             "metadata": monitoring_session.session_metadata,
+            "parent_session_id": monitoring_session.parent_session_id,
+            "child_session_ids": [child.id for child in monitoring_session.child_sessions],
             "common_variables": common_variables
         }
 
@@ -1275,6 +1280,7 @@ async def get_stack_recording_data(function_id: str):
     snapshots = session.query(StackSnapshot).filter(
         StackSnapshot.function_call_id == function_id
     ).order_by(StackSnapshot.order_in_call.asc()).all()
+    StackSnapshot.reconstruct(session, snapshots)
 
     if not snapshots:
         raise ValueError(f"No stack snapshots found for function call {function_id}")
@@ -0,0 +1,729 @@
+"""
+Unit tests for the recording side of SpaceTimeMonitor.
+"""
+
+import asyncio
+import collections
+import contextlib
+import glob
+import itertools
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import spacetimepy
+from spacetimepy.core.capture_policy import CapturePolicy, ValueSummary
+from spacetimepy.core.governor import FULL, FUNCTION, MAX_TRANSITIONS, OverheadGovernor
+from spacetimepy.core.models import (
+    DatabaseInfo,
+    FunctionCall,
+    MonitoringSession,
+    StackSnapshot,
+    StoredObject,
+    init_db,
+)
+from spacetimepy.core.shards import SHARD_ENV, merge_databases
+
+
+@spacetimepy.pymonitor(mode="line")
+def monitored_line_function(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+@spacetimepy.pymonitor(mode="function")
+def monitored_function(x):
+    return x * 2
+
+
+@spacetimepy.pymonitor(mode="function", sample_every=3)
+def sampled_parent(x):
+    return sampled_child(x) + 1
+
+
+@spacetimepy.pymonitor(mode="function")
+def sampled_child(x):
+    return x * 2
+
+
+@spacetimepy.pymonitor(mode="line", ignore=["secret"], use_tag_line=True)
+def monitored_tagged_function(x, secret):
+    y = x + 1
+    return y * 2  #tag
+
+
+@spacetimepy.pymonitor(mode="function", max_length=100)
+def monitored_large_argument(data, small):
+    return len(data) + len(small)
+
+
+class Settings:
+    """Plain object whose state is fingerprinted."""
+
+    def __init__(self, level):
+        self.level = level
+
+
+class Stream:
+    """Iterator over a large buffer, with an unrelated memory_usage()."""
+
+    def __init__(self):
+        self.buffer = list(range(1000))
+        self.pos = 0
+        self.usage_calls = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.pos += 1
+        return self.pos
+
+    def memory_usage(self, deep=False):
+        self.usage_calls += 1
+        return 0
+
+
+class Unpicklable:
+    """Counts the attempts to pickle it."""
+
+    attempts = 0
+
+    def __reduce__(self):
+        Unpicklable.attempts += 1
+        raise TypeError("cannot pickle Unpicklable")
+
+
+@spacetimepy.pymonitor(mode="function")
+def monitored_resources(resource, lock):
+    return 1
+
+
+@spacetimepy.pymonitor(mode="line", fork=True)
+def monitored_forked_function(n):
+    data = list(range(n))
+    data.append(-1)
+    total = sum(data)
+    return total / len(data)
+
+
+@spacetimepy.pymonitor(mode="function")
+def threaded_parent(x):
+    return threaded_child(x) + threaded_child(x + 1)
+
+
+@spacetimepy.pymonitor(mode="function")
+def threaded_child(x):
+    time.sleep(0.001)  # Let the other threads run in between
+    return x
+
+
+@spacetimepy.pymonitor(mode="function")
+async def async_parent(x):
+    first = await async_child(x, 0.02)
+    with contextlib.suppress(ValueError):
+        await async_child(x, 0.01, fail=True)
+    return first + await async_child(x, 0)
+
+
+@spacetimepy.pymonitor(mode="function")
+async def async_child(x, delay, fail=False):
+    await asyncio.sleep(delay)
+    if fail:
+        raise ValueError(x)
+    return x
+
+
+HELPER_LIMIT = 10
+HELPER_SCALE = 3
+
+
+def limit_helper(x):
+    return x + HELPER_LIMIT
+
+
+def scale_helper(x):
+    return x * HELPER_SCALE
+
+
+@spacetimepy.pymonitor(mode="function")
+def monitored_helper_caller(x):
+    return limit_helper(x)
+
+
+class ControlFlow(Exception):
+    """Raised to leave nested calls."""
+
+
+@spacetimepy.pymonitor(mode="function")
+def raising_parent(n):
+    try:
+        raising_child(n)
+    except ControlFlow as e:
+        return e.args[0]
+
+
+@spacetimepy.pymonitor(mode="line")
+def raising_child(n):
+    raise ControlFlow(n, "done")
+
+
+@spacetimepy.pymonitor(mode="line")
+def monitored_rolled_back_function(commit, rollback):
+    total = 1
+    commit()
+    total += 1
+    rollback()
+    total += 1
+    return total
+
+
+@spacetimepy.pymonitor(mode="line")
+def monitored_mutating_function(items, config):
+    items.append(1)
+    items.append(2)
+    return len(items) + len(config)
+
+
+class TestSpaceTimeMonitor(unittest.TestCase):
+    """Test cases for recording with SpaceTimeMonitor."""
+
+    def setUp(self):
+        """Create a fresh in-memory monitor."""
+        self.monitor = spacetimepy.init_monitoring(db_path=":memory:", flush_rows=10_000, flush_interval=None)
+        self.session = self.monitor.session
+
+    def tearDown(self):
+        """Stop using the monitor."""
+        self.session.close()
+
+    def test_rows_are_buffered_until_flush(self):
+        """Rows are only committed once the buffer flushes."""
+        self.monitor.start_session("buffered")
+        monitored_function(3)
+        self.assertGreater(self.monitor.write_buffer.pending_rows, 0)
+        flushes = self.monitor.write_buffer.stats["flushes"]
+
+        self.monitor.end_session()
+        self.assertEqual(self.monitor.write_buffer.pending_rows, 0)
+        self.assertEqual(self.monitor.write_buffer.stats["flushes"], flushes + 1)
+
+        call = self.session.query(FunctionCall).filter_by(function="monitored_function").one()
+        self.assertIsNotNone(call.end_time)
+        self.assertEqual(self.monitor.object_manager.rehydrate(call.return_ref), 6)
+
+    def test_flush_on_row_threshold(self):
+        """Reaching the row threshold triggers a flush without an explicit call."""
+        self.monitor.write_buffer.max_rows = 5
+        self.monitor.start_session("threshold")
+        for i in range(10):
+            monitored_function(i)
+        self.assertGreater(self.monitor.write_buffer.stats["flushes"], 1)
+        self.monitor.end_session()
+
+    def test_snapshot_links(self):
+        """Snapshots are chained and the call points to the first one."""
+        self.monitor.start_session("links")
+        self.assertEqual(monitored_line_function(3), 3)
+        self.monitor.end_session()
+
+        call = self.session.query(FunctionCall).filter_by(function="monitored_line_function").one()
+        snapshots = self.session.query(StackSnapshot).filter_by(
+            function_call_id=call.id
+        ).order_by(StackSnapshot.order_in_call).all()
+        self.assertGreater(len(snapshots), 1)
+        self.assertEqual(call.first_snapshot_id, snapshots[0].id)
+        for prev_snapshot, snapshot in itertools.pairwise(snapshots):
+            self.assertEqual(prev_snapshot.next_snapshot_id, snapshot.id)
+        self.assertIsNone(snapshots[-1].next_snapshot_id)
+
+    def test_snapshot_deltas(self):
+        """Snapshots between keyframes only store changes, full refs are reconstructed on read."""
+        self.monitor.keyframe_every = 4
+        self.monitor.start_session("deltas")
+        monitored_line_function(5)
+        self.monitor.end_session()
+        self.session.expunge_all()
+
+        call = self.session.query(FunctionCall).filter_by(function="monitored_line_function").one()
+        snapshots = self.session.query(StackSnapshot).filter_by(
+            function_call_id=call.id
+        ).order_by(StackSnapshot.order_in_call).all()
+        self.assertEqual([s.is_keyframe for s in snapshots[:5]], [True, False, False, False, True])
+        n_ref = snapshots[0].locals_refs["n"]
+        for snapshot in snapshots[1:]:
+            if not snapshot.is_keyframe:
+                self.assertNotIn("n", snapshot.locals_delta)
+            self.assertEqual(snapshot.locals_refs["n"], n_ref)
+        self.assertIn("total", snapshots[-1].locals_refs)
+
+        traces = spacetimepy.FunctionCallRepository(self.session).get_function_traces(str(call.id))
+        self.assertEqual([t["locals_refs"] for t in traces], [s.locals_refs for s in snapshots])
+
+    def test_snapshot_after_rollback_is_keyframe(self):
+        """The first snapshot after a rollback is a keyframe, its previous snapshot was discarded."""
+        self.monitor.start_session("rollback")
+        monitored_rolled_back_function(self.monitor.flush, self.monitor.write_buffer.rollback)
+        self.monitor.end_session()
+        self.session.expunge_all()
+
+        call = self.session.query(FunctionCall).filter_by(function="monitored_rolled_back_function").one()
+        snapshots = self.session.query(StackSnapshot).filter_by(
+            function_call_id=call.id
+        ).order_by(StackSnapshot.order_in_call).all()
+        self.assertEqual([s.order_in_call for s in snapshots], [0, 1, 4, 5])
+        self.assertTrue(snapshots[2].is_keyframe)
+        totals = [self.monitor.object_manager.get(s.locals_refs["total"])[0] for s in snapshots[2:]]
+        self.assertEqual(totals, [2, 3])
+
+    def test_unchanged_objects_are_not_captured_again(self):
+        """Objects keep their ref without being pickled again until they change."""
+        config = {f"key{i}": list(range(i)) for i in range(100)}
+        self.monitor.start_session("changes")
+        monitored_mutating_function([], config)
+        self.monitor.end_session()
+
+        call = self.session.query(FunctionCall).filter_by(function="monitored_mutating_function").one()
+        snapshots = self.session.query(StackSnapshot).filter_by(
+            function_call_id=call.id
+        ).order_by(StackSnapshot.order_in_call).all()
+        self.assertEqual(len({s.locals_refs["config"] for s in snapshots}), 1)
+        self.assertEqual(len({s.locals_refs["items"] for s in snapshots}), 3)
+        self.assertGreater(self.monitor.object_manager.change_detector.stats()["reused"], 0)
+
+    def test_change_detector_does_not_keep_objects_alive(self):
+        """Captures are reused while the object is unchanged, the object itself isn't kept alive."""
+        manager = self.monitor.object_manager
+        settings = Settings(1)
+        captured = manager.capture(settings)
+        self.assertIs(manager.capture(settings), captured)
+        settings.level = 2
+        self.assertIsNot(manager.capture(settings), captured)
+        collected = weakref.ref(settings)
+        del settings
+        self.assertIsNone(collected())
+
+    def test_oversized_values_are_summarized(self):
+        """Values above the capture policy limits are stored as summaries."""
+        self.monitor.start_session("limits")
+        monitored_large_argument(list(range(1000)), [1, 2])
+        self.monitor.end_session()
+
+        call = self.session.query(FunctionCall).filter_by(function="monitored_large_argument").one()
+        data = self.session.get(StoredObject, call.locals_refs["data"])
+        self.assertTrue(data.is_summary)
+        self.assertEqual(data.type_name, "list")
+        summary = self.monitor.object_manager.get(data.id)[0]
+        self.assertIsInstance(summary, ValueSummary)
+        self.assertEqual((summary.reason, summary.length), ("max_length", 1000))
+        self.assertEqual(summary.sample, ["0", "1", "2", "3", "4"])
+        self.assertFalse(self.session.get(StoredObject, call.locals_refs["small"]).is_summary)
+
+        ref = self.monitor.object_manager.store_captured(
+            self.monitor.object_manager.capture("x" * 2000, CapturePolicy(max_size=1000))
+        )
+        self.assertEqual(self.monitor.object_manager.get(ref)[0].reason, "max_size")
+
+        # Summarizing a value doesn't run its iterator or any method of its own
+        stream = Stream()
+        ref = self.monitor.object_manager.store_captured(
+            self.monitor.object_manager.capture(stream, CapturePolicy(max_size=1000))
+        )
+        summary = self.monitor.object_manager.get(ref)[0]
+        self.assertEqual((summary.reason, summary.sample), ("max_size", []))
+        self.assertEqual((stream.pos, stream.usage_calls), (0, 0))
+
+    def test_type_strategies(self):
+        """Unpicklable types are not pickled again, and types can be captured by their repr."""
+        lock_type = type(threading.Lock())
+        monitor = spacetimepy.init_monitoring(db_path=":memory:", type_strategies={lock_type: "repr"})
+        monitor.start_session("types")
+        Unpicklable.attempts = 0
+        for _ in range(3):
+            monitored_resources(Unpicklable(), threading.Lock())
+        monitor.end_session()
+
+        self.assertEqual(Unpicklable.attempts, 1)
+        self.assertEqual(monitor.type_strategies.unpicklable_types(), [Unpicklable])
+        calls = monitor.session.query(FunctionCall).filter_by(function="monitored_resources").all()
+        self.assertEqual(len(calls), 3)
+        for call in calls:
+            self.assertEqual(call.locals_refs["resource"], "<unserializable>")
+            lock = monitor.object_manager.get(call.locals_refs["lock"])[0]
+            self.assertEqual(lock.reason, "repr")
+            self.assertIn("unlocked", lock.sample[0])
+
+        with self.assertRaises(ValueError):
+            spacetimepy.init_monitoring(db_path=":memory:", type_strategies={lock_type: "ignore"})
+
+    def test_instance_failures_dont_cache_types(self):
+        """A value failing because of its content doesn't make the other values of its type unserializable."""
+        capture = self.monitor._capture_value
+        self.assertEqual(capture(collections.defaultdict(lambda: 0), "line"), "<unserializable>")
+        self.assertNotEqual(capture(collections.defaultdict(list), "line"), "<unserializable>")
+
+        holder = Settings(threading.Lock())
+        for _ in range(2):
+            self.assertEqual(capture(holder, "line"), "<unserializable>")
+        self.assertNotEqual(capture(Settings(1), "line"), "<unserializable>")
+        for _ in range(3):
+            self.assertEqual(capture(holder, "line"), "<unserializable>")
+        self.assertEqual(self.monitor.type_strategies.unpicklable_types(), [Settings])
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs os.fork")
+    def test_forked_snapshots(self):
+        """Snapshots captured in forked children get their variables when merged."""
+        self.monitor.start_session("forked")
+        monitored_forked_function(100)
+        self.monitor.end_session()
+        self.assertEqual(self.monitor.forks.running, 0)
+        self.assertEqual(self.monitor._forked_snapshots, {})
+
+        call = self.session.query(FunctionCall).filter_by(function="monitored_forked_function").one()
+        snapshots = sorted(call.stack_snapshots, key=lambda s: s.order_in_call)
+        self.assertEqual(len(snapshots), 4)
+        self.assertTrue(all(snapshot.is_keyframe for snapshot in snapshots))
+        data = self.monitor.object_manager.rehydrate(snapshots[2].locals_refs["data"])
+        self.assertEqual(data, [*range(100), -1])
+        self.assertEqual(self.monitor.object_manager.rehydrate(snapshots[3].locals_refs["total"]), 4949)
+        # Both states of the list are versions of the same identity
+        first = self.session.get(StoredObject, snapshots[1].locals_refs["data"])
+        second = self.session.get(StoredObject, snapshots[2].locals_refs["data"])
+        self.assertEqual(first.identity_id, second.identity_id)
+        self.assertEqual((first.version_number, second.version_number), (1, 2))
+
+    def test_threads_have_their_own_call_stacks(self):
+        """Calls made by worker threads get their parents and order from their own thread."""
+        for pipeline in (False, True):
+            with self.subTest(pipeline=pipeline):
+                monitor = spacetimepy.init_monitoring(db_path=":memory:", pipeline=pipeline)
+                monitor.start_session("threads")
+                with ThreadPoolExecutor(max_workers=4) as pool:
+                    self.assertEqual(sum(pool.map(threaded_parent, range(0, 40, 2))), sum(range(40)))
+                monitor.end_session()
+
+                calls = {call.id: call for call in monitor.session.query(FunctionCall).all()}
+                parents = [call for call in calls.values() if call.function == "threaded_parent"]
+                self.assertEqual(len(parents), 20)
+                self.assertGreater(len({call.thread_id for call in parents}), 1)
+                for call in calls.values():
+                    self.assertIsNotNone(call.end_time)
+                    if call.function == "threaded_child":
+                        parent = calls[call.parent_call_id]
+                        self.assertEqual(parent.thread_id, call.thread_id)
+                        self.assertEqual(monitor.object_manager.rehydrate(call.locals_refs["x"]),
+                                         monitor.object_manager.rehydrate(parent.locals_refs["x"]) + call.order_in_parent)
+                if monitor.pipeline is not None:
+                    monitor.pipeline.stop()
+
+    def test_asyncio_tasks_have_their_own_call_stacks(self):
+        """Concurrent tasks get their own call trees, and the time spent awaiting is recorded."""
+        async def main():
+            return await asyncio.gather(async_parent(1), async_parent(2), async_parent(3))
+
+        self.monitor.start_session("tasks")
+        self.assertEqual(asyncio.run(main()), [2, 4, 6])
+        self.monitor.end_session()
+
+        calls = {call.id: call for call in self.session.query(FunctionCall).all()}
+        parents = [call for call in calls.values() if call.function == "async_parent"]
+        self.assertEqual(len({call.task_id for call in parents}), 3)
+        for parent in parents:
+            children = sorted(parent.child_calls, key=lambda call: call.order_in_parent)
+            self.assertEqual([call.order_in_parent for call in children], [0, 1, 2])
+            self.assertEqual({call.task_id for call in children}, {parent.task_id})
+            self.assertEqual(children[1].return_ref, None)
+            self.assertIsNotNone(children[1].end_time)
+            # The parent awaited its children, the time awaiting is part of its duration
+            self.assertGreaterEqual(len(parent.suspensions), 2)
+            self.assertGreater(parent.awaiting_time, 0.025)
+            self.assertGreaterEqual(parent.running_time, 0)
+            self.assertGreater(children[0].awaiting_time, 0.015)
+            duration = (children[0].end_time - children[0].start_time).total_seconds()
+            self.assertLessEqual(children[0].suspensions[-1][1], duration)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs os.fork")
+    def test_process_shards_are_merged(self):
+        """Pool workers record into their own shards, merged with their sessions linked to the parent's."""
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = os.path.join(directory, "monitoring.db")
+            monitor = spacetimepy.init_monitoring(db_path=db_path, shard_processes=True, flush_interval=None)
+            try:
+                session_id = monitor.start_session("workers")
+                monitored_function(1)
+                with multiprocessing.get_context("fork").Pool(2) as pool:
+                    self.assertEqual(pool.map(monitored_function, [2, 3, 4], chunksize=1), [4, 6, 8])
+                monitor.end_session()
+                monitor.export_db()
+            finally:
+                os.environ.pop(SHARD_ENV, None)
+                # The monitor exported at exit must not write to the removed directory
+                self.monitor = spacetimepy.init_monitoring(db_path=":memory:")
+
+            shards = glob.glob(os.path.join(directory, "monitoring.*.db"))
+            self.assertEqual(len(shards), 2)
+            counts = merge_databases(db_path, shards)
+            self.assertEqual(counts["monitoring_sessions"], 2)
+
+            with init_db(db_path, in_memory=False)() as session:
+                calls = session.query(FunctionCall).filter_by(function="monitored_function").all()
+                self.assertEqual(len(calls), 4)
+                self.assertEqual(len({call.id for call in calls}), 4)
+                parent = session.get(MonitoringSession, session_id)
+                children = parent.child_sessions
+                self.assertEqual(len(children), 2)
+                self.assertEqual(sum(len(child.function_calls) for child in children), 3)
+                # Values stored by several processes are stored once
+                returns = {call.return_ref for call in calls}
+                self.assertEqual(session.query(StoredObject).filter(StoredObject.id.in_(returns)).count(), 4)
+
+    def test_exceptions_close_calls(self):
+        """Calls ended by an exception are closed with the exception, later calls aren't parented under them."""
+        self.monitor.start_session("exceptions")
+        for n in range(3):
+            self.assertEqual(raising_parent(n), n)
+        with self.assertRaises(ControlFlow):
+            raising_child(3)
+        self.assertEqual(self.monitor._threads.state.capture_stack, [])
+        self.assertEqual(self.monitor.call_stack, [])
+        # The counters of the calls are dropped when they end
+        self.assertEqual(self.monitor._parent_call_child_counts, {})
+        monitored_function(1)
+        self.monitor.end_session()
+
+        children = self.session.query(FunctionCall).filter_by(function="raising_child").order_by(FunctionCall.id).all()
+        self.assertEqual(len(children), 4)
+        for n, child in enumerate(children):
+            self.assertIsNotNone(child.end_time)
+            self.assertIsNone(child.return_ref)
+            self.assertEqual(child.exception_type, f"{__name__}.ControlFlow")
+            self.assertEqual(child.exception_message, f"({n}, 'done')")
+            exception = self.monitor.object_manager.rehydrate(child.exception_ref)
+            self.assertIsInstance(exception, ControlFlow)
+            self.assertEqual(exception.args, (n, "done"))
+        self.assertIsNone(children[3].parent_call_id)
+        parents = self.session.query(FunctionCall).filter_by(function="raising_parent").all()
+        self.assertTrue(all(parent.exception_type is None and parent.return_ref for parent in parents))
+        last = self.session.query(FunctionCall).filter_by(function="monitored_function").one()
+        self.assertIsNone(last.parent_call_id)
+
+    def test_used_globals_closure(self):
+        """Globals reached through called functions are resolved once, and again when a function is rebound."""
+        global HELPER_LIMIT, limit_helper
+        code = monitored_helper_caller.__code__
+        self.assertEqual(self.monitor.get_used_globals(code, globals()), {"HELPER_LIMIT": 10})
+        closure = self.monitor._globals_closures[code]
+        original_limit, original_helper = HELPER_LIMIT, limit_helper
+        try:
+            HELPER_LIMIT = 20
+            self.assertEqual(self.monitor.get_used_globals(code, globals()), {"HELPER_LIMIT": 20})
+            self.assertIs(self.monitor._globals_closures[code], closure)
+
+            limit_helper = scale_helper
+            self.assertEqual(self.monitor.get_used_globals(code, globals()), {"HELPER_SCALE": 3})
+            self.assertIsNot(self.monitor._globals_closures[code], closure)
+
+            self.monitor.start_session("closure")
+            monitored_helper_caller(2)
+            self.monitor.end_session()
+            call = self.session.query(FunctionCall).filter_by(function="monitored_helper_caller").one()
+            self.assertEqual(set(call.globals_refs), {"HELPER_SCALE"})
+        finally:
+            HELPER_LIMIT, limit_helper = original_limit, original_helper
+
+    def test_strict_capture(self):
+        """Strict capture pickles every object."""
+        monitor = spacetimepy.init_monitoring(db_path=":memory:", strict_capture=True)
+        self.assertIsNone(monitor.object_manager.change_detector)
+
+    def test_object_digest(self):
+        """The digest of a new database is recorded and used for the object references."""
+        monitor = spacetimepy.init_monitoring(db_path=":memory:", digest="sha256")
+        self.assertEqual(monitor.session.get(DatabaseInfo, "object_digest").value, "sha256")
+        self.assertEqual(len(monitor.object_manager.store([1, 2, 3])), 64)
+
+    def test_ids_allocated_before_write(self):
+        """Buffered rows get their IDs and links before anything is written."""
+        self.monitor.start_session("ids")
+        monitored_line_function(3)
+
+        pending = list(self.session.new)
+        snapshots = sorted((o for o in pending if isinstance(o, StackSnapshot)), key=lambda s: s.order_in_call)
+        call = next(o for o in pending if isinstance(o, FunctionCall))
+        self.assertGreater(len(snapshots), 1)
+        self.assertIsNotNone(call.id)
+        self.assertEqual(call.first_snapshot_id, snapshots[0].id)
+        self.assertEqual(snapshots[0].next_snapshot_id, snapshots[1].id)
+        self.monitor.end_session()
+
+    def test_capture_plan(self):
+        """The capture plan filters ignored variables and untagged lines."""
+        plan = spacetimepy.SpaceTimeMonitor._capture_plans[monitored_tagged_function.__code__]
+        self.assertEqual(plan.arg_names, ("x", "secret"))
+        self.assertEqual(len(plan.allowed_lines), 1)
+
+        self.monitor.start_session("plan")
+        monitored_tagged_function(1, "password")
+        self.monitor.end_session()
+
+        call = self.session.query(FunctionCall).filter_by(function="monitored_tagged_function").one()
+        self.assertEqual(set(call.locals_refs), {"x"})
+        snapshots = self.session.query(StackSnapshot).filter_by(function_call_id=call.id).all()
+        self.assertEqual([s.line_number for s in snapshots], list(plan.allowed_lines))
+        self.assertNotIn("secret", snapshots[0].locals_refs)
+
+    def test_code_definition_resolved_once_per_plan(self):
+        """The code definition of a function is looked up once, until its plan changes."""
+        lookups = []
+        resolve = self.monitor._get_cached_code_definition
+
+        def counted_lookup(*args):
+            lookups.append(args)
+            return resolve(*args)
+
+        self.monitor._get_cached_code_definition = counted_lookup
+        plan = spacetimepy.SpaceTimeMonitor._capture_plans[monitored_tagged_function.__code__]
+        self.monitor.start_session("definitions")
+        monitored_tagged_function(1, "password")
+        monitored_tagged_function(2, "password")
+        self.assertEqual(len(lookups), 1)
+
+        spacetimepy.set_line_filter(monitored_tagged_function, use_tag_line=True)
+        self.assertIsNone(plan.code_definition)
+        monitored_tagged_function(3, "password")
+        self.assertEqual(len(lookups), 2)
+        self.monitor.end_session()
+
+        calls = self.session.query(FunctionCall).filter_by(function="monitored_tagged_function").all()
+        self.assertEqual({call.code_definition_id for call in calls}, {plan.code_definition[1]})
+        self.assertIsNotNone(plan.code_definition[1])
+
+    def test_set_line_filter_rearms_lines(self):
+        """Lines disabled by a filter are recorded again once the filter changes."""
+        self.monitor.start_session("filter")
+        monitored_tagged_function(1, "password")
+        try:
+            spacetimepy.set_line_filter(monitored_tagged_function)
+            monitored_tagged_function(2, "password")
+        finally:
+            spacetimepy.set_line_filter(monitored_tagged_function, use_tag_line=True)
+        self.monitor.end_session()
+
+        calls = self.session.query(FunctionCall).filter_by(
+            function="monitored_tagged_function"
+        ).order_by(FunctionCall.id).all()
+        counts = [
+            self.session.query(StackSnapshot).filter_by(function_call_id=call.id).count()
+            for call in calls
+        ]
+        self.assertEqual(counts, [1, 2])
+
+    def test_pause_turns_off_events(self):
+        """Pausing turns off the events of monitored code and resuming restores them."""
+        code = monitored_function.__code__
+        events = sys.monitoring.get_local_events(self.monitor.MONITOR_TOOL_ID, code)
+        self.monitor.start_session("pause")
+        exception_events = sys.monitoring.events.PY_UNWIND | sys.monitoring.events.PY_THROW
+        self.assertEqual(sys.monitoring.get_events(self.monitor.MONITOR_TOOL_ID), exception_events)
+        with spacetimepy.recording_context(enabled=False):
+            self.assertEqual(sys.monitoring.get_local_events(self.monitor.MONITOR_TOOL_ID, code), 0)
+            # Exceptions of unmonitored code don't reach the callbacks while paused
+            self.assertEqual(sys.monitoring.get_events(self.monitor.MONITOR_TOOL_ID), 0)
+            monitored_function(1)
+        self.assertEqual(sys.monitoring.get_local_events(self.monitor.MONITOR_TOOL_ID, code), events)
+        self.assertEqual(sys.monitoring.get_events(self.monitor.MONITOR_TOOL_ID), exception_events)
+        monitored_function(2)
+        self.monitor.end_session()
+
+        calls = self.session.query(FunctionCall).filter_by(function="monitored_function").all()
+        self.assertEqual([self.monitor.object_manager.rehydrate(c.return_ref) for c in calls], [4])
+
+    def test_sampling(self):
+        """Unsampled calls are counted and their children attach to the nearest recorded call."""
+        session_id = self.monitor.start_session("sampling")
+        for i in range(6):
+            sampled_parent(i)
+        self.monitor.end_session()
+
+        parents = self.session.query(FunctionCall).filter_by(function="sampled_parent").all()
+        children = self.session.query(FunctionCall).filter_by(function="sampled_child").all()
+        self.assertEqual(len(parents), 2)
+        self.assertEqual(len(children), 6)
+        parent_ids = {p.id for p in parents}
+        self.assertEqual(sum(c.parent_call_id in parent_ids for c in children), 2)
+
+        session = self.session.get(MonitoringSession, session_id)
+        self.assertEqual(session.session_metadata["sampling"]["sampled_parent"], {"calls": 6, "recorded": 2})
+
+    def test_governor_lowers_fidelity(self):
+        """The governor stops line snapshots when recording takes too much time."""
+        monitor = spacetimepy.init_monitoring(db_path=":memory:", flush_interval=None,
+                                              max_overhead=0.01, governor_window=0.001)
+        session_id = monitor.start_session("governor")
+        for _ in range(20):
+            monitored_line_function(10)
+        monitor.end_session()
+
+        session = monitor.session.get(MonitoringSession, session_id)
+        transitions = session.session_metadata["governor"]["transitions"]
+        self.assertGreater(len(transitions), 0)
+        self.assertEqual((transitions[0]["from"], transitions[0]["to"]), ("full", "function"))
+        calls = monitor.session.query(FunctionCall).filter_by(function="monitored_line_function").all()
+        snapshots = monitor.session.query(StackSnapshot).count()
+        self.assertLess(snapshots, len(calls) * 30)
+        monitor.session.close()
+
+    def test_governor_keeps_recent_transitions(self):
+        """Oscillating fidelity keeps a bounded list of transitions, all of them are counted."""
+        governor = OverheadGovernor()
+        for i in range(3 * MAX_TRANSITIONS):
+            governor._set_level(FUNCTION if i % 2 == 0 else FULL, 0.2)
+        stats = governor.stats()
+        self.assertEqual(len(stats["transitions"]), MAX_TRANSITIONS)
+        half = 3 * MAX_TRANSITIONS // 2
+        self.assertEqual(stats["transition_counts"], {"full": half, "function": half, "args": 0, "sampled": 0})
+        governor.reset()
+        self.assertEqual((len(governor.transitions), sum(governor.transition_counts.values())), (0, 0))
+
+
+class TestRecordingPipeline(unittest.TestCase):
+    """Test cases for storing recorded events from the writer thread."""
+
+    def setUp(self):
+        """Create a fresh in-memory monitor with a pipeline."""
+        self.monitor = spacetimepy.init_monitoring(db_path=":memory:", pipeline=True, flush_interval=None)
+        self.session = self.monitor.session
+
+    def tearDown(self):
+        """Stop the writer thread."""
+        self.monitor.pipeline.stop()
+        self.session.close()
+
+    def test_events_are_stored_by_writer(self):
+        """Calls and snapshots captured on the monitored thread are all stored."""
+        self.monitor.start_session("pipeline")
+        for i in range(5):
+            monitored_function(i)
+        self.assertEqual(monitored_line_function(4), 6)
+        self.monitor.end_session()
+
+        self.assertEqual(self.monitor.pipeline.stats["errors"], 0)
+        calls = self.session.query(FunctionCall).filter_by(function="monitored_function").order_by(FunctionCall.id).all()
+        self.assertEqual([self.monitor.object_manager.rehydrate(c.return_ref) for c in calls], [0, 2, 4, 6, 8])
+
+        line_call = self.session.query(FunctionCall).filter_by(function="monitored_line_function").one()
+        snapshots = self.session.query(StackSnapshot).filter_by(function_call_id=line_call.id).all()
+        self.assertGreater(len(snapshots), 1)
+        self.assertEqual(line_call.first_snapshot_id, min(s.id for s in snapshots))
+
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
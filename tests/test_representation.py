@@ -4,23 +4,41 @@ Unit tests for the object representation and storage system.
 """
 
 import unittest
+from dataclasses import dataclass, field
+from unittest import mock
 import sys
 import os
 from typing import Optional
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
 
 # Add the parent directory to the path so we can import the package
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from spacetimepy.core.models import Base, init_db, StoredObject, ObjectIdentity
-from spacetimepy.core.representation import ObjectManager, ObjectType, Primitive, List, DictObject, CustomClass
+from spacetimepy.core.chunking import _candidate_boundaries, _candidate_boundaries_python
+from spacetimepy.core.compression import DICTIONARY_SAMPLES, Compressor, dictionary_id, is_compressed, recompress
+from spacetimepy.core.identity import IdentityRegistry
+from spacetimepy.core.models import Base, init_db, StoredObject, ObjectChunk, ObjectIdentity, CompressionDictionary
+from spacetimepy.core.representation import ObjectManager, ObjectType, Primitive, List, DictObject, CustomClass, ArrayObject
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class TestClass:
     def __init__(self, value):
         self.value = value
 
+class Inventory(list):
+    pass
+
+@dataclass
+class Player:
+    name: str
+    hp: int = field(default=100, compare=False)
+
 class TestObjectManager(unittest.TestCase):
     """Test cases for the ObjectManager class."""
     
@@ -212,5 +230,208 @@ class TestObjectManager(unittest.TestCase):
         self.assertIsNone(self.manager.next_ref("non_existent_ref"))
         self.assertEqual(self.manager.get_history("non_existent_ref"), [])
 
+    def test_known_states_are_not_queried(self):
+        """Storing a known state runs no SQL, a new version only inserts"""
+        statements = []
+        event.listen(self.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+        value = [1, 2, 3]
+        ref1 = self.manager.store(value)
+        statements.clear()
+        self.assertEqual(self.manager.store(value), ref1)
+        self.assertEqual(statements, [])
+
+        value.append(4)
+        ref2 = self.manager.store(value)
+        self.assertTrue(statements)
+        self.assertTrue(all(statement.startswith("INSERT") for statement in statements))
+        self.assertEqual(self.session.get(StoredObject, ref2).version_number, 2)
+        self.assertEqual(self.manager.index.stats()["hits"], 1)
+
+    def test_collected_object_identity_is_not_reused(self):
+        """A new object at the address of a collected one starts a new history"""
+        obj = TestClass(1)
+        ref1 = self.manager.store(obj)
+        obj.value = 2
+        ref2 = self.manager.store(obj)
+        self.assertEqual(self.manager.next_ref(ref1), ref2)
+        del obj
+
+        ref3 = self.manager.store(TestClass(3))
+        first = self.session.get(StoredObject, ref1)
+        third = self.session.get(StoredObject, ref3)
+        self.assertNotEqual(first.identity_id, third.identity_id)
+        self.assertEqual(third.version_number, 1)
+
+    def test_identity_registry_size_limit(self):
+        """Objects without weak references are kept up to a total size, an evicted one gets a new identity"""
+        registry = IdentityRegistry(max_strong_size=64 * 1024)
+        small, medium, large = [1, 2, 3], list(range(2000)), list(range(100000))
+        small_token = registry.identity_of(small)
+        self.assertEqual(registry.identity_of(small), small_token)
+
+        # Larger than the bound by itself: not kept, and nothing else is evicted for it
+        large_token = registry.identity_of(large)
+        self.assertEqual(len(registry), 1)
+        self.assertEqual(registry.evictions, 1)
+        self.assertTrue(registry.is_new(large_token))
+        self.assertNotEqual(registry.identity_of(large), large_token)
+        self.assertEqual(registry.identity_of(small), small_token)
+
+        medium_token = registry.identity_of(medium)
+        registry.identity_of(list(range(2000)))
+        self.assertEqual(registry.evictions, 4)
+        self.assertEqual(len(registry), 1)
+        self.assertNotEqual(registry.identity_of(small), small_token)
+        self.assertNotEqual(registry.identity_of(medium), medium_token)
+
+    def test_large_states_share_chunks(self):
+        """Large states are stored as chunks shared between versions"""
+        value = [{"x": i, "y": str(i)} for i in range(20000)]
+        ref1 = self.manager.store(value)
+        chunk_count = self.session.query(ObjectChunk).count()
+        value[10000] = {"x": -1, "y": "changed"}
+        ref2 = self.manager.store(value)
+
+        stored = self.session.get(StoredObject, ref2)
+        self.assertIsNone(stored.pickle_data)
+        self.assertGreater(len(stored.chunk_refs), 1)
+        self.assertLess(self.session.query(ObjectChunk).count() - chunk_count, len(stored.chunk_refs))
+        self.assertEqual(self.manager.get(ref1)[0][10000], {"x": 10000, "y": "10000"})
+        self.assertEqual(self.manager.get(ref2)[0], value)
+
+    @unittest.skipUnless(np is not None, "numpy is not installed")
+    def test_chunk_boundaries_without_numpy(self):
+        """The gear hash computed without numpy finds the same chunk boundaries"""
+        data = np.random.default_rng(1).integers(0, 256, size=200000, dtype=np.uint8).tobytes()
+        boundaries = _candidate_boundaries(data)
+        self.assertGreater(len(boundaries), 10)
+        self.assertEqual(_candidate_boundaries_python(data), boundaries)
+
+    def test_delta_encoding(self):
+        """New versions are stored as patches and rebuilt on load"""
+        self.manager.delta_encoding = True
+        value = {"items": list(range(100)), "name": "state"}
+        obj = TestClass(0)
+        obj.items = list(range(100))
+        expected = {}
+        for i in range(5):
+            value[f"key{i}"] = i
+            obj.value = i
+            expected[self.manager.store(value)] = dict(value)
+            expected[self.manager.store(obj)] = i
+
+        encodings = [stored.encoding for stored in self.session.query(StoredObject).filter(StoredObject.id.in_(expected))]
+        self.assertEqual(encodings.count("delta"), 8)
+        self.manager._reconstructed.clear()
+        for ref, state in expected.items():
+            loaded = self.manager.get(ref)[0]
+            self.assertEqual(loaded if isinstance(loaded, dict) else loaded.value, state)
+
+    def test_delta_encoding_keeps_every_change(self):
+        """Patches keep the elements of container subclasses and the changes __eq__ doesn't see"""
+        self.manager.delta_encoding = True
+        inventory = Inventory(range(200))
+        players = [Player(str(i)) for i in range(50)]
+        zeros = [0.0] * 200
+        expected = []
+        for i in range(1, 4):
+            inventory[5] = -i
+            players[0].hp = 100 - i
+            zeros[i] = -0.0
+            expected.append((self.manager.store(inventory), list(inventory)))
+            expected.append((self.manager.store(players), [p.hp for p in players]))
+            expected.append((self.manager.store(zeros), [str(z) for z in zeros]))
+
+        encodings = [self.session.get(StoredObject, ref).encoding for ref, _ in expected]
+        self.assertEqual(encodings.count("delta"), 4)  # Lists of Players and floats
+        self.manager._reconstructed.clear()
+        for ref, state in expected:
+            loaded = self.manager.get(ref)[0]
+            if isinstance(loaded, Inventory):
+                self.assertEqual(list(loaded), state)
+            elif isinstance(loaded[0], Player):
+                self.assertEqual([p.hp for p in loaded], state)
+            else:
+                self.assertEqual([str(z) for z in loaded], state)
+
+    def test_compression(self):
+        """Compressed states and chunks load back, recompress() rewrites them with another codec"""
+        self.manager.compressor = Compressor("zlib", dictionaries=True)
+        expected = {}
+        for i in range(DICTIONARY_SAMPLES + 5):
+            expected[self.manager.store(TestClass(f"instance {i} " * 20))] = f"instance {i} " * 20
+        large = [f"item {i}" for i in range(20000)]
+        large_ref = self.manager.store(large)
+        self.session.commit()
+
+        stored = self.session.query(StoredObject).filter(StoredObject.id.in_(expected)).all()
+        self.assertTrue(all(is_compressed(obj.pickle_data) for obj in stored))
+        self.assertEqual(self.session.query(CompressionDictionary).count(), 1)
+        self.assertTrue(any(dictionary_id(obj.pickle_data) is not None for obj in stored))
+        self.assertTrue(all(is_compressed(chunk.data) for chunk in self.session.query(ObjectChunk)))
+
+        recompress(self.session, Compressor("lzma"))
+        self.assertEqual(self.session.query(CompressionDictionary).count(), 0)
+        self.manager.pickle_config.dictionaries.clear()
+        self.manager._reconstructed.clear()
+        for ref, value in expected.items():
+            self.assertEqual(self.manager.get(ref)[0].value, value)
+        self.assertEqual(self.manager.get(large_ref)[0], large)
+
+    @unittest.skipUnless(np is not None, "numpy is not installed")
+    def test_array_storage(self):
+        """Arrays are hashed over their buffer and loaded back without a copy"""
+        image = np.arange(64 * 64 * 3, dtype=np.uint8).reshape(64, 64, 3)
+        ref = self.manager.store(image)
+        self.assertEqual(self.manager.store(image.copy()), ref)
+        captured = self.manager.capture(image)
+        self.assertIsInstance(captured, ArrayObject)
+        self.assertEqual(captured.ref(), ref)
+
+        image[0, 0] = 255
+        new_ref = self.manager.store(image)
+        self.assertNotEqual(new_ref, ref)
+        self.assertEqual(self.session.query(StoredObject).filter_by(type_name="ndarray").count(), 2)
+
+        loaded = self.manager.get(new_ref)[0]
+        np.testing.assert_array_equal(loaded, image)
+        self.assertFalse(loaded.flags.writeable)  # Views on the stored payload
+        self.assertTrue(self.manager.rehydrate(new_ref).flags.writeable)
+
+        transposed = image.transpose(1, 0, 2)  # Not contiguous, pickled with its data
+        np.testing.assert_array_equal(self.manager.get(self.manager.store(transposed))[0], transposed)
+
+        # Large arrays are split in fixed size chunks, a modified pixel only adds one chunk
+        large = np.zeros((256, 256, 3), dtype=np.uint8)
+        self.manager.store(large)
+        chunk_count = self.session.query(ObjectChunk).count()
+        large[100, 100] = 1
+        np.testing.assert_array_equal(self.manager.get(self.manager.store(large))[0], large)
+        self.assertEqual(self.session.query(ObjectChunk).count(), chunk_count + 1)
+
+    @unittest.skipUnless(np is not None, "numpy is not installed")
+    def test_stored_arrays_are_not_copied(self):
+        """Capturing an array whose state is stored doesn't copy its data"""
+        from spacetimepy.core import representation
+        image = np.arange(64 * 64 * 3, dtype=np.uint8).reshape(64, 64, 3)
+        with mock.patch.object(representation, "encode_frame", wraps=representation.encode_frame) as encode:
+            refs = {self.manager.store_captured(self.manager.capture(image)) for _ in range(5)}
+            self.assertEqual(len(refs), 1)
+            self.assertEqual(encode.call_count, 1)
+
+            # A rolled back state is stored again from the array, unless it changed
+            captured = self.manager.capture(image)
+            self.manager.index.clear()
+            self.session.query(StoredObject).filter_by(type_name="ndarray").delete()
+            self.assertEqual(self.manager.store_captured(captured), refs.pop())
+            self.assertEqual(encode.call_count, 2)
+            captured = self.manager.capture(image)
+            self.manager.index.clear()
+            self.session.query(StoredObject).filter_by(type_name="ndarray").delete()
+            image[0, 0] = 255
+            with self.assertRaises(ValueError):
+                captured.data()
+
 if __name__ == '__main__':
     unittest.main(failfast=True) 
\ No newline at end of file